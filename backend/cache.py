@@ -0,0 +1,96 @@
+import json
+import collections
+
+import config
+
+
+class ResultCache():
+	"""
+	Bounded LRU of search results, keyed by query kind, parameters and the
+	generation of every notebook the query reads.
+	A notebook's generation is bumped whenever its notes or index change,
+	which drops its cached results at once.
+	"""
+
+	def __init__(self, max_bytes=config.RESULT_CACHE_BYTES, max_entries=config.RESULT_CACHE_ENTRIES):
+		self.max_bytes = max_bytes
+		self.max_entries = max_entries
+		self.entries = collections.OrderedDict()  # key --> (result, size)
+		self.generations = collections.Counter()  # notebookid --> generation
+		self.by_notebook = collections.defaultdict(set)  # notebookid --> keys
+		self.size = 0
+		self.stats = {
+			'hits': 0,
+			'misses': 0,
+			'puts': 0,
+			'evictions': 0,
+			'invalidations': 0,
+		}
+
+	def key(self, kind, notebookids, params):
+		"""
+		@params: dict of query parameters, values must be hashable
+		"""
+		return (kind, tuple((int(nbid), self.generations[int(nbid)]) for nbid in notebookids), tuple(sorted(params.items())))
+
+	def get(self, key):
+		"""
+		Return a cached result, shared with other readers and not to be modified
+		"""
+		entry = self.entries.get(key)
+		if entry is None:
+			self.stats['misses'] += 1
+			return None
+		self.entries.move_to_end(key)
+		self.stats['hits'] += 1
+		return entry[0]
+
+	def put(self, key, result):
+		# a notebook changed while the query ran, its result is already stale
+		if any(self.generations[nbid] != gen for nbid, gen in key[1]):
+			return
+		size = len(json.dumps(result, default=str))
+		if size > self.max_bytes:
+			return
+		self._remove(key)
+		self.entries[key] = (result, size)
+		self.size += size
+		for nbid, _ in key[1]:
+			self.by_notebook[nbid].add(key)
+		self.stats['puts'] += 1
+		while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+			self._remove(next(iter(self.entries)))
+			self.stats['evictions'] += 1
+
+	def _remove(self, key):
+		entry = self.entries.pop(key, None)
+		if entry is None:
+			return
+		self.size -= entry[1]
+		for nbid, _ in key[1]:
+			keys = self.by_notebook.get(nbid)
+			if keys is not None:
+				keys.discard(key)
+
+	def bump(self, notebookid):
+		"""
+		Invalidate every cached result that read @notebookid
+		"""
+		notebookid = int(notebookid)
+		self.generations[notebookid] += 1
+		for key in self.by_notebook.pop(notebookid, ()):
+			self._remove(key)
+			self.stats['invalidations'] += 1
+
+	def info(self):
+		lookups = self.stats['hits'] + self.stats['misses']
+		return {
+			**self.stats,
+			'entries': len(self.entries),
+			'bytes': self.size,
+			'max_bytes': self.max_bytes,
+			'hit_rate': self.stats['hits'] / lookups if lookups else 0.0,
+		}
+
+
+results = ResultCache()
@@ -6,6 +6,37 @@ SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 SQLITE_TOKENIZER = "../libsimple/libsimple"
 DB_PATH = os.path.join(SCRIPT_DIR, "db/database.db")
+SQLITE_READERS = 4  # reader connections in the pool, besides the single writer
+SQLITE_STATEMENT_CACHE = 256  # prepared statements kept per connection
+SQLITE_PRAGMAS = {
+	"journal_mode": "WAL",
+	"synchronous": "NORMAL",
+	"cache_size": -64000,  # KiB
+	"mmap_size": 256*1024*1024,
+	"temp_store": "MEMORY",
+	"busy_timeout": 5000,  # ms
+}
+
+NOTE_SCAN_INTERVAL = 600  # seconds between scans for notes to chunk
+CHUNKS_DROP_LEGACY_COLUMNS = False  # drop the chunk columns of notebook tables migrated to the chunks table, back up the database first
+
+# background writes (chunk stores, vectorstore saves) are grouped into one commit
+GROUP_COMMIT_MAX_BATCH = 64  # jobs
+GROUP_COMMIT_MAX_DELAY = 2  # seconds
+GROUP_COMMIT_WAIT = False  # True: writers wait until their batch is committed
+
+# bulk import
+IMPORT_BATCH_SIZE = 2000  # notes inserted per transaction
+IMPORT_SPOOL_MEMORY = 16*1024*1024  # bytes, larger zip uploads are spooled to disk
+IMPORT_ZIP_MAX_MEMBERS = 100000  # files in a zip upload
+IMPORT_ZIP_MAX_MEMBER_SIZE = 64*1024*1024  # bytes, uncompressed, of one file in a zip upload
+IMPORT_ZIP_MAX_RATIO = 100  # uncompressed to compressed size of a file in a zip upload, higher looks like a zip bomb
+IMPORT_ZIP_READ_SIZE = 64*1024  # bytes decompressed per read of a zip member
+IMPORT_MAX_ERRORS = 20  # invalid records reported per import
+IMPORT_PIPELINE_DEPTH = 64  # notes buffered between chunk pipeline stages
+IMPORT_EMBED_WORKERS = 4  # concurrent embedding requests of the chunk pipeline
+EXPORT_FETCH_SIZE = 500  # notes read and sent per block by a streaming export
+
 NPL_MODEL_NAME = "zh_core_web_sm"
 # LLM_MODEL_NAME = "multi2"
 # LLM_EMBED_D = 512
@@ -14,6 +45,53 @@ LLM_EMBED_D = 768
 LLM_API_URL = "http://192.168.1.220:8999/embedding"
 LLM_HTTP_TIMEOUT = 300
 
-FAISS_NLIST = 6
+# FTS index maintenance
+FTS_AUTOMERGE = 8  # segments on a level before writers merge them
+FTS_CRISISMERGE = 16  # segments on a level before a writer must merge them at once
+FTS_USERMERGE = 4  # segments on a level before an incremental merge step touches it
+FTS_PREFIX = "1 2 3"  # token prefix lengths indexed for type-ahead queries
+FTS_MAINTENANCE_INTERVAL = 60  # seconds between maintenance rounds
+FTS_MERGE_PAGES = 256  # pages written per incremental merge step
+FTS_MERGE_STEPS = 16  # max merge steps per table per idle round
+FTS_OPTIMIZE_IDLE_ROUNDS = 30  # idle rounds in a row before fragmented indexes are fully optimized
+
+SEARCH_FTS_TIMEOUT = 2  # seconds, per vsearch leg
+SEARCH_EMBED_TIMEOUT = 3
+SEARCH_BATCH_MAX = 256  # max queries per batch search request
+SEARCH_FEDERATED_BUDGET = 5  # seconds, whole bookshelf search
+RESULT_CACHE_ENTRIES = 4096  # cached search results, across notebooks
+RESULT_CACHE_BYTES = 64*1024*1024  # approximate, measured as serialized JSON
+SNIPPET_MAX = 3  # max snippets per search result
+SNIPPET_OFFSET_CACHE_BYTES = 32*1024*1024  # cached byte to char offset tables of non-ascii notes
+
+COMPRESS_MIN_SIZE = 1024  # bytes, smaller responses are sent uncompressed
+COMPRESS_GZIP_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 4
+
+FAISS_NLIST = 6  # 0: exact search without inverted lists
 FAISS_NORMALIZE = True
 FAISS_NPROBE = 3
+FAISS_ENCODING = "Flat"  # Flat | SQ8 | SQfp16 | PQ<m>, see tools/vsbench.py for per-notebook settings
+FAISS_LATENCY_TARGET = 0.02  # seconds per vector search, waiting for the index included, above it nprobe is lowered
+FAISS_NPROBE_MIN = 1  # lowest nprobe a search is degraded to under load
+FAISS_CANDIDATES = 2  # faiss hits per requested result, chunks of one note count as one result
+FAISS_CANDIDATES_HR = 4  # same, for high recall searches, which also probe every inverted list
+VECTORSTORE_CACHE_SIZE = 8  # max vectorstores kept loaded in memory
+HYDRATE_MEMORY_BUDGET = 512*1024*1024  # bytes of serialized vectorstores loaded by the startup warm-up, 0 to disable
+
+RANK_FUSION = "rrf"  # rrf | weighted
+RANK_RRF_K = 60
+RANK_WEIGHTS = {"fts": 1.0, "content": 1.0, "title": 0.5}
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")  # DEBUG | INFO | WARNING | ERROR
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # text | json, one object per line
+
+TRACE_EXPORT = os.environ.get("TRACE_EXPORT", "")  # "" off | stdout | path of a JSON lines file
+TRACE_SERVICE_NAME = "notebook-backend"
+
+PROFILE_MAX_SECONDS = 60  # longest sampling profile an admin may request
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+LOOP_LAG_INTERVAL = 0.1  # seconds between event loop heartbeats
+LOOP_LAG_THRESHOLD = 0.25  # seconds, a late heartbeat beyond this logs the blocking stack
+
+WARMUP = True  # once serving, preload the nlp model, recently used vectorstores and the llm server's model in the background
@@ -0,0 +1,160 @@
+import logging
+import json
+import struct
+
+import numpy as np
+
+import config
+import model
+
+logger = logging.getLogger(__name__)
+
+
+# binary export layout, all integers little endian:
+#   header   MAGIC, u8 version, u32 embed_d, u8 with_chunks
+#   note     i64 noteid, i64 lastedit, u32 n_chunk, then title, content and meta
+#            each as u32 length + utf-8 bytes
+#   chunks   (with_chunks only) u8 has_title_emb [+ embed_d f32 title embedding],
+#            then n_chunk times u32 span_start, u32 span_end, embed_d f32 embedding
+MAGIC = b'NBEX'
+VERSION = 1
+_header = struct.Struct('<4sBIB')
+_note = struct.Struct('<qqI')
+_span = struct.Struct('<II')
+_len = struct.Struct('<I')
+
+
+def _pack_str(s):
+	b = (s or '').encode('utf-8')
+	return _len.pack(len(b)) + b
+
+
+def encode_note_binary(noteid, title, content, lastedit, meta, chunks, with_chunks):
+	title_vec, chunk_rows = chunks if chunks else (None, [])
+	# vectors left over from a model of another size are not exported
+	vec_size = config.LLM_EMBED_D * 4
+	if title_vec is not None and len(title_vec) != vec_size:
+		title_vec = None
+	chunk_rows = [row for row in chunk_rows if len(row[2]) == vec_size]
+
+	parts = [_note.pack(noteid, lastedit or 0, len(chunk_rows)),
+		_pack_str(title), _pack_str(content), _pack_str(meta)]
+	if with_chunks:
+		parts.append(b'\x01' + title_vec if title_vec is not None else b'\x00')
+		for s, e, vec in chunk_rows:
+			parts.append(_span.pack(s, e) + vec)
+	return b''.join(parts)
+
+
+def encode_note_ndjson(noteid, title, content, lastedit, meta, chunks, with_chunks):
+	note = {
+		'noteid': noteid,
+		'title': title,
+		'textcontent': content,
+		'lastedit': lastedit,
+		'meta': json.loads(meta) if meta else {},
+	}
+	if with_chunks:
+		note['chunk_spans'] = [[s, e] for s, e, _ in chunks[1]] if chunks else []
+	return json.dumps(note, ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+ENCODERS = {
+	'ndjson': encode_note_ndjson,
+	'bin': encode_note_binary,
+}
+
+
+async def _iter_chunks(conn, notebookid):
+	# chunk rows of the whole notebook in note order, straight off the chunks_note index
+	cursor = await conn.execute('''
+		SELECT noteid, chunk_idx, span_start, span_end, vector
+		FROM chunks
+		WHERE notebookid = ?
+		ORDER BY noteid, chunk_idx;
+	''', (notebookid,))
+	while rows := await cursor.fetchmany(config.EXPORT_FETCH_SIZE):
+		for row in rows:
+			yield row
+	await cursor.close()
+
+
+async def iter_export(notebookid, fmt='ndjson', with_chunks=False):
+	"""
+	Stream every note of a notebook, and optionally its chunk spans and embeddings,
+	in @fmt as a series of byte blocks.
+	Reads go through a dedicated read-only connection inside one read transaction,
+	so the export is a consistent WAL snapshot that neither blocks writers nor
+	holds a pool reader for the whole download.
+	"""
+	encode = ENCODERS[fmt]
+	tablename = f"notebook_{notebookid}"
+	conn = await model.db_connect(config.DB_PATH, readonly=True)
+	try:
+		await conn.execute("BEGIN;")
+		if fmt == 'bin':
+			yield _header.pack(MAGIC, VERSION, config.LLM_EMBED_D, int(with_chunks))
+
+		chunk_rows = _iter_chunks(conn, notebookid) if with_chunks else None
+		pending_chunk = None
+		cursor = await conn.execute(f'''
+			SELECT
+				docid, title, content,
+				CAST(strftime('%s', lastedit) AS INTEGER), meta
+			FROM {tablename}
+			ORDER BY docid;
+		''')
+		n = 0
+		while rows := await cursor.fetchmany(config.EXPORT_FETCH_SIZE):
+			block = []
+			for noteid, title, content, lastedit, meta in rows:
+				chunks = None
+				if chunk_rows is not None:
+					# merge join, both cursors walk in noteid order
+					title_vec, note_chunks = None, []
+					while True:
+						if pending_chunk is None:
+							pending_chunk = await anext(chunk_rows, None)
+						if pending_chunk is None or pending_chunk[0] > noteid:
+							break
+						if pending_chunk[0] == noteid:
+							_, chunk_idx, s, e, vec = pending_chunk
+							if chunk_idx == model.chunk.TITLE_CHUNK_IDX:
+								title_vec = vec
+							else:
+								note_chunks.append((s, e, vec))
+						pending_chunk = None
+					chunks = (title_vec, note_chunks)
+				block.append(encode(noteid, title, content, lastedit, meta, chunks, with_chunks))
+			n += len(block)
+			yield b''.join(block)
+		await cursor.close()
+		logger.info(f"exported {n} notes from table#{notebookid}")
+	finally:
+		await conn.close()
+
+
+def read_binary(f):
+	"""
+	Parse a binary export from file object @f,
+	yield (noteid, title, content, lastedit, meta, title_emb, chunk_spans, chunk_embs)
+	"""
+	magic, version, embed_d, with_chunks = _header.unpack(f.read(_header.size))
+	assert magic == MAGIC and version == VERSION, "not a notebook export"
+	vec_size = embed_d * 4
+
+	def _read_str():
+		n, = _len.unpack(f.read(_len.size))
+		return f.read(n).decode('utf-8')
+
+	while head := f.read(_note.size):
+		noteid, lastedit, n_chunk = _note.unpack(head)
+		title, content, meta = _read_str(), _read_str(), _read_str()
+		title_emb, chunk_spans, chunk_embs = None, [], []
+		if with_chunks:
+			if f.read(1) == b'\x01':
+				title_emb = np.frombuffer(f.read(vec_size), dtype=np.float32)
+			for _ in range(n_chunk):
+				chunk_spans.append(list(_span.unpack(f.read(_span.size))))
+				chunk_embs.append(np.frombuffer(f.read(vec_size), dtype=np.float32))
+		yield noteid, title, content, lastedit, json.loads(meta) if meta else {}, title_emb, chunk_spans, chunk_embs
@@ -0,0 +1,295 @@
+import logging
+import os
+import json
+import asyncio
+import typing
+import zipfile
+import tempfile
+import datetime
+import itertools
+
+import anyio
+import pydantic
+import starlette.requests
+
+import config
+import cache
+import model
+import metrics
+import worker
+
+logger = logging.getLogger(__name__)
+
+
+# import ids being ingested by this process
+running_imports = set()
+# import_id --> [notes chunked, notes failed] since this process started
+chunk_progress = {}
+
+
+class NoteRecord(pydantic.BaseModel):
+	title: str = pydantic.Field(min_length=1)
+	textcontent: str = pydantic.Field(min_length=1)
+	lastedit: typing.Optional[int] = pydantic.Field(None, ge=0, description="unix time, defaults to import time")
+	meta: typing.Optional[typing.Dict[str, typing.Any]] = pydantic.Field(None, description="note metadata as exported, chunk bookkeeping is dropped")
+
+
+def parse_record(raw):
+	"""
+	Validate one input record, a NDJSON line or a dict
+	"""
+	if isinstance(raw, bytes):
+		raw = json.loads(raw)
+	if not isinstance(raw, dict):
+		raise ValueError("record is not an object")
+	record = NoteRecord(**raw)
+	if not record.title.strip() or not record.textcontent.strip():
+		raise ValueError("empty title or content")
+	return record
+
+
+async def iter_ndjson(stream):
+	"""
+	Yield non-blank lines of a NDJSON byte stream
+	"""
+	buf = b''
+	async for chunk in stream:
+		*lines, buf = (buf + chunk).split(b'\n')
+		for line in lines:
+			if line.strip():
+				yield line
+	if buf.strip():
+		yield buf
+
+
+def _check_zip_member(info):
+	if info.file_size > config.IMPORT_ZIP_MAX_MEMBER_SIZE:
+		raise zipfile.BadZipFile(f"{info.filename}: {info.file_size} bytes uncompressed, over {config.IMPORT_ZIP_MAX_MEMBER_SIZE}")
+	if info.file_size > config.IMPORT_ZIP_READ_SIZE and info.file_size > info.compress_size * config.IMPORT_ZIP_MAX_RATIO:
+		raise zipfile.BadZipFile(f"{info.filename}: compressed over {config.IMPORT_ZIP_MAX_RATIO} times")
+
+
+def _read_zip_member(zf, info):
+	# in steps, never past the size limit whatever the member's header claims
+	parts = []
+	size = 0
+	with zf.open(info) as f:
+		while part := f.read(config.IMPORT_ZIP_READ_SIZE):
+			size += len(part)
+			if size > config.IMPORT_ZIP_MAX_MEMBER_SIZE:
+				raise zipfile.BadZipFile(f"{info.filename}: over {config.IMPORT_ZIP_MAX_MEMBER_SIZE} bytes uncompressed")
+			parts.append(part)
+	return b''.join(parts)
+
+
+def _iter_zip(fileobj):
+	with zipfile.ZipFile(fileobj) as zf:
+		infos = [info for info in zf.infolist() if not info.is_dir()]
+		if len(infos) > config.IMPORT_ZIP_MAX_MEMBERS:
+			raise zipfile.BadZipFile(f"{len(infos)} files, over {config.IMPORT_ZIP_MAX_MEMBERS}")
+		# members in name order, so the same archive always yields records in the same order
+		for info in sorted(infos, key=lambda info: info.filename):
+			ext = os.path.splitext(info.filename)[1].lower()
+			if ext not in ('.ndjson', '.jsonl', '.md', '.txt'):
+				continue
+			_check_zip_member(info)
+			if ext in ('.ndjson', '.jsonl'):
+				# zipfile stops reading a member at its header's size, which is checked above
+				with zf.open(info) as f:
+					for line in f:
+						if line.strip():
+							yield line
+			else:
+				yield {
+					'title': os.path.splitext(os.path.basename(info.filename))[0],
+					'textcontent': _read_zip_member(zf, info).decode('utf-8', errors='replace'),
+					'lastedit': int(datetime.datetime(*info.date_time).timestamp()),
+				}
+
+
+async def iter_zip(stream):
+	"""
+	Yield records of a zip archive holding NDJSON files and/or one note per .md/.txt file.
+	The upload is spooled first since zip archives are read from their end.
+	"""
+	with tempfile.SpooledTemporaryFile(max_size=config.IMPORT_SPOOL_MEMORY) as spool:
+		async for chunk in stream:
+			spool.write(chunk)
+		spool.seek(0)
+		records = _iter_zip(spool)
+		while batch := await anyio.to_thread.run_sync(lambda: list(itertools.islice(records, config.IMPORT_BATCH_SIZE))):
+			for raw in batch:
+				yield raw
+
+
+async def _commit_batch(app, db_conn, job, batch):
+	docids = await model.Note.db_insert_many(db_conn, job['notebookid'], batch) if batch else []
+	await model.Imports.progress(db_conn, job['import_id'], job['n_records'], job['n_inserted'] + len(docids), job['n_invalid'], job['errors'])
+	await db_conn.commit()
+	model.forget_note_count(job['notebookid'])
+	job['n_inserted'] += len(docids)
+	await _queue_notes(app, job, docids)
+
+
+async def _queue_notes(app, job, docids):
+	app.state.importing[job['notebookid']] += len(docids)
+	for docid in docids:
+		app.state.import_queue.put_nowait((job['import_id'], job['notebookid'], docid))
+
+
+async def ingest(app, job, records):
+	"""
+	Insert records in transactions of IMPORT_BATCH_SIZE notes with the notebook's
+	FTS index sync suspended, then rebuild the index once.
+	Committed notes are fed to the chunk pipeline right away.
+	Records committed by an earlier run of the same import are skipped.
+	Runs on a connection of its own, so its rollbacks and commits never
+	take in request handlers' writes.
+	"""
+	db_conn = await model.db_connect(config.DB_PATH)
+	notebookid = job['notebookid']
+	tablename = f"notebook_{notebookid}"
+	n_skip = job['n_records']
+	logger.info(f"import {job['import_id']}: start at record {n_skip+1} into table#{notebookid}")
+
+	if n_skip:
+		# notes committed by the interrupted run may not have been chunked yet
+		cursor = await db_conn.execute(f"SELECT docid FROM {tablename} WHERE dirty = 1;")
+		await _queue_notes(app, job, [docid for docid, in await cursor.fetchall()])
+		await cursor.close()
+
+	running_imports.add(job['import_id'])
+	app.state.importing[notebookid] += 1
+	status = 'failed'
+	committed = (job['n_records'], job['n_invalid'], list(job['errors']))
+	# notes written meanwhile by other connections are indexed by the rebuild on resume
+	fts_suspended = await model.db_suspend_table_fts(db_conn, tablename)
+	try:
+		batch = []
+		i = 0
+		async for raw in records:
+			i += 1
+			if i <= n_skip:
+				continue
+			try:
+				record = parse_record(raw)
+				batch.append((record.title, record.textcontent, record.lastedit, record.meta))
+			except (ValueError, pydantic.ValidationError) as e:
+				job['n_invalid'] += 1
+				if len(job['errors']) < config.IMPORT_MAX_ERRORS:
+					job['errors'].append({'record': i, 'error': str(e)})
+			job['n_records'] = i
+			if len(batch) >= config.IMPORT_BATCH_SIZE:
+				await _commit_batch(app, db_conn, job, batch)
+				committed = (job['n_records'], job['n_invalid'], list(job['errors']))
+				batch = []
+		await _commit_batch(app, db_conn, job, batch)
+		status = 'done'
+	except starlette.requests.ClientDisconnect:
+		status = 'interrupted'
+	except Exception:
+		await db_conn.rollback()  # drop the partial batch, committed batches are kept
+		raise
+	finally:
+		if status != 'done':
+			# report what a resumed run will skip, not records of the dropped batch
+			job['n_records'], job['n_invalid'], job['errors'] = committed
+		try:
+			if fts_suspended:
+				await model.db_resume_table_fts(db_conn, tablename)
+			await model.Imports.finish(db_conn, job['import_id'], status)
+			await db_conn.commit()
+		finally:
+			await db_conn.close()
+		cache.results.bump(notebookid)
+		running_imports.discard(job['import_id'])
+		await _release(app, notebookid)
+		job['status'] = status
+		logger.info(f"import {job['import_id']}: {status}, {job['n_inserted']} notes inserted, {job['n_invalid']} invalid records")
+	return job
+
+
+async def _note_done(app, import_id, notebookid, ok):
+	progress = chunk_progress.setdefault(import_id, [0, 0])
+	progress[0 if ok else 1] += 1
+	metrics.chunked_notes.inc(outcome='ok' if ok else 'failed')
+	n_chunked = progress[0]
+
+	async def _write_progress(db_conn):
+		await model.Imports.set_chunked(db_conn, import_id, n_chunked)
+	await app.state.write_queue.submit(('import', import_id), _write_progress)
+	await _release(app, notebookid)
+
+
+async def _release(app, notebookid):
+	app.state.importing[notebookid] -= 1
+	if app.state.importing[notebookid] <= 0:
+		# the whole import is chunked, let the rebuilder train or refresh the vectorstore
+		del app.state.importing[notebookid]
+		await app.state.write_queue.flush()
+		await app.state.rebuild_queue.put(notebookid)
+
+
+async def _split_stage(app, embed_queue):
+	while True:
+		import_id, notebookid, noteid = await app.state.import_queue.get()
+		try:
+			async with app.state.db_pool.reader() as db_conn:
+				note = await model.Note.db_load(db_conn, notebookid, noteid)
+			sentences, spans = await anyio.to_thread.run_sync(note.split)
+		except Exception as err:
+			logger.warning(f"note#{notebookid}/{noteid}: split - failed: {err!r}")
+			await _note_done(app, import_id, notebookid, ok=False)
+			continue
+		await embed_queue.put((import_id, note, sentences, spans))
+
+
+async def _embed_stage(app, embed_queue, index_queue):
+	while True:
+		import_id, note, sentences, spans = await embed_queue.get()
+		try:
+			rets = await note.embed(sentences, spans) if sentences else None
+		except Exception as err:
+			logger.warning(f"note#{note.notebookid}/{note.noteid}: embed - failed: {err!r}")
+			rets = None
+		if not rets:
+			logger.warning(f"note#{note.notebookid}/{note.noteid}: chunk - failed")
+			await _note_done(app, import_id, int(note.notebookid), ok=False)
+			continue
+		await index_queue.put((import_id, note, rets))
+
+
+async def _index_stage(app, index_queue):
+	while True:
+		import_id, note, (chunks, chunk_spans, chunk_embs, title_emb) = await index_queue.get()
+		try:
+			await worker.store_chunks(app, note, chunks, chunk_spans, chunk_embs, title_emb)
+			ok = True
+		except Exception as err:
+			logger.warning(f"note#{note.notebookid}/{note.noteid}: index - failed: {err!r}")
+			ok = False
+		await _note_done(app, import_id, int(note.notebookid), ok=ok)
+
+
+async def chunk_pipeline(app):
+	"""
+	Chunk imported notes in three overlapping stages, split --> embed --> index.
+	Sentence splitting runs on a worker thread while several notes wait on the
+	LLM server and finished ones are added to their vectorstore.
+	Bounded queues between stages keep a slow stage from piling up work.
+	Notes stay dirty until their chunks are committed, so anything lost to a
+	restart is picked up again by the note scanner.
+	"""
+	await anyio.sleep(1)
+	logger.info("import pipeline: start")
+	embed_queue = asyncio.Queue(config.IMPORT_PIPELINE_DEPTH)
+	index_queue = asyncio.Queue(config.IMPORT_PIPELINE_DEPTH)
+	try:
+		async with anyio.create_task_group() as tg:
+			tg.start_soon(_split_stage, app, embed_queue)
+			for _ in range(config.IMPORT_EMBED_WORKERS):
+				tg.start_soon(_embed_stage, app, embed_queue, index_queue)
+			tg.start_soon(_index_stage, app, index_queue)
+	except anyio.get_cancelled_exc_class():
+		logger.info("import pipeline: cancelled")
+		raise
@@ -1,3 +1,4 @@
+import logging
 import urllib.parse
 import typing
 import json
@@ -14,6 +15,8 @@ import starlette.responses
 import utils
 import model
 
+logger = logging.getLogger(__name__)
+
 
 
 async def login(request):
@@ -22,7 +25,7 @@ async def login(request):
 	"""
 	if request.method == "POST":
 		if request.user.is_authenticated:
-			print("attempt to logout as %s(%s)" % (request.user.username, request.user.uid))
+			logger.info("attempt to logout as %s(%s)", request.user.username, request.user.uid)
 			model.user.user_pool.pop(request.user.uid)
 			model.user.user_pool.pop(request.user.username)
 			await starlette_login.utils.logout_user(request)
@@ -42,7 +45,7 @@ async def login(request):
 		except pydantic.ValidationError as e:
 			return utils._error_json_resp(400, "invalid parameters", content=e.errors())
 
-		print("attempt to login as %s with password=%s" % (post_params.username, post_params.password))
+		logger.info("attempt to login as %s", post_params.username)
 		user = await model.User.getUserByName(request, post_params.username)
 		if not user:
 			request.session.clear()
@@ -104,7 +107,7 @@ async def logout(request):
 		return utils._error_json_resp(400, "not logged in")
 
 	user = request.user
-	print("attempt to logout as %s(%s)" % (user.username, user.uid))
+	logger.info("attempt to logout as %s(%s)", user.username, user.uid)
 	await starlette_login.utils.logout_user(request)
 	model.user.user_pool.pop(user.uid)
 	model.user.user_pool.pop(user.username)
@@ -130,14 +133,17 @@ async def register(request):
 	except pydantic.ValidationError as e:
 		return utils._error_json_resp(400, "invalid parameters", content={"error": e.errors()})
 
-	print("attempt to register as '%s' with password '%s'" % (post_params.username, post_params.password))
+	logger.info("attempt to register as '%s'", post_params.username)
 	uid = await model.User.createUser(request, post_params.username, post_params.password)
 	if not uid:
 		return utils._error_json_resp(400, "unable to create user")
-	print(f"suscessfully registered {post_params.username}(uid={uid})")
+	logger.info(f"suscessfully registered {post_params.username}(uid={uid})")
 
-	# create a notebook for user
-	await model.Notebook.createNotebook(request, uid)
+	# create a notebook for user, searchable right away
+	nbid = await model.Notebook.createNotebook(request, uid)
+	if nbid:
+		await model.db_init_table_fts(request.app.state.db_conn, f"notebook_{nbid}", fts_tokenizer='simple')
+		await request.app.state.db_conn.commit()
 
 	return utils._json_resp(200, "registered", content={
 		"uid": uid,
@@ -1,15 +1,19 @@
+import time
+startup_t0 = time.perf_counter()  # startup timings count from before the imports
+import logging
 import os
 import asyncio
 import typing
 import json
 import urllib.parse
 import datetime
-import requests
 import dataclasses
-import pickle
 import contextlib
 import collections
+import zipfile
 import math
+import uuid
+import threading
 
 import anyio
 import anyio.from_thread
@@ -38,9 +42,22 @@ import model
 import worker
 import nlp
 import utils
+import middleware
 import search
+import cache
+import metrics
+import tracing
+import profiler
+import importer
+import exporter
+import ranking
 import login
 
+logger = logging.getLogger(__name__)
+utils.setup_logging()
+
+startup = utils.StartupTimer(startup_t0)
+
 
 
 
@@ -53,32 +70,93 @@ import login
 bg_tasks=None
 
 
+async def warmup(app):
+	"""
+	Preload what the first chunked note and searches would wait for,
+	recently used vectorstores first among them.
+	Runs once the server answers requests, heavy loading happens off the event loop.
+	"""
+	logger.info("warm-up: start")
+
+	async def _nlp():
+		with startup.timed('warmup.nlp'):
+			try:
+				await anyio.to_thread.run_sync(nlp.preload)
+			except Exception as err:
+				logger.warning(f"warm-up: failed to load nlp model: {err!r}")
+
+	async def _vectorstores():
+		if config.HYDRATE_MEMORY_BUDGET <= 0:
+			return
+		with startup.timed('warmup.vectorstores'):
+			try:
+				loaded = await model.NotebookVectorStore.hydrate(app.state.db_conn)
+				logger.info(f"warm-up: hydrated vectorstores of notebooks {loaded}")
+			except Exception as err:
+				logger.warning(f"warm-up: failed to hydrate vectorstores: {err!r}")
+
+	async def _llm():
+		# makes the llm server load its embedding model
+		with startup.timed('warmup.llm'):
+			await nlp.asyncGetEmbedLLM(['warm up'])
+
+	async with anyio.create_task_group() as tg:
+		tg.start_soon(_vectorstores)
+		tg.start_soon(_nlp)
+		tg.start_soon(_llm)
+	logger.info(f"warm-up: {startup.report([p for p in startup.phases if p.startswith('warmup.')])}")
+
+
 @contextlib.asynccontextmanager
 async def lifespan_event(app):
 	async with anyio.create_task_group() as tg:
 		global bg_tasks
 		bg_tasks = tg
-		print("Application starting up...")
+		startup.lap('import')
+		logger.info("Application starting up...")
 		app.state.should_exit = False
-		app.state.db_conn = await model.db_init(config.DB_PATH)
-		print("database initialized")
+		app.state.db_pool = await model.DBPool.open(config.DB_PATH)
+		app.state.db_conn = app.state.db_pool.writer
+		logger.info("database initialized")
+		startup.lap('db')
+		# group commits get a writer connection of their own, apart from the one request handlers commit on
+		app.state.write_queue = model.WriteBehindQueue(await model.db_connect(config.DB_PATH))
+		tg.start_soon(app.state.write_queue.run)
 		app.state.rebuild_queue = asyncio.Queue()
 		tg.start_soon(worker.index_rebuilder, app)
 		app.state.chunk_queue = asyncio.Queue()
 		tg.start_soon(anyio.to_thread.run_sync, worker.note_chunker, app)
 		tg.start_soon(worker.note_scanner, app)
-		print("background worker initialized")
+		tg.start_soon(worker.fts_maintainer, app)
+		app.state.import_queue = asyncio.Queue()
+		app.state.importing = collections.Counter()  # notebookid --> imported notes waiting to be chunked
+		tg.start_soon(importer.chunk_pipeline, app)
+		tg.start_soon(profiler.loop_lag_monitor, app)
+		logger.info("background worker initialized")
+		metrics.queue_depth.fn = lambda: {
+			('chunk',): app.state.chunk_queue.qsize(),
+			('rebuild',): app.state.rebuild_queue.qsize(),
+			('import',): app.state.import_queue.qsize(),
+			('write',): app.state.write_queue.info()['pending_jobs'],
+		}
+		metrics.result_cache.fn = lambda: {(k,): v for k, v in cache.results.info().items()}
+		metrics.startup_seconds.fn = lambda: {(p,): s for p, s in startup.phases.items()}
+		startup.lap('workers')
+		logger.info(f"startup: {startup.report()}")
+		if config.WARMUP:
+			tg.start_soon(warmup, app)
 
 		yield
 
-		print("Application shutting down...")
+		logger.info("Application shutting down...")
 		app.state.should_exit = True
 		await app.state.rebuild_queue.put(None)
 		await app.state.chunk_queue.put((None, None))
 		await anyio.sleep(0.5)
-		await app.state.db_conn.commit()
-		await app.state.db_conn.close()
-		print("databse closed")
+		await model.NotebookVectorStore.saveUsage(app.state.db_conn)
+		await app.state.write_queue.close()
+		await app.state.db_pool.close()
+		logger.info("databse closed")
 		tg.cancel_scope.cancel()
 
 
@@ -98,8 +176,9 @@ async def get_note(request):
 	except:
 		utils._error_json_resp(400, "invalid parameters")
 
-	note = await model.Note.db_load(request.app.state.db_conn, notebookid, noteid)
-	return utils._json_resp(200, "okay", content=dataclasses.asdict(note))
+	async with request.app.state.db_pool.reader() as db_conn:
+		note = await model.Note.db_load(db_conn, notebookid, noteid)
+	return utils._etag_json_resp(request, 200, "okay", content=dataclasses.asdict(note))
 
 
 async def delete_note(request):
@@ -115,11 +194,14 @@ async def delete_note(request):
 
 	# remove from database
 	await model.Note.db_delete(request.app.state.db_conn, notebookid, noteid)
+	await request.app.state.db_conn.commit()
+	model.forget_note_count(notebookid)
 
 	# remove from vector search index
-	vs = await model.NotebookVectorStore.getVectorStore(notebookid, request.app.state.db_conn)
-	vs.remove(noteid)
-	await model.NotebookVectorStore.saveDB(request.app.state.db_conn, vs)
+	async with model.NotebookVectorStore.hold(notebookid, request.app.state.db_conn) as vs:
+		vs.remove(noteid)
+	cache.results.bump(notebookid)
+	await request.app.state.write_queue.submit(notebookid=notebookid)
 
 	return utils._json_resp(200, "okay")
 
@@ -153,6 +235,8 @@ async def update_note(request):
 
 	# update to database
 	await model.Note.db_update(request.app.state.db_conn, post_params.notebookid, post_params.noteid, post_params.title, post_params.textcontent)
+	await request.app.state.db_conn.commit()
+	cache.results.bump(notebookid)
 
 	return utils._json_resp(200, "okay")
 
@@ -174,6 +258,9 @@ async def create_note(request):
 
 	# update to database
 	noteid = await model.Note.db_insert(request.app.state.db_conn, notebookid, post_params.title, post_params.textcontent)
+	await request.app.state.db_conn.commit()
+	model.forget_note_count(notebookid)
+	cache.results.bump(notebookid)
 
 	return utils._json_resp(200, "okay", content={
 		'notebookid': notebookid,
@@ -209,11 +296,53 @@ async def get_bookshelf(request):
 
 
 
+@utils.login_required
+async def search_bookshelf(request):
+	"""
+	Search across all notebooks owned by a user
+	"""
+	username = request.path_params['username']
+	raw_query_params = request.query_params._dict
+
+	# validate parameters
+	class Params(pydantic.BaseModel):
+		kw: str = pydantic.Field(min_length=1, description="search text")
+		k: typing.Optional[int] = pydantic.Field(10, gt=0, le=100, description="result size")
+		title: typing.Optional[bool] = pydantic.Field(True, description="search title")
+		fts: typing.Optional[bool] = pydantic.Field(True, description="include fts result")
+		fusion: typing.Optional[typing.Literal[tuple(ranking.FUSIONS)]] = pydantic.Field(config.RANK_FUSION, description="rank fusion strategy")
+		budget: typing.Optional[float] = pydantic.Field(config.SEARCH_FEDERATED_BUDGET, gt=0, le=60, description="latency budget in seconds")
+		ss: typing.Optional[int] = pydantic.Field(0, ge=0, le=1024, description="match snippet window, 0 to return full content")
+		hr: typing.Optional[bool] = pydantic.Field(False, description="high recall, search every inverted list however busy the index is")
+	try:
+		assert request.user.username == username
+		query_params = Params(**raw_query_params)
+	except pydantic.ValidationError as e:
+		return utils._error_json_resp(400, "invalid parameters", content={"error": e.errors()})
+	except:
+		return utils._error_json_resp(400, "invalid parameters")
+
+	notebooks = await model.Notebook.fetchUserNotebooks(request, request.user.uid)
+	notebookids = [nb.notebookid for nb in notebooks]
+	cache_key = cache.results.key('federated', notebookids, query_params.model_dump())
+	result = cache.results.get(cache_key)
+	if result is None:
+		result = await search.federated_search(request, notebookids, query_params.kw,
+			k=query_params.k, search_title=query_params.title, search_fts=query_params.fts,
+			fusion=query_params.fusion, budget=query_params.budget, snippet_size=query_params.ss, high_recall=query_params.hr)
+		# only complete results are cached, a reduced one would be served past the load that caused it
+		if not result['degraded'] and not result['incomplete'] and not result['degraded_notebooks']:
+			cache.results.put(cache_key, result)
+	return utils._json_resp(200, "okay", content=result)
+
+
+
 
 @utils.login_required
 async def get_notebook(request):
 	"""
-	Get notebook table's rows at a certain page
+	Get notebook table's rows at a certain page,
+	or after a cursor returned by a previous page
 	"""
 	notebookid = request.path_params['notebookid']
 	raw_query_params = request.query_params._dict
@@ -221,7 +350,9 @@ async def get_notebook(request):
 	# validate parameters
 	class Params(pydantic.BaseModel):
 		page: typing.Optional[int] = pydantic.Field(1, ge=1)
-		pagesize: typing.Optional[int] = pydantic.Field(50)
+		pagesize: typing.Optional[int] = pydantic.Field(50, gt=0, le=500)
+		cursor: typing.Optional[str] = pydantic.Field(None, pattern=r'^\d+:\d+$', description="'lastedit:noteid' of the last note on previous page")
+		excerpt: typing.Optional[int] = pydantic.Field(0, ge=0, description="return only this many chars of content, 0 for full content")
 	try:
 		assert notebookid!=0
 		query_params = Params(**raw_query_params)
@@ -231,24 +362,32 @@ async def get_notebook(request):
 		return utils._error_json_resp(400, "invalid parameters")
 
 	# query database
-	offset = (query_params.page - 1) * query_params.pagesize
 	tablename = "notebook_"+str(notebookid)
-	cursor = await request.app.state.db_conn.cursor()
-	await cursor.execute(f'''SELECT COUNT(*) FROM {tablename};''')
-	total_n = await cursor.fetchone()
-	total_n = total_n[0]
-	await cursor.execute(f'''
-		SELECT
-			CAST(docid AS TEXT), title, content,
-			CAST(strftime('%s', lastedit) AS INTEGER), meta
-		FROM {tablename}
-		ORDER BY lastedit DESC
-		LIMIT {query_params.pagesize} OFFSET {offset};
-	''')
-	rows = await cursor.fetchall()
-	await cursor.close()
+	format_content = f"substr(content, 1, {query_params.excerpt})" if query_params.excerpt>0 else "content"
+	if query_params.cursor:
+		# keyset pagination, seeks straight into the (lastedit, docid) index
+		cursor_lastedit, cursor_docid = [int(v) for v in query_params.cursor.split(':')]
+		where = "WHERE (lastedit, docid) < (datetime(?, 'unixepoch'), ?)"
+		params = (cursor_lastedit, cursor_docid, query_params.pagesize)
+	else:
+		where = ""
+		params = (query_params.pagesize, (query_params.page - 1) * query_params.pagesize)
+	async with request.app.state.db_pool.reader() as db_conn:
+		total_n = await model.db_count_notes(db_conn, notebookid)
+		cursor = await db_conn.cursor()
+		await cursor.execute(f'''
+			SELECT
+				CAST(docid AS TEXT), title, {format_content},
+				CAST(strftime('%s', lastedit) AS INTEGER), meta
+			FROM {tablename}
+			{where}
+			ORDER BY lastedit DESC, docid DESC
+			LIMIT ? {"" if query_params.cursor else "OFFSET ?"};
+		''', params)
+		rows = await cursor.fetchall()
+		await cursor.close()
 	rows_size = len(rows)
-	print(f"fetched {rows_size} rows from table#{notebookid}")
+	logger.debug(f"fetched {rows_size} rows from table#{notebookid}")
 
 	notebook = {
 		'notebookid': notebookid,
@@ -257,6 +396,7 @@ async def get_notebook(request):
 		'page_size': query_params.pagesize,
 		'page_n': rows_size,
 		'total_n': total_n,
+		'next_cursor': f"{rows[-1][3]}:{rows[-1][0]}" if rows_size==query_params.pagesize else None,
 		'notes': [{
 			'notebookid': notebookid,
 			'noteid': int(r[0]),
@@ -265,7 +405,7 @@ async def get_notebook(request):
 			'lastedit': r[3],
 		} for r in rows],
 	}
-	return utils._json_resp(200, "okay", content=notebook)
+	return utils._etag_json_resp(request, 200, "okay", content=notebook)
 
 
 async def delete_notebook(request):
@@ -287,7 +427,11 @@ async def delete_notebook(request):
 		DROP TABLE IF EXISTS {tablename};
 	''')
 	await cursor.close()
-	print("removed table#%s" % tablename)
+	await model.Chunks.delete(request.app.state.db_conn, notebookid)
+	await request.app.state.db_conn.commit()
+	model.forget_note_count(notebookid)
+	cache.results.bump(notebookid)
+	logger.info("removed table#%s", tablename)
 
 	return utils._json_resp(200, "okay")
 
@@ -305,6 +449,7 @@ async def quicksearch_notebook(request):
 		k: typing.Optional[int] = pydantic.Field(5, gt=0, le=500, description="result size")
 		ss: typing.Optional[int] = pydantic.Field(48, ge=-1, le=256, description="match snippet size")
 		q: typing.Optional[bool] = pydantic.Field(True, description="result is quoted")
+		prefix: typing.Optional[bool] = pydantic.Field(False, description="type-ahead mode, prefix match returning titles only")
 	try:
 		assert notebookid!=0
 		query_params = Params(**raw_query_params)
@@ -313,7 +458,16 @@ async def quicksearch_notebook(request):
 	except:
 		utils._error_json_resp(400, "invalid parameters")
 
-	result = await search.quick_search(request, notebookid, query_params.kw.strip(), k=query_params.k, snippet_size=query_params.ss, is_quoted=query_params.q)
+	if query_params.prefix:
+		# keep trailing whitespace, it tells whether the last term is finished
+		result = await search.typeahead_search(request, notebookid, query_params.kw.lstrip(), k=query_params.k)
+		return utils._json_resp(200, "okay", content=result)
+
+	cache_key = cache.results.key('fts', [notebookid], query_params.model_dump())
+	result = cache.results.get(cache_key)
+	if result is None:
+		result = await search.quick_search(request, notebookid, query_params.kw.strip(), k=query_params.k, snippet_size=query_params.ss, is_quoted=query_params.q)
+		cache.results.put(cache_key, result)
 
 	return utils._json_resp(200, "okay", content=result)
 
@@ -333,20 +487,16 @@ async def chunck_note(request):
 	note = await model.Note.db_load(request.app.state.db_conn, notebookid, noteid)
 	rechunk = False
 	if not note.dirty:
-		b_emb, = await note.db_fetch_cols(request.app.state.db_conn, ['title_emb'])
-		if not b_emb:
+		emb = await model.Chunks.fetch_title_emb(request.app.state.db_conn, notebookid, noteid)
+		if emb is None or len(emb)!=config.LLM_EMBED_D:
 			rechunk = True
-		else:
-			emb = pickle.loads(b_emb)
-			if len(emb)!=config.LLM_EMBED_D:
-				rechunk = True
 	else:
 		rechunk = True
 	if rechunk:
 		chunks, chunk_spans, chunk_embs, title_emb = await note.make_chunks()
 		await note.db_store_chunks(request.app.state.db_conn, title_emb, chunk_embs, chunk_spans)
 		await note.db_store_cols(request.app.state.db_conn, ['dirty'], [False])
-		request.app.state.db_conn.commit()
+		await request.app.state.db_conn.commit()
 
 	return utils._json_resp(200, "okay", content=dataclasses.asdict(note))
 
@@ -362,6 +512,13 @@ async def vector_search(request):
 		k: typing.Optional[int] = pydantic.Field(10, gt=0, le=100, description="result size")
 		title: typing.Optional[bool] = pydantic.Field(True, description="search title")
 		fts: typing.Optional[bool] = pydantic.Field(True, description="include fts result")
+		fusion: typing.Optional[typing.Literal[tuple(ranking.FUSIONS)]] = pydantic.Field(config.RANK_FUSION, description="rank fusion strategy")
+		wf: typing.Optional[float] = pydantic.Field(config.RANK_WEIGHTS['fts'], ge=0, description="fts result weight")
+		wc: typing.Optional[float] = pydantic.Field(config.RANK_WEIGHTS['content'], ge=0, description="content semantic result weight")
+		wt: typing.Optional[float] = pydantic.Field(config.RANK_WEIGHTS['title'], ge=0, description="title semantic result weight")
+		ss: typing.Optional[int] = pydantic.Field(0, ge=0, le=1024, description="match snippet window, 0 to return full content")
+		hr: typing.Optional[bool] = pydantic.Field(False, description="high recall, search every inverted list however busy the index is")
+		debug: typing.Optional[typing.Literal['timings']] = pydantic.Field(None, description="return stage timings")
 	try:
 		assert notebookid!=0
 		query_params = Params(**raw_query_params)
@@ -370,13 +527,218 @@ async def vector_search(request):
 	except:
 		utils._error_json_resp(400, "invalid parameters")
 
-	result = await search.vsearch(request, notebookid, query_params.kw, k=query_params.k, search_title=query_params.title, search_fts=query_params.fts)
-	if not result:
+	cache_key = cache.results.key('vsearch', [notebookid], query_params.model_dump(exclude={'debug'}))
+	# timed requests always run the search
+	result = cache.results.get(cache_key) if not query_params.debug else None
+	if result is None:
+		weights = {'fts': query_params.wf, 'content': query_params.wc, 'title': query_params.wt}
+		result = await search.vsearch(request, notebookid, query_params.kw, k=query_params.k, search_title=query_params.title, search_fts=query_params.fts, fusion=query_params.fusion, weights=weights, snippet_size=query_params.ss, high_recall=query_params.hr)
+		if not result:
+			return utils._error_json_resp(400, "llm server down")
+		if not result['degraded']:
+			# results missing a timed out leg are not worth repeating
+			cache.results.put(cache_key, result)
+	if query_params.debug == 'timings':
+		result = {**result, 'timings': tracing.timings()}
+	return utils._json_resp(200, "okay", content=result)
+
+
+@utils.login_required
+async def vector_search_batch(request):
+	"""
+	Semantic search for many queries in one request, over notebooks of the user
+	"""
+	payload = await request.json()
+
+	# validate post body
+	class PostParams(pydantic.BaseModel):
+		kws: typing.List[str] = pydantic.Field(min_length=1, max_length=config.SEARCH_BATCH_MAX, description="search texts")
+		notebookids: typing.List[int] = pydantic.Field(min_length=1, description="one notebook for all texts, or one per text")
+		k: typing.Optional[int] = pydantic.Field(10, gt=0, le=100, description="result size")
+		title: typing.Optional[bool] = pydantic.Field(True, description="search title")
+		fusion: typing.Optional[typing.Literal[tuple(ranking.FUSIONS)]] = pydantic.Field(config.RANK_FUSION, description="rank fusion strategy")
+		weights: typing.Optional[typing.Dict[typing.Literal[ranking.LEGS], pydantic.NonNegativeFloat]] = pydantic.Field(config.RANK_WEIGHTS, description="result weight per leg, unset legs keep their default")
+		hr: typing.Optional[bool] = pydantic.Field(False, description="high recall, search every inverted list however busy the index is")
+	try:
+		post_params = PostParams(**payload)
+		assert all(kw.strip() != "" for kw in post_params.kws)
+		assert all(nbid > 0 for nbid in post_params.notebookids)
+		assert len(post_params.notebookids) in (1, len(post_params.kws))
+	except (pydantic.ValidationError, AssertionError) as e:
+		return utils._error_json_resp(400, "invalid parameters", content={"error": str(e)})
+	# before any vectorstore is loaded, or created for a notebook that does not exist
+	owned = {nb.notebookid for nb in await model.Notebook.fetchUserNotebooks(request, request.user.uid)}
+	unknown = sorted(set(post_params.notebookids) - owned)
+	if unknown:
+		return utils._error_json_resp(404, "notebook not found", content={'notebookids': unknown})
+
+	notebookids = post_params.notebookids
+	if len(notebookids)==1:
+		notebookids = notebookids * len(post_params.kws)
+	weights = {**config.RANK_WEIGHTS, **post_params.weights}
+	result = await search.vsearch_batch(request, post_params.kws, notebookids, k=post_params.k, search_title=post_params.title,
+		fusion=post_params.fusion, weights=weights, high_recall=post_params.hr)
+	if result is None:
 		return utils._error_json_resp(400, "llm server down")
 	return utils._json_resp(200, "okay", content=result)
 
 
 
+@utils.login_required
+async def import_notes(request):
+	"""
+	Bulk import notes from a NDJSON or zip stream.
+	Each record is {"title": ..., "textcontent": ..., "lastedit": unix time, "meta": {...}}, as exported.
+	Re-send the same stream under the same import id to resume an interrupted import.
+	"""
+	notebookid = request.path_params['notebookid']
+	raw_query_params = request.query_params._dict
+
+	# validate parameters
+	class Params(pydantic.BaseModel):
+		id: typing.Optional[str] = pydantic.Field(None, min_length=1, max_length=64, pattern=r'^[\w.-]+$', description="import id, to resume an import")
+		format: typing.Optional[typing.Literal['ndjson', 'zip']] = pydantic.Field(None, description="defaults to zip for application/zip bodies, else ndjson")
+	try:
+		assert notebookid != 0
+		query_params = Params(**raw_query_params)
+		assert await model.db_table_exists(request.app.state.db_conn, f"notebook_{notebookid}")
+		assert notebookid in [nb.notebookid for nb in await model.Notebook.fetchUserNotebooks(request, request.user.uid)]
+	except pydantic.ValidationError as e:
+		return utils._error_json_resp(400, "invalid parameters", content={"error": e.errors()})
+	except:
+		return utils._error_json_resp(400, "invalid parameters")
+
+	import_id = query_params.id or uuid.uuid4().hex
+	if import_id in importer.running_imports:
+		return utils._error_json_resp(400, "import already running", content={'import_id': import_id})
+	job = await model.Imports.start(request.app.state.db_conn, import_id, notebookid)
+	await request.app.state.db_conn.commit()
+	if job['notebookid'] != notebookid:
+		return utils._error_json_resp(400, "import id used by another notebook", content={'import_id': import_id})
+	if job['status'] == 'done':
+		return utils._json_resp(200, "okay", content=job)
+
+	fmt = query_params.format or ('zip' if request.headers.get('content-type', '').startswith('application/zip') else 'ndjson')
+	records = importer.iter_zip(request.stream()) if fmt == 'zip' else importer.iter_ndjson(request.stream())
+	try:
+		job = await importer.ingest(request.app, job, records)
+	except zipfile.BadZipFile as e:
+		return utils._error_json_resp(400, "invalid zip archive", content={'import_id': import_id, 'error': str(e)})
+	return utils._json_resp(200, "okay", content=job)
+
+
+@utils.login_required
+async def get_import(request):
+	"""
+	Progress of a bulk import
+	"""
+	notebookid = request.path_params['notebookid']
+	import_id = request.path_params['import_id']
+	if notebookid not in [nb.notebookid for nb in await model.Notebook.fetchUserNotebooks(request, request.user.uid)]:
+		return utils._error_json_resp(400, "import not found")
+	async with request.app.state.db_pool.reader() as db_conn:
+		job = await model.Imports.load(db_conn, import_id)
+	if not job or job['notebookid'] != notebookid:
+		return utils._error_json_resp(400, "import not found")
+	n_chunked, n_chunk_failed = importer.chunk_progress.get(import_id, (job['n_chunked'], 0))
+	job['n_chunked'] = n_chunked
+	job['n_chunk_failed'] = n_chunk_failed
+	job['n_chunk_pending'] = request.app.state.importing.get(notebookid, 0)
+	return utils._json_resp(200, "okay", content=job)
+
+
+@utils.admin_required
+async def profile_backend(request):
+	"""
+	Sample stacks of the running process for a while,
+	return them in collapsed stack format for flamegraph tools
+	"""
+	raw_query_params = request.query_params._dict
+
+	# validate parameters
+	class Params(pydantic.BaseModel):
+		seconds: typing.Optional[float] = pydantic.Field(10, gt=0, le=config.PROFILE_MAX_SECONDS, description="profile duration")
+		interval_ms: typing.Optional[float] = pydantic.Field(config.PROFILE_INTERVAL*1000, ge=1, le=1000, description="sampling interval")
+		threads: typing.Optional[typing.Literal['loop', 'all']] = pydantic.Field('loop', description="event loop thread only, or all threads")
+	try:
+		query_params = Params(**raw_query_params)
+	except pydantic.ValidationError as e:
+		return utils._error_json_resp(400, "invalid parameters", content={"error": e.errors()})
+
+	if not profiler.profile_lock.acquire(blocking=False):
+		return utils._error_json_resp(409, "a profile is already running")
+	try:
+		thread_ids = {threading.get_ident()} if query_params.threads == 'loop' else None
+		stacks, rounds = await anyio.to_thread.run_sync(profiler.sample, query_params.seconds, query_params.interval_ms/1000, thread_ids)
+	finally:
+		profiler.profile_lock.release()
+	logger.info(f"profiled {rounds} rounds over {query_params.seconds}s, {len(stacks)} distinct stacks")
+	return starlette.responses.PlainTextResponse(profiler.collapsed(stacks), headers={
+		'Content-Disposition': f'attachment; filename="profile-{int(time.time())}.folded"',
+	})
+
+
+@utils.login_required
+async def export_notebook(request):
+	"""
+	Stream a snapshot of all notes in a notebook,
+	as NDJSON or, with their chunk embeddings, in binary
+	"""
+	notebookid = request.path_params['notebookid']
+	raw_query_params = request.query_params._dict
+
+	# validate parameters
+	class Params(pydantic.BaseModel):
+		format: typing.Optional[typing.Literal[tuple(exporter.ENCODERS)]] = pydantic.Field('ndjson', description="ndjson, or bin for binary")
+		chunks: typing.Optional[bool] = pydantic.Field(False, description="include chunk spans, and embeddings in binary format")
+	try:
+		assert notebookid != 0
+		query_params = Params(**raw_query_params)
+		assert await model.db_table_exists(request.app.state.db_conn, f"notebook_{notebookid}")
+		assert notebookid in [nb.notebookid for nb in await model.Notebook.fetchUserNotebooks(request, request.user.uid)]
+	except pydantic.ValidationError as e:
+		return utils._error_json_resp(400, "invalid parameters", content={"error": e.errors()})
+	except:
+		return utils._error_json_resp(400, "invalid parameters")
+
+	media_type, ext = ('application/x-ndjson', 'ndjson') if query_params.format == 'ndjson' else ('application/octet-stream', 'nbex')
+	return starlette.responses.StreamingResponse(
+		exporter.iter_export(notebookid, fmt=query_params.format, with_chunks=query_params.chunks),
+		media_type=media_type,
+		headers={'Content-Disposition': f'attachment; filename="notebook_{notebookid}.{ext}"'})
+
+
+async def get_write_stats(request):
+	"""
+	Group commit statistics of the write-behind queue
+	"""
+	return utils._json_resp(200, "okay", content=request.app.state.write_queue.info())
+
+
+async def get_cache_stats(request):
+	"""
+	Search result cache size and hit rate
+	"""
+	return utils._json_resp(200, "okay", content=cache.results.info())
+
+
+async def get_fts_stats(request):
+	"""
+	Size and segment counts of every notebook's FTS index
+	"""
+	stats = {}
+	async with request.app.state.db_pool.reader() as db_conn:
+		cursor = await db_conn.execute("SELECT nbid FROM Notebooks;")
+		nbids = [nbid for nbid, in await cursor.fetchall()]
+		await cursor.close()
+		for nbid in nbids:
+			if await model.db_table_exists(db_conn, f"notebook_{nbid}_fts"):
+				stats[str(nbid)] = {
+					**await model.db_fts_stats(db_conn, f"notebook_{nbid}"),
+					**worker.fts_stats.get(nbid, {'merge_steps': 0, 'optimizes': 0, 'last_maintenance': None}),
+				}
+	return utils._json_resp(200, "okay", content=stats)
+
 
 async def check_train(request):
 	notebookid = request.path_params['notebookid']
@@ -392,12 +754,16 @@ async def check_train(request):
 login_manager_config = starlette_login.login_manager.Config(COOKIE_DURATION=datetime.timedelta(hours=1))
 login_manager = starlette_login.login_manager.LoginManager(redirect_to='/login', secret_key='secret', config=login_manager_config)
 login_manager.set_user_loader(model.User.getUserById)
-middleware = [
+middlewares = [
+	starlette.middleware.Middleware(metrics.MetricsMiddleware, histogram=metrics.http_request_seconds),
+	starlette.middleware.Middleware(tracing.TracingMiddleware),
 	starlette.middleware.Middleware(starlette.middleware.cors.CORSMiddleware,
 		allow_origins=["*", "http://192.168.1.220", "http://192.168.1.220:3000"],
 		allow_credentials=True,
 		allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
 		allow_headers=["*"]),
+	starlette.middleware.Middleware(middleware.CompressionMiddleware),
+	starlette.middleware.Middleware(middleware.PrettyJSONMiddleware),
 	starlette.middleware.Middleware(starlette.middleware.sessions.SessionMiddleware, secret_key='secret', https_only=False, max_age=None),
 	starlette.middleware.Middleware(
 		starlette_login.middleware.AuthenticationMiddleware,
@@ -413,19 +779,29 @@ routes = [
 	starlette.routing.Route("/api/logout", login.logout, methods=['GET', 'POST']),
 	starlette.routing.Route("/api/register", login.register, methods=['POST']),
 	starlette.routing.Route('/api/{username:str}/get', get_bookshelf),
+	starlette.routing.Route('/api/{username:str}/search', search_bookshelf),
 	starlette.routing.Route('/api/note/{notebookid:int}/get', get_notebook),
 	starlette.routing.Route('/api/note/{notebookid:int}/delete', delete_notebook),
+	starlette.routing.Route('/api/note/{notebookid:int}/export', export_notebook),
 	starlette.routing.Route('/api/note/{notebookid:int}/new', create_note, methods=['POST']),
+	starlette.routing.Route('/api/note/{notebookid:int}/import', import_notes, methods=['POST']),
+	starlette.routing.Route('/api/note/{notebookid:int}/import/{import_id:str}', get_import),
 	starlette.routing.Route('/api/note/{notebookid:int}/{noteid:int}/get', get_note),
 	starlette.routing.Route('/api/note/{notebookid:int}/{noteid:int}/delete', delete_note),
 	starlette.routing.Route('/api/note/{notebookid:int}/{noteid:int}/update', update_note, methods=['POST']),
 	starlette.routing.Route('/api/note/{notebookid:int}/search', quicksearch_notebook),
 	starlette.routing.Route('/api/note/{notebookid:int}/{noteid:int}/chunk', chunck_note),
 	starlette.routing.Route('/api/note/{notebookid:int}/vsearch', vector_search),
+	starlette.routing.Route('/api/note/vsearch', vector_search_batch, methods=['POST']),
 	starlette.routing.Route('/api/note/{notebookid:int}/{noteid:int}/check', check_train),
+	starlette.routing.Route('/api/stats/writes', get_write_stats),
+	starlette.routing.Route('/api/stats/fts', get_fts_stats),
+	starlette.routing.Route('/api/stats/cache', get_cache_stats),
+	starlette.routing.Route('/api/admin/profile', profile_backend),
+	starlette.routing.Route('/metrics', metrics.metrics_endpoint),
 	starlette.routing.Mount('/static', starlette.staticfiles.StaticFiles(directory="static")),
 ]
-app = starlette.applications.Starlette(routes=routes, middleware=middleware, lifespan=lifespan_event)
+app = starlette.applications.Starlette(routes=routes, middleware=middlewares, lifespan=lifespan_event)
 app.state.login_manager = login_manager
 app.state.config = config
 
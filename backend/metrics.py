@@ -0,0 +1,25 @@
+import os
+import sys
+
+# the telemetry package at the repository root is shared with the llm server
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if ROOT_DIR not in sys.path:
+	sys.path.append(ROOT_DIR)
+
+from telemetry.metrics import Counter, Gauge, Histogram, MetricsMiddleware, metrics_endpoint, render, http_request_seconds, startup_seconds
+
+
+embed_request_seconds = Histogram('embed_request_duration_seconds', "Round trip time of embedding requests to the LLM server", labels=('outcome',))
+embed_texts = Counter('embed_texts_total', "Texts sent to the LLM server for embedding")
+faiss_seconds = Histogram('faiss_operation_duration_seconds', "Time spent in faiss index operations", labels=('op',))
+sqlite_query_seconds = Histogram('sqlite_query_duration_seconds', "Time spent in hot path SQLite queries", labels=('query',))
+sqlite_reader_wait_seconds = Histogram('sqlite_reader_wait_seconds', "Time spent waiting for a free pool reader connection")
+group_commit_seconds = Histogram('group_commit_duration_seconds', "Duration of write-behind group commits")
+rebuild_seconds = Histogram('vectorstore_rebuild_duration_seconds', "Duration of vectorstore rebuilds", buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600))
+vector_searches = Counter('vector_searches_total', "Vector searches by nprobe mode", labels=('mode',))
+vectorstore_cache = Counter('vectorstore_cache_total', "Vectorstore cache lookups and evictions", labels=('result',))
+chunked_notes = Counter('chunked_notes_total', "Notes chunked by background workers", labels=('outcome',))
+queue_depth = Gauge('queue_depth', "Items waiting in background work queues", labels=('queue',))
+result_cache = Gauge('result_cache', "Search result cache counters and size", labels=('stat',))
+loop_lag_seconds = Histogram('event_loop_lag_seconds', "Delay of event loop heartbeats past their schedule")
+loop_stalls = Counter('event_loop_stalls_total', "Event loop blocks longer than LOOP_LAG_THRESHOLD")
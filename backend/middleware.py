@@ -0,0 +1,103 @@
+import gzip
+
+import starlette.datastructures
+
+import config
+import utils
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+
+class PrettyJSONMiddleware():
+	"""
+	Pretty print JSON responses of requests with ?pretty=1
+	"""
+
+	def __init__(self, app):
+		self.app = app
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] != 'http':
+			return await self.app(scope, receive, send)
+
+		query_params = starlette.datastructures.QueryParams(scope.get('query_string', b''))
+		token = utils.pretty_json.set(query_params.get('pretty', '0') not in ('', '0', 'false'))
+		try:
+			await self.app(scope, receive, send)
+		finally:
+			utils.pretty_json.reset(token)
+
+
+class CompressionMiddleware():
+	"""
+	Compress response bodies with brotli (if installed) or gzip,
+	depending on what the client accepts.
+	Small responses, streamed responses and non-text content are passed through.
+	"""
+	compressible_types = ('text/', 'application/json', 'application/javascript', 'application/x-ndjson', 'image/svg+xml')
+
+	def __init__(self, app, minimum_size=config.COMPRESS_MIN_SIZE, gzip_level=config.COMPRESS_GZIP_LEVEL, brotli_quality=config.COMPRESS_BROTLI_QUALITY):
+		self.app = app
+		self.minimum_size = minimum_size
+		self.gzip_level = gzip_level
+		self.brotli_quality = brotli_quality
+
+	def _select_encoding(self, accept_encoding):
+		accepted = set()
+		for token in accept_encoding.split(','):
+			name, _, q = token.strip().partition(';')
+			if q.strip() in ('q=0', 'q=0.0'):
+				continue
+			accepted.add(name.strip().lower())
+		if brotli and 'br' in accepted:
+			return 'br'
+		if 'gzip' in accepted:
+			return 'gzip'
+		return None
+
+	def _compress(self, encoding, body):
+		if encoding == 'br':
+			return brotli.compress(body, quality=self.brotli_quality)
+		return gzip.compress(body, compresslevel=self.gzip_level)
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] != 'http':
+			return await self.app(scope, receive, send)
+
+		request_headers = starlette.datastructures.Headers(scope=scope)
+		encoding = self._select_encoding(request_headers.get('accept-encoding', ''))
+		if not encoding:
+			return await self.app(scope, receive, send)
+
+		start_message = None
+
+		async def _send(message):
+			nonlocal start_message
+			if message['type'] == 'http.response.start':
+				# hold the headers back until we see the first body chunk
+				start_message = message
+				return
+			if message['type'] != 'http.response.body' or start_message is None:
+				return await send(message)
+
+			headers = starlette.datastructures.MutableHeaders(raw=start_message['headers'])
+			body = message.get('body', b'')
+			compress = not message.get('more_body', False) \
+				and len(body) >= self.minimum_size \
+				and 'content-encoding' not in headers \
+				and headers.get('content-type', '').startswith(self.compressible_types)
+			if compress:
+				body = self._compress(encoding, body)
+				headers['Content-Encoding'] = encoding
+				headers['Content-Length'] = str(len(body))
+				headers.add_vary_header('Accept-Encoding')
+				message = {'type': 'http.response.body', 'body': body}
+
+			await send(start_message)
+			start_message = None
+			await send(message)
+
+		await self.app(scope, receive, _send)
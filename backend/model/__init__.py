@@ -1,7 +1,10 @@
+import logging
+import re
 import json
+import asyncio
 import datetime
 import dataclasses
-import pickle
+import contextlib
 import os
 
 import sqlite3
@@ -9,31 +12,153 @@ import aiosqlite
 
 import nlp
 import config
+import metrics
 
 from model.user import User
 from model.vectorstore import NotebookVectorStore
 from model.notebook import Notebook
+from model.chunk import Chunks
+from model.imports import Imports
+from model.writeback import WriteBehindQueue
 
+logger = logging.getLogger(__name__)
 
 
 
-async def db_init(db_path):
-	first_run = True if not os.path.exists(db_path) else False
 
+async def db_connect(db_path, readonly=False):
+	"""
+	Open a connection with the FTS tokenizer loaded and pragmas tuned
+	"""
 	aiosqlite.register_converter('DATETIME', sqlite3.converters['TIMESTAMP'])
-	conn = await aiosqlite.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+	conn = await aiosqlite.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=config.SQLITE_STATEMENT_CACHE)
 	await conn.enable_load_extension(True)
 	await conn.load_extension(config.SQLITE_TOKENIZER)
-	print(".libsimple loaded")
+	for name, value in config.SQLITE_PRAGMAS.items():
+		await conn.execute(f"PRAGMA {name} = {value};")
+	if readonly:
+		await conn.execute("PRAGMA query_only = 1;")
+	return conn
+
+
+async def db_init(db_path):
+	first_run = True if not os.path.exists(db_path) else False
+
+	conn = await db_connect(db_path)
+	logger.info(".libsimple loaded")
 
 	if first_run:
-		print("first run")
+		logger.info("first run")
 		await User.initDB(conn)
 		await Notebook.initDB(conn)
 		await db_init_table_fts(conn, "notebook_1", fts_tokenizer='simple')
+
+	# make sure every notebook table has its paging index and keeps its chunks in the chunks table
+	await Chunks.initDB(conn)
+	cursor = await conn.execute("SELECT nbid FROM Notebooks;")
+	for nbid, in await cursor.fetchall():
+		if await db_init_table_index(conn, f"notebook_{nbid}"):
+			await Chunks.migrate(conn, nbid)
+		if await db_table_exists(conn, f"notebook_{nbid}_fts"):
+			await db_upgrade_table_fts(conn, f"notebook_{nbid}")
+			await db_config_table_fts(conn, f"notebook_{nbid}")
+	await cursor.close()
+
+	# imports cut short by a restart left their notebook's FTS index unsynced
+	await Imports.initDB(conn)
+	for nbid in await Imports.interrupted(conn):
+		if await db_table_exists(conn, f"notebook_{nbid}_fts"):
+			await db_resume_table_fts(conn, f"notebook_{nbid}")
+	await conn.commit()
 	return conn
 
 
+class DBPool():
+	"""
+	One writer connection plus a fixed set of reader connections.
+	In WAL mode readers neither block the writer nor each other,
+	so reads run on several threads at once instead of queueing
+	behind the writer's.
+	Readers only see committed data.
+	"""
+
+	def __init__(self, writer, readers):
+		self.writer = writer
+		self.readers = readers
+		self._idle_readers = asyncio.Queue()
+		for conn in readers:
+			self._idle_readers.put_nowait(conn)
+
+	@classmethod
+	async def open(cls, db_path, n_readers=config.SQLITE_READERS):
+		writer = await db_init(db_path)
+		readers = [await db_connect(db_path, readonly=True) for _ in range(n_readers)]
+		logger.info(f"database pool: 1 writer, {n_readers} readers")
+		return cls(writer, readers)
+
+	@contextlib.asynccontextmanager
+	async def reader(self):
+		"""
+		Borrow a reader connection
+		"""
+		with metrics.sqlite_reader_wait_seconds.time():
+			conn = await self._idle_readers.get()
+		try:
+			yield conn
+		finally:
+			self._idle_readers.put_nowait(conn)
+
+	async def close(self):
+		await self.writer.commit()
+		await self.writer.close()
+		for conn in self.readers:
+			await conn.close()
+
+
+async def db_init_table_index(conn, tablename):
+	"""
+	Index notes by (lastedit, docid) for keyset pagination
+	"""
+	cursor = await conn.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name=?;", (tablename,))
+	table_exists = bool((await cursor.fetchone())[0])
+	if table_exists:
+		await cursor.execute(f'''
+			CREATE INDEX IF NOT EXISTS {tablename}_lastedit ON {tablename}(lastedit, docid);
+		''')
+	await cursor.close()
+	return table_exists
+
+
+# cached number of notes in each notebook, dropped by forget_note_count() once notes are added or removed
+note_counts = {}
+note_counts_gen = {}  # notebookid --> times its count was dropped
+
+
+def forget_note_count(notebookid):
+	"""
+	Drop a notebook's cached note count, call after committing inserts or deletes
+	"""
+	notebookid = int(notebookid)
+	note_counts.pop(notebookid, None)
+	note_counts_gen[notebookid] = note_counts_gen.get(notebookid, 0) + 1
+
+
+async def db_count_notes(conn, notebookid):
+	"""
+	Return number of notes in a notebook, counting the table only when not cached
+	"""
+	if notebookid in note_counts:
+		return note_counts[notebookid]
+	gen = note_counts_gen.get(notebookid, 0)
+	cursor = await conn.execute(f"SELECT COUNT(*) FROM notebook_{notebookid};")
+	n = (await cursor.fetchone())[0]
+	await cursor.close()
+	# a count read from a snapshot older than a commit that landed meanwhile is not kept
+	if note_counts_gen.get(notebookid, 0) == gen:
+		note_counts[notebookid] = n
+	return n
+
+
 async def db_rebuild_table_fts(conn, tablename):
 	cursor = await conn.cursor()
 	tablename_fts = tablename + '_fts'
@@ -41,22 +166,9 @@ async def db_rebuild_table_fts(conn, tablename):
 	await cursor.close()
 
 
-async def db_init_table_fts(conn, tablename, fts_tokenizer=''):
-	cursor = await conn.cursor()
+def _fts_triggers_sql(tablename):
 	tablename_fts = tablename + '_fts'
-	if fts_tokenizer:
-		fts_tokenizer = f"tokenize = '{fts_tokenizer}',"
-
-	# build FTS index on a table
-	print(f'init fts index for table "{tablename}"')
-	await cursor.executescript(f'''
-		DROP TABLE IF EXISTS {tablename_fts};
-		CREATE VIRTUAL TABLE {tablename_fts} USING fts5(
-			title,
-			content,
-			{fts_tokenizer}
-		content='{tablename}', content_rowid='docid');
-
+	return f'''
 		-- hooks to sync FTS index with its content table
 		DROP TRIGGER IF EXISTS {tablename_fts}_ai;
 		DROP TRIGGER IF EXISTS {tablename_fts}_ad;
@@ -71,12 +183,183 @@ async def db_init_table_fts(conn, tablename, fts_tokenizer=''):
 			INSERT INTO {tablename_fts}({tablename_fts}, rowid, title, content) VALUES('delete', old.docid, old.title, old.content);
 			INSERT INTO {tablename_fts}(rowid, title, content) VALUES (new.docid, new.title, new.content);
 		END;
+	'''
+
+
+async def db_init_table_fts(conn, tablename, fts_tokenizer='', fts_prefix=config.FTS_PREFIX):
+	cursor = await conn.cursor()
+	tablename_fts = tablename + '_fts'
+	if fts_tokenizer:
+		fts_tokenizer = f"tokenize = '{fts_tokenizer}',"
+	if fts_prefix:
+		fts_tokenizer += f" prefix = '{fts_prefix}',"
+
+	# build FTS index on a table
+	logger.info(f'init fts index for table "{tablename}"')
+	await cursor.executescript(f'''
+		DROP TABLE IF EXISTS {tablename_fts};
+		CREATE VIRTUAL TABLE {tablename_fts} USING fts5(
+			title,
+			content,
+			{fts_tokenizer}
+		content='{tablename}', content_rowid='docid');
+
+		{_fts_triggers_sql(tablename)}
 
 		-- build FTS index from its content table
 		INSERT INTO {tablename_fts}(rowid, title, content)
 			SELECT docid, title, content FROM {tablename};
 	''')
 	await cursor.close()
+	await db_config_table_fts(conn, tablename)
+
+
+async def db_upgrade_table_fts(conn, tablename):
+	"""
+	Recreate an FTS index built without the configured prefix indexes,
+	keeping its tokenizer
+	"""
+	cursor = await conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?;", (tablename + '_fts',))
+	sql, = await cursor.fetchone()
+	await cursor.close()
+	if not config.FTS_PREFIX or re.search(r"prefix\s*=", sql):
+		return
+	m = re.search(r"tokenize\s*=\s*'([^']*)'", sql)
+	logger.info(f'add prefix indexes to fts index of table "{tablename}"')
+	await db_init_table_fts(conn, tablename, fts_tokenizer=m.group(1) if m else '')
+
+
+async def db_config_table_fts(conn, tablename):
+	"""
+	Set how eagerly FTS5 merges index segments on writes,
+	settings persist in the index's own config table
+	"""
+	tablename_fts = tablename + '_fts'
+	for name, value in (('automerge', config.FTS_AUTOMERGE), ('crisismerge', config.FTS_CRISISMERGE), ('usermerge', config.FTS_USERMERGE)):
+		await conn.execute(f"INSERT INTO {tablename_fts}({tablename_fts}, rank) VALUES('{name}', {value});")
+
+
+def _fts_varint(buf, i):
+	# sqlite varint, big endian 7 bit groups, a 9th byte holds a full 8 bits
+	v = 0
+	for n in range(8):
+		b = buf[i + n]
+		v = (v << 7) | (b & 0x7f)
+		if b < 0x80:
+			return v, i + n + 1
+	return (v << 8) | buf[i + 8], i + 9
+
+
+async def db_fts_structure(conn, tablename):
+	"""
+	Decode an FTS5 index's structure record,
+	return [(n_segments, [(segid, n_pages), ...]), ...] per level, or None
+	"""
+	tablename_fts = tablename + '_fts'
+	cursor = await conn.execute(f"SELECT block FROM {tablename_fts}_data WHERE id = 10;")
+	row = await cursor.fetchone()
+	await cursor.close()
+	if not row or not row[0]:
+		return None
+
+	buf = row[0]
+	i = 4  # cookie
+	v2 = buf[i:i+4] == b'\xff\x00\x00\x01'
+	if v2:
+		i += 4
+	n_level, i = _fts_varint(buf, i)
+	n_segment, i = _fts_varint(buf, i)
+	_, i = _fts_varint(buf, i)  # write counter
+	levels = []
+	for _ in range(n_level):
+		_, i = _fts_varint(buf, i)  # segments being merged
+		n_seg, i = _fts_varint(buf, i)
+		segs = []
+		for _ in range(n_seg):
+			segid, i = _fts_varint(buf, i)
+			pgno_first, i = _fts_varint(buf, i)
+			pgno_last, i = _fts_varint(buf, i)
+			if v2:
+				for _ in range(5):  # origin range, tombstone and entry counts
+					_, i = _fts_varint(buf, i)
+			segs.append((segid, pgno_last - pgno_first + 1))
+		levels.append((n_seg, segs))
+	assert sum(n for n, _ in levels) == n_segment
+	return levels
+
+
+async def db_fts_stats(conn, tablename):
+	"""
+	Segment counts and on disk size of a table's FTS index
+	"""
+	levels = await db_fts_structure(conn, tablename)
+	cursor = await conn.execute(f"SELECT count(*), COALESCE(sum(length(block)), 0) FROM {tablename}_fts_data;")
+	n_blocks, size = await cursor.fetchone()
+	await cursor.close()
+	return {
+		'segments': sum(n for n, _ in levels) if levels else 0,
+		'levels': [n for n, _ in levels] if levels else [],
+		'pages': sum(pages for _, segs in levels for _, pages in segs) if levels else 0,
+		'blocks': n_blocks,
+		'bytes': size,
+	}
+
+
+async def db_merge_table_fts(conn, tablename, n_pages):
+	"""
+	Run one incremental merge step writing about @n_pages pages,
+	return False once there is nothing left to merge
+	"""
+	tablename_fts = tablename + '_fts'
+	changes = conn.total_changes
+	await conn.execute(f"INSERT INTO {tablename_fts}({tablename_fts}, rank) VALUES('merge', {int(n_pages)});")
+	# fts5 counts less than 2 changes for a merge step that found no work
+	return conn.total_changes - changes >= 2
+
+
+async def db_optimize_table_fts(conn, tablename):
+	"""
+	Merge all segments of a table's FTS index into one
+	"""
+	tablename_fts = tablename + '_fts'
+	await conn.execute(f"INSERT INTO {tablename_fts}({tablename_fts}) VALUES('optimize');")
+
+
+async def db_table_exists(conn, tablename):
+	cursor = await conn.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name=?;", (tablename,))
+	table_exists = bool((await cursor.fetchone())[0])
+	await cursor.close()
+	return table_exists
+
+
+async def db_suspend_table_fts(conn, tablename):
+	"""
+	Stop syncing a table's FTS index on every write, for bulk loads.
+	Return False if the table has no FTS index.
+	"""
+	tablename_fts = tablename + '_fts'
+	if not await db_table_exists(conn, tablename_fts):
+		return False
+	logger.info(f'suspend fts index sync for table "{tablename}"')
+	cursor = await conn.cursor()
+	await cursor.executescript(f'''
+		DROP TRIGGER IF EXISTS {tablename_fts}_ai;
+		DROP TRIGGER IF EXISTS {tablename_fts}_ad;
+		DROP TRIGGER IF EXISTS {tablename_fts}_au;
+	''')
+	await cursor.close()
+	return True
+
+
+async def db_resume_table_fts(conn, tablename):
+	"""
+	Restore FTS sync triggers and rebuild the index once from its content table
+	"""
+	logger.info(f'resume fts index sync for table "{tablename}"')
+	cursor = await conn.cursor()
+	await cursor.executescript(_fts_triggers_sql(tablename))
+	await cursor.close()
+	await db_rebuild_table_fts(conn, tablename)
 
 
 
@@ -92,52 +375,72 @@ class Note():
 	meta: dict
 	dirty: bool=False
 
-	async def make_chunks(self):
+	def split(self):
 		"""
-		Chunking note text
+		Split note text into sentences, CPU bound
 		"""
-		print("chunk note#%s/%s" % (self.notebookid, self.noteid))
 		nlp_model = nlp.initNLP()
 		doc = nlp_model(self.textcontent)
 		sentences, spans = nlp.splitDoc(doc)
-		print("split note into %d sentences" % len(sentences))
+		logger.debug("split note#%s/%s into %d sentences", self.notebookid, self.noteid, len(sentences))
+		return sentences, spans
 
+	async def embed(self, sentences, spans):
+		"""
+		Group sentences into chunks and get embeddings of title and chunks
+		"""
 		sent_embs = await nlp.asyncGetEmbedLLM(sentences)
 		if not sent_embs:
-			print("failed getting sentence embeddings")
+			logger.warning("failed getting sentence embeddings")
 			return None
 
 		chunks, chunk_spans = nlp.makeChunks(sentences, spans, sent_embs)
-		print("group sentences into %d chunks" % len(chunks))
+		logger.debug("group sentences into %d chunks", len(chunks))
 
 		chunk_embs = await nlp.asyncGetEmbedLLM([self.title, *chunks])
 		if not chunk_embs:
-			print("failed getting chunk embeddings")
+			logger.warning("failed getting chunk embeddings")
 			return None
 
 		title_emb = chunk_embs[0]
 		chunk_embs = chunk_embs[1:]
 		return chunks, chunk_spans, chunk_embs, title_emb
 
+	async def make_chunks(self):
+		"""
+		Chunking note text
+		"""
+		logger.debug("chunk note#%s/%s", self.notebookid, self.noteid)
+		sentences, spans = self.split()
+		return await self.embed(sentences, spans)
+
 	async def db_store_chunks(self, db_conn, title_emb, chunk_embs, chunk_spans):
 		"""
 		Save chunks' embeddings and spans to database
 		"""
+		await Chunks.store(db_conn, int(self.notebookid), int(self.noteid), title_emb, chunk_embs, chunk_spans)
+		logger.debug("saved %d chunks and their embeddings to note#%s/%s", len(chunk_embs), self.notebookid, self.noteid)
+
+	async def db_mark_chunked(self, db_conn, n_chunk, embed_d):
+		"""
+		Clear the dirty flag and record chunk meta, unless the note was
+		deleted or edited since it was loaded. Return whether it was marked.
+		"""
 		tablename = 'notebook_' + str(self.notebookid)
-		b_chunk_embs = pickle.dumps(chunk_embs)
-		b_title_emb = pickle.dumps(title_emb)
-		js_chunk_spans = json.dumps(chunk_spans)
 		cursor = await db_conn.cursor()
+		# lastedit has 1 second resolution, title and content catch edits within a second
 		await cursor.execute(f'''
 			UPDATE {tablename}
 			SET
-				title_emb = ?,
-				chunk_embs = ?,
-				chunk_spans = ?
-			WHERE docid = {self.noteid};
-		''', (b_title_emb, b_chunk_embs, js_chunk_spans))
+				dirty = 0,
+				meta = json_set(CASE WHEN meta IS NULL OR meta = '' THEN '{{}}' ELSE meta END, '$.n_chunk', ?, '$.embed_d', ?)
+			WHERE docid = ?
+				AND CAST(strftime('%s', lastedit) AS INTEGER) = ?
+				AND title = ? AND content = ?;
+		''', (n_chunk, embed_d, int(self.noteid), self.lastedit, self.title, self.textcontent))
+		marked = cursor.rowcount == 1
 		await cursor.close()
-		print("saved %d chunks and their embeddings to note#%s/%s" % (len(chunk_embs), self.notebookid, self.noteid))
+		return marked
 
 	async def db_fetch_cols(self, db_conn, col_names):
 		"""
@@ -151,8 +454,8 @@ class Note():
 		await cursor.execute(f'''
 			SELECT {','.join(col_names)}
 			FROM {tablename}
-			WHERE docid = {self.noteid};
-		''')
+			WHERE docid = ?;
+		''', (self.noteid,))
 		result = await cursor.fetchone()
 		await cursor.close()
 		return result
@@ -196,11 +499,11 @@ class Note():
 				CAST(strftime('%s', lastedit) AS INTEGER),
 				meta, dirty
 			FROM {tablename}
-			WHERE docid = {noteid};
-		''')
+			WHERE docid = ?;
+		''', (noteid,))
 		row = await cursor.fetchone()
 		await cursor.close()
-		print("fetched note#%s/%s" % (notebookid, noteid))
+		logger.debug("fetched note#%s/%s", notebookid, noteid)
 		if not row:
 			return None
 
@@ -219,7 +522,7 @@ class Note():
 		"""
 		Update database's note entry
 		"""
-		print(f"update note#{notebookid}/{noteid}")
+		logger.info(f"update note#{notebookid}/{noteid}")
 		tablename = f'notebook_{notebookid}'
 		cursor = await db_conn.cursor()
 		await cursor.execute(f'''
@@ -233,7 +536,7 @@ class Note():
 		''', (title, textcontent))
 		await cursor.close()
 		if cursor.rowcount!=1:
-			print(f"update note#{notebookid}/{noteid} - failed")
+			logger.warning(f"update note#{notebookid}/{noteid} - failed")
 			return False
 		return True
 
@@ -242,7 +545,7 @@ class Note():
 		"""
 		Delete from database
 		"""
-		print(f"delete note#{notebookid}/{noteid}")
+		logger.info(f"delete note#{notebookid}/{noteid}")
 		tablename = f'notebook_{notebookid}'
 		cursor = await db_conn.cursor()
 		await cursor.execute(f'''
@@ -250,6 +553,34 @@ class Note():
 			WHERE docid = {noteid};
 		''')
 		await cursor.close()
+		await Chunks.delete(db_conn, int(notebookid), int(noteid))
+
+	@classmethod
+	async def db_insert_many(cls, db_conn, notebookid, notes):
+		"""
+		Insert many notes in one statement, marked dirty so they get chunked.
+		@notes: [(title, textcontent, lastedit unix time or None[, meta dict or None]), ...],
+		meta's chunk bookkeeping is dropped since the notes are chunked anew
+		Return docids of the inserted notes
+		"""
+		tablename = f'notebook_{notebookid}'
+		# the notes go in as one JSON array parameter, so any batch size fits sqlite's variable limit
+		cursor = await db_conn.execute(f'''
+			INSERT INTO {tablename} (title, content, lastedit, meta, dirty)
+			SELECT
+				json_extract(value, '$[0]'),
+				json_extract(value, '$[1]'),
+				COALESCE(datetime(json_extract(value, '$[2]'), 'unixepoch'), CURRENT_TIMESTAMP),
+				COALESCE(json_remove(json_extract(value, '$[3]'), '$.n_chunk', '$.embed_d'), '{{}}'),
+				1
+			FROM json_each(?)
+			ORDER BY key
+			RETURNING docid;
+		''', (json.dumps(notes, ensure_ascii=False),))
+		docids = sorted(docid for docid, in await cursor.fetchall())
+		await cursor.close()
+		logger.info(f"inserted {len(docids)} notes into table#{notebookid}")
+		return docids
 
 	@classmethod
 	async def db_insert(cls, db_conn, notebookid, title, textcontent):
@@ -265,6 +596,6 @@ class Note():
 		noteid = cursor.lastrowid
 		await cursor.close()
 		if noteid:
-			print(f"inserted note#{notebookid}/{noteid}")
+			logger.info(f"inserted note#{notebookid}/{noteid}")
 			return noteid
 		return None
@@ -0,0 +1,159 @@
+import logging
+import json
+import pickle
+
+import numpy as np
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+TITLE_CHUNK_IDX = -1  # chunk_idx of a note's title embedding
+
+
+def pack_vector(vec) -> bytes:
+	return np.asarray(vec, dtype=np.float32).tobytes()
+
+
+def unpack_vector(b_vec) -> np.ndarray:
+	return np.frombuffer(b_vec, dtype=np.float32)
+
+
+class Chunks():
+	"""
+	Chunk spans and embeddings of every note, one row per chunk.
+	A note's title embedding is stored as chunk TITLE_CHUNK_IDX without a span.
+	"""
+
+	@staticmethod
+	async def initDB(conn):
+		cursor = await conn.cursor()
+		await cursor.executescript('''
+			CREATE TABLE IF NOT EXISTS chunks (
+				notebookid INTEGER,
+				noteid INTEGER,
+				chunk_idx INTEGER,
+				span_start INTEGER,
+				span_end INTEGER,
+				vector BLOB
+			);
+			CREATE UNIQUE INDEX IF NOT EXISTS chunks_note ON chunks(notebookid, noteid, chunk_idx);
+		''')
+		await cursor.close()
+
+	@staticmethod
+	async def migrate(conn, notebookid):
+		"""
+		Copy embeddings and spans stored in a notebook table's own
+		chunk_embs/title_emb/chunk_spans columns into the chunks table once.
+		The columns are kept, a later start with CHUNKS_DROP_LEGACY_COLUMNS
+		set drops them.
+		"""
+		tablename = f"notebook_{notebookid}"
+		cursor = await conn.execute(f"PRAGMA table_info({tablename});")
+		columns = {row[1] for row in await cursor.fetchall()}
+		if 'chunk_embs' not in columns:
+			await cursor.close()
+			return
+
+		await cursor.execute('''
+			SELECT CASE WHEN json_valid(meta) THEN json_extract(meta, '$.chunks_migrated') END
+			FROM Notebooks
+			WHERE nbid = ?;
+		''', (notebookid,))
+		row = await cursor.fetchone()
+		if row and row[0]:
+			if config.CHUNKS_DROP_LEGACY_COLUMNS:
+				logger.info(f"drop chunk columns of table#{notebookid}")
+				for column in ('chunk_embs', 'title_emb', 'chunk_spans'):
+					await conn.execute(f"ALTER TABLE {tablename} DROP COLUMN {column};")
+			await cursor.close()
+			return
+
+		logger.info(f"migrate chunks of table#{notebookid}")
+		await cursor.execute(f'''
+			SELECT docid, chunk_embs, chunk_spans, title_emb
+			FROM {tablename}
+			WHERE chunk_embs IS NOT NULL AND chunk_embs != ''
+				AND chunk_spans IS NOT NULL AND chunk_spans != ''
+				AND title_emb IS NOT NULL AND title_emb != '';
+		''')
+		n = 0
+		while rows := await cursor.fetchmany(256):
+			for docid, b_chunk_embs, js_chunk_spans, b_title_emb in rows:
+				await Chunks.store(conn, notebookid, int(docid),
+					pickle.loads(b_title_emb), pickle.loads(b_chunk_embs), json.loads(js_chunk_spans))
+				n += 1
+		# committed with the copied rows, an interrupted copy starts over on the next start
+		await cursor.execute('''
+			UPDATE Notebooks
+			SET meta = json_set(CASE WHEN json_valid(meta) THEN meta ELSE '{}' END, '$.chunks_migrated', 1)
+			WHERE nbid = ?;
+		''', (notebookid,))
+		await cursor.close()
+		logger.info(f"migrated chunks of {n} notes in table#{notebookid}")
+
+	@staticmethod
+	async def store(db_conn, notebookid, noteid, title_emb, chunk_embs, chunk_spans):
+		"""
+		Replace a note's chunk rows
+		"""
+		rows = [(notebookid, noteid, TITLE_CHUNK_IDX, None, None, pack_vector(title_emb))]
+		rows.extend((notebookid, noteid, i, s, e, pack_vector(emb)) for i, ((s, e), emb) in enumerate(zip(chunk_spans, chunk_embs)))
+		await db_conn.execute("DELETE FROM chunks WHERE notebookid = ? AND noteid = ?;", (notebookid, noteid))
+		await db_conn.executemany('''
+			INSERT INTO chunks (notebookid, noteid, chunk_idx, span_start, span_end, vector)
+			VALUES (?, ?, ?, ?, ?, ?);
+		''', rows)
+
+	@staticmethod
+	async def fetch_title_emb(db_conn, notebookid, noteid):
+		cursor = await db_conn.execute('''
+			SELECT vector FROM chunks
+			WHERE notebookid = ? AND noteid = ? AND chunk_idx = ?;
+		''', (notebookid, noteid, TITLE_CHUNK_IDX))
+		row = await cursor.fetchone()
+		await cursor.close()
+		return unpack_vector(row[0]) if row else None
+
+	@staticmethod
+	async def iter_notes(db_conn, notebookid, batch_size=1024):
+		"""
+		Stream (noteid, chunk_embs, chunk_spans, title_emb) of every clean,
+		fully chunked note in a notebook, reading chunk rows in note order
+		"""
+		tablename = f"notebook_{notebookid}"
+		cursor = await db_conn.execute(f'''
+			SELECT c.noteid, c.chunk_idx, c.span_start, c.span_end, c.vector
+			FROM chunks c JOIN {tablename} n ON n.docid = c.noteid
+			WHERE c.notebookid = ?
+				AND n.dirty = 0
+				AND json_extract(n.meta, '$.embed_d') == {config.LLM_EMBED_D}
+			ORDER BY c.noteid, c.chunk_idx;
+		''', (notebookid,))
+		note = None
+		while rows := await cursor.fetchmany(batch_size):
+			for noteid, chunk_idx, s, e, b_vec in rows:
+				if note is None or note[0] != noteid:
+					if note is not None and note[3] is not None:
+						yield note
+					note = (noteid, [], [], None)
+				if chunk_idx == TITLE_CHUNK_IDX:
+					note = (noteid, note[1], note[2], unpack_vector(b_vec))
+				else:
+					note[1].append(unpack_vector(b_vec))
+					note[2].append([s, e])
+		if note is not None and note[3] is not None:
+			yield note
+		await cursor.close()
+
+	@staticmethod
+	async def delete(db_conn, notebookid, noteid=None):
+		"""
+		Delete chunk rows of a note, or of a whole notebook if @noteid is None
+		"""
+		if noteid is None:
+			await db_conn.execute("DELETE FROM chunks WHERE notebookid = ?;", (notebookid,))
+		else:
+			await db_conn.execute("DELETE FROM chunks WHERE notebookid = ? AND noteid = ?;", (notebookid, noteid))
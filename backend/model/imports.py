@@ -0,0 +1,103 @@
+import json
+
+
+class Imports():
+	"""
+	Progress of bulk imports, one row per import id.
+	n_records counts input records (inserted, skipped or invalid) already committed,
+	re-sending the same input under the same import id resumes after them.
+	"""
+
+	@staticmethod
+	async def initDB(conn):
+		cursor = await conn.cursor()
+		await cursor.executescript('''
+			CREATE TABLE IF NOT EXISTS Imports (
+				import_id TEXT PRIMARY KEY,
+				notebookid INTEGER,
+				status TEXT,
+				n_records INTEGER DEFAULT 0,
+				n_inserted INTEGER DEFAULT 0,
+				n_invalid INTEGER DEFAULT 0,
+				n_chunked INTEGER DEFAULT 0,
+				errors TEXT DEFAULT '[]',
+				started TIMESTAMP,
+				updated TIMESTAMP
+			);
+		''')
+		await cursor.close()
+
+	@staticmethod
+	async def load(db_conn, import_id):
+		cursor = await db_conn.execute('''
+			SELECT
+				import_id, notebookid, status, n_records, n_inserted, n_invalid, n_chunked, errors,
+				CAST(strftime('%s', started) AS INTEGER), CAST(strftime('%s', updated) AS INTEGER)
+			FROM Imports
+			WHERE import_id = ?;
+		''', (import_id,))
+		row = await cursor.fetchone()
+		await cursor.close()
+		if not row:
+			return None
+		keys = ('import_id', 'notebookid', 'status', 'n_records', 'n_inserted', 'n_invalid', 'n_chunked', 'errors', 'started', 'updated')
+		job = dict(zip(keys, row))
+		job['errors'] = json.loads(job['errors'])
+		return job
+
+	@staticmethod
+	async def start(db_conn, import_id, notebookid):
+		"""
+		Create an import, or reopen an unfinished one of the same notebook
+		"""
+		await db_conn.execute('''
+			INSERT INTO Imports (import_id, notebookid, status, started, updated)
+			VALUES (?, ?, 'running', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+			ON CONFLICT(import_id) DO UPDATE SET
+				status = 'running',
+				updated = CURRENT_TIMESTAMP
+			WHERE notebookid = excluded.notebookid AND status != 'done';
+		''', (import_id, notebookid))
+		return await Imports.load(db_conn, import_id)
+
+	@staticmethod
+	async def progress(db_conn, import_id, n_records, n_inserted, n_invalid, errors):
+		"""
+		Record progress of an import, committed with the batch it describes
+		"""
+		await db_conn.execute('''
+			UPDATE Imports
+			SET
+				n_records = ?,
+				n_inserted = ?,
+				n_invalid = ?,
+				errors = ?,
+				updated = CURRENT_TIMESTAMP
+			WHERE import_id = ?;
+		''', (n_records, n_inserted, n_invalid, json.dumps(errors), import_id))
+
+	@staticmethod
+	async def set_chunked(db_conn, import_id, n_chunked):
+		await db_conn.execute('''
+			UPDATE Imports SET n_chunked = ? WHERE import_id = ?;
+		''', (n_chunked, import_id))
+
+	@staticmethod
+	async def finish(db_conn, import_id, status):
+		await db_conn.execute('''
+			UPDATE Imports SET status = ?, updated = CURRENT_TIMESTAMP WHERE import_id = ?;
+		''', (status, import_id))
+
+	@staticmethod
+	async def interrupted(db_conn):
+		"""
+		Mark imports left running by a previous process as interrupted,
+		return their notebook ids
+		"""
+		cursor = await db_conn.execute('''
+			UPDATE Imports SET status = 'interrupted' WHERE status = 'running'
+			RETURNING notebookid;
+		''')
+		rows = await cursor.fetchall()
+		await cursor.close()
+		return {int(nbid) for nbid, in rows}
@@ -1,7 +1,10 @@
+import logging
 import datetime
 import json
 import dataclasses
 
+logger = logging.getLogger(__name__)
+
 
 
 
@@ -25,7 +28,7 @@ class Notebook():
 	@staticmethod
 	async def initDB(conn):
 		cursor = await conn.cursor()
-		print("init Notebooks table")
+		logger.info("init Notebooks table")
 		await cursor.executescript('''
 			DROP TABLE IF EXISTS Notebooks;
 			CREATE TABLE Notebooks (
@@ -44,11 +47,9 @@ class Notebook():
 				content TEXT,
 				lastedit TIMESTAMP,
 				meta TEXT,
-				dirty INTEGER,
-				chunk_embs BLOB,
-				title_emb BLOB,
-				chunk_spans TEXT
+				dirty INTEGER
 			);
+			CREATE INDEX notebook_1_lastedit ON notebook_1(lastedit, docid);
 			INSERT INTO notebook_1 (title, content, lastedit, meta, dirty) VALUES ('hello world', 'your first note', CURRENT_TIMESTAMP, '{}', 1);
 		''')
 		await cursor.close()
@@ -84,28 +85,28 @@ class Notebook():
 				content TEXT,
 				lastedit TIMESTAMP,
 				meta TEXT,
-				dirty INTEGER,
-				chunk_embs BLOB,
-				title_emb BLOB,
-				chunk_spans TEXT
+				dirty INTEGER
 			);
+			CREATE INDEX {tablename}_lastedit ON {tablename}(lastedit, docid);
 			INSERT INTO {tablename} (title, content, lastedit, meta, dirty) VALUES ('hello', 'your first note', CURRENT_TIMESTAMP, '{{}}', 1);
 		''')
 
-		print(f'user#{owner_uid} created notebook#{nbid}')
+		logger.info(f'user#{owner_uid} created notebook#{nbid}')
 		await cursor.close()
+		await request.app.state.db_conn.commit()
 		return nbid
 
 	@classmethod
 	async def fetchUserNotebooks(cls, request, uid):
-		cursor = await request.app.state.db_conn.cursor()
-		await cursor.execute(f'''
-			SELECT nbid, name, meta
-			FROM Notebooks
-			WHERE owner={uid};
-		''')
-		rows = await cursor.fetchall()
-		await cursor.close()
+		async with request.app.state.db_pool.reader() as db_conn:
+			cursor = await db_conn.cursor()
+			await cursor.execute(f'''
+				SELECT nbid, name, meta
+				FROM Notebooks
+				WHERE owner={uid};
+			''')
+			rows = await cursor.fetchall()
+			await cursor.close()
 
 		notebooks = []
 		for row in rows:
@@ -1,7 +1,10 @@
+import logging
 import datetime
 
 import starlette_login.mixins
 
+logger = logging.getLogger(__name__)
+
 
 
 
@@ -25,7 +28,7 @@ class User(starlette_login.mixins.UserMixin):
 	@staticmethod
 	async def initDB(conn):
 		cursor = await conn.cursor()
-		print("init Users table")
+		logger.info("init Users table")
 		await cursor.executescript('''
 			DROP TABLE IF EXISTS Users;
 			CREATE TABLE Users (
@@ -58,6 +61,7 @@ class User(starlette_login.mixins.UserMixin):
 		cursor = await request.app.state.db_conn.cursor()
 		await cursor.execute(f"UPDATE Users SET lastlogin = CURRENT_TIMESTAMP WHERE uid = {self.uid};")
 		await cursor.close()
+		await request.app.state.db_conn.commit()
 		return True
 
 	@classmethod
@@ -75,11 +79,11 @@ class User(starlette_login.mixins.UserMixin):
 		row = await cursor.fetchone()
 		await cursor.close()
 		if not row:
-			print("no such user")
+			logger.debug("no such user")
 			return None
 		uid, username, password, lastlogin, since, isadmin = row
 		user = cls(uid, username, password, lastlogin, since, isadmin)
-		print("getUserByName:", user)
+		logger.debug("getUserByName: %s", user)
 		user_pool[user.uid] = user
 		user_pool[user.username] = user
 		return user
@@ -99,11 +103,11 @@ class User(starlette_login.mixins.UserMixin):
 		row = await cursor.fetchone()
 		await cursor.close()
 		if not row:
-			print("no such user")
+			logger.debug("no such user")
 			return None
 		uid, username, password, lastlogin, since, isadmin = row
 		user = cls(uid, username, password, lastlogin, since, isadmin)
-		print("getUserById:", user)
+		logger.debug("getUserById: %s", user)
 		user_pool[user.uid] = user
 		user_pool[user.username] = user
 		return user
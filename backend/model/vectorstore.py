@@ -1,18 +1,95 @@
+import logging
+import re
+import json
+import asyncio
+import collections
+import contextlib
 import copy
 import pickle
+import time
 import datetime
 
 import faiss
 import numpy as np
 
 import config
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+
+# vector encodings of the faiss index factory a notebook may be configured with
+FAISS_ENCODINGS = re.compile(r'Flat|SQ4|SQ6|SQ8|SQfp16|PQ\d+')
+
+
+def check_settings(settings, emb_d=config.LLM_EMBED_D):
+	"""
+	Validate per-notebook faiss settings {nlist, nprobe, encoding},
+	nlist 0 being an exact index without inverted lists.
+	Return the recognized settings, or None if they are unusable.
+	"""
+	if not isinstance(settings, dict):
+		return None
+	settings = {k: settings[k] for k in ('nlist', 'nprobe', 'encoding') if k in settings}
+	nlist, nprobe, encoding = settings.get('nlist', 1), settings.get('nprobe', 1), settings.get('encoding', 'Flat')
+	if type(nlist) is not int or nlist < 0 or type(nprobe) is not int or nprobe < 1:
+		return None
+	if not isinstance(encoding, str) or not FAISS_ENCODINGS.fullmatch(encoding):
+		return None
+	if encoding.startswith('PQ') and (int(encoding[2:]) < 1 or emb_d % int(encoding[2:]) != 0):
+		return None
+	return settings
+
+
+class SearchTuner():
+	"""
+	Trade a notebook's recall for latency under load.
+	Every level halves nprobe and the candidate k of searches, it is raised
+	when searches, waiting for the index included, take longer than
+	FAISS_LATENCY_TARGET on average and lowered again below half of it.
+	"""
+	SAMPLES = 4  # searches averaged per decision
+
+	def __init__(self, target=config.FAISS_LATENCY_TARGET):
+		self.target = target
+		self.level = 0
+		self.n = 0
+		self.seconds = 0.0
+
+	def plan(self, vs, k, high_recall=False):
+		"""
+		Return (nprobe, candidate k) of the next search for @k results
+		"""
+		if high_recall:
+			return max(vs.nlist, 1), k * config.FAISS_CANDIDATES_HR
+		nprobe = max(min(vs.nprobe, config.FAISS_NPROBE_MIN), vs.nprobe >> self.level)
+		return nprobe, max(k, (k * config.FAISS_CANDIDATES) >> self.level)
+
+	def observe(self, vs, seconds, n=1):
+		"""
+		Record a search of @n queries that took @seconds
+		"""
+		self.n += n
+		self.seconds += seconds
+		if self.n < self.SAMPLES:
+			return
+		mean = self.seconds / self.n
+		self.n, self.seconds = 0, 0.0
+		# no point in going past nprobe FAISS_NPROBE_MIN and candidate k = k
+		max_level = max(vs.nprobe // config.FAISS_NPROBE_MIN, config.FAISS_CANDIDATES).bit_length() - 1
+		if mean > self.target and self.level < max_level:
+			self.level += 1
+			logger.info(f"vectorstore#{vs.notebookid}: searches take {mean*1000:.1f}ms, lower nprobe to {self.plan(vs, 1)[0]}")
+		elif mean < self.target / 2 and self.level > 0:
+			self.level -= 1
+			logger.info(f"vectorstore#{vs.notebookid}: searches take {mean*1000:.1f}ms, raise nprobe to {self.plan(vs, 1)[0]}")
 
 
 class VectorStoreBase():
 	def __init__(self):
 		self._next_emb_id = 1
 		self.last_rebuild = datetime.datetime.min
-		print("vs base init")
 
 	def gen_emb_ids(self, n=1):
 		"""
@@ -23,15 +100,12 @@ class VectorStoreBase():
 		return emb_ids
 
 	def add(self, *args, **kwargs):
-		print("vs base add")
 		pass
 
 	def train(self, *args, **kwargs):
-		print("vs base train")
 		pass
 
 	def search(self, *args, **kwargs):
-		print("vs base search")
 		pass
 
 	@classmethod
@@ -64,41 +138,136 @@ class VectorStoreBase():
 
 
 class NotebookVectorStore(VectorStoreBase):
-	active_vs = None  # TODO: multiple instances
+	cached_vs = collections.OrderedDict()  # key: notebookid -> value: NotebookVectorStore, least recently used first
 	emb_id_map: dict = {}  # key: int -> value: Tuple(noteid: int, List[start: int, end: int])
 	noteid_map: dict = {}  # key: int -> value: List[embedding_id: int])
+	locks: dict = {}  # key: notebookid -> value: asyncio.Lock guarding faiss index access
+	tuners: dict = {}  # key: notebookid -> value: SearchTuner, runtime state kept out of the pickled instance
+	last_used: dict = {}  # key: notebookid -> value: unix time of the last request for its vectorstore
+	hydrate_plan: set = set()  # notebookids hydrate() is yet to load
+	loading: dict = {}  # key: notebookid -> value: asyncio.Task loading its vectorstore, shared by concurrent requests
+
+	@classmethod
+	def lock(cls, notebookid: int):
+		"""
+		Lock held while a notebook's faiss index is searched off the event loop,
+		mutated on it or evicted, so none of them interleave
+		"""
+		if notebookid not in cls.locks:
+			cls.locks[notebookid] = asyncio.Lock()
+		return cls.locks[notebookid]
+
+	@classmethod
+	def tuner(cls, notebookid: int):
+		"""
+		Latency based search settings of a notebook
+		"""
+		if notebookid not in cls.tuners:
+			cls.tuners[notebookid] = SearchTuner()
+		return cls.tuners[notebookid]
 
 	@classmethod
-	async def getVectorStore(cls, notebookid: int, db_conn):
+	async def getVectorStore(cls, notebookid: int, db_conn, track_use=True):
 		"""
-		Maintain only one vectorstore instance for each notebookid
+		Maintain only one vectorstore instance for each notebookid,
+		keep up to VECTORSTORE_CACHE_SIZE instances loaded
+		@track_use: count this as a use of the notebook, background workers don't
 		"""
-		if cls.active_vs:
-			if cls.active_vs.notebookid==notebookid:
-				print(f"vectorstore#{notebookid}: use cached")
-				return cls.active_vs
+		if track_use:
+			cls.last_used[notebookid] = time.time()
+		# needed before its turn to be hydrated, load it right away instead
+		cls.hydrate_plan.discard(notebookid)
+
+		if notebookid in cls.cached_vs:
+			logger.debug(f"vectorstore#{notebookid}: use cached")
+			metrics.vectorstore_cache.inc(result='hit')
+			cls.cached_vs.move_to_end(notebookid)
+			return cls.cached_vs[notebookid]
+		return await cls._load_shared(notebookid, db_conn)
 
-			# save previous instance
-			await cls.saveDB(db_conn, cls.active_vs)
+	@classmethod
+	@contextlib.asynccontextmanager
+	async def hold(cls, notebookid: int, db_conn, track_use=True):
+		"""
+		Get a notebook's vectorstore and hold its lock, to search or change it.
+		An instance evicted while waiting for the lock is loaded again,
+		changes to it would be lost.
+		"""
+		while True:
+			vs = await cls.getVectorStore(notebookid, db_conn, track_use=track_use)
+			async with cls.lock(notebookid):
+				if cls.cached_vs.get(notebookid) is vs:
+					yield vs
+					return
+			logger.debug(f"vectorstore#{notebookid}: evicted while waiting, reload")
 
-		# load/create a new instance
-		vs = await cls.loadDB(db_conn, notebookid=notebookid)
-		if not vs:
-			print(f"vectorstore#{notebookid}: create new")
-			vs = NotebookVectorStore(notebookid=notebookid)
+	@classmethod
+	async def _load_shared(cls, notebookid: int, db_conn, hydrate=False):
+		"""
+		Load a notebook's vectorstore once however many requests need it at the same time.
+		The load runs in its own task, a cancelled request doesn't cancel it for the others.
+		"""
+		task = cls.loading.get(notebookid)
+		if task is None:
+			task = asyncio.create_task(cls._load(notebookid, db_conn, hydrate))
+			cls.loading[notebookid] = task
+			task.add_done_callback(lambda t: cls.loading.get(notebookid) is t and cls.loading.pop(notebookid))
+		else:
+			logger.debug(f"vectorstore#{notebookid}: wait for load in progress")
+			metrics.vectorstore_cache.inc(result='shared')
+		return await asyncio.shield(task)
 
-		cls.active_vs = vs
+	@classmethod
+	async def _load(cls, notebookid: int, db_conn, hydrate=False):
+		"""
+		Load/create a vectorstore instance and cache it, as the most recently used
+		or, when @hydrate, as the least recently used one
+		"""
+		# an eviction of this notebook saves it under the lock, wait for it
+		async with cls.lock(notebookid):
+			vs = await cls.loadDB(db_conn, notebookid=notebookid)
+			if not vs:
+				logger.info(f"vectorstore#{notebookid}: create new")
+				vs = NotebookVectorStore(notebookid=notebookid, **await cls.loadSettings(db_conn, notebookid))
+				metrics.vectorstore_cache.inc(result='create')
+			else:
+				metrics.vectorstore_cache.inc(result='hydrate' if hydrate else 'load')
+
+			cls.cached_vs[notebookid] = vs
+			if hydrate:
+				cls.cached_vs.move_to_end(notebookid, last=False)
+		await cls._evict(db_conn, keep=notebookid)
 		return vs
 
-	def __init__(self, notebookid, emb_d=config.LLM_EMBED_D, nlist=config.FAISS_NLIST, nprobe=config.FAISS_NPROBE, normalize=config.FAISS_NORMALIZE):
+	@classmethod
+	async def _evict(cls, db_conn, keep=None):
+		"""
+		Save and unload least recently used instances beyond VECTORSTORE_CACHE_SIZE.
+		Instances locked by a search or change are kept until a later load.
+		"""
+		while len(cls.cached_vs) > config.VECTORSTORE_CACHE_SIZE:
+			nbid = next((nbid for nbid in cls.cached_vs if nbid != keep and not cls.lock(nbid).locked()), None)
+			if nbid is None:
+				logger.debug(f"vectorstore cache: {len(cls.cached_vs)} instances, all in use")
+				return
+			async with cls.lock(nbid):
+				evicted = cls.cached_vs.pop(nbid, None)
+				if evicted is None:
+					continue
+				logger.info(f"vectorstore#{nbid}: evict from cache")
+				metrics.vectorstore_cache.inc(result='evict')
+				await cls.saveDB(db_conn, evicted)
+
+	def __init__(self, notebookid, emb_d=config.LLM_EMBED_D, nlist=config.FAISS_NLIST, nprobe=config.FAISS_NPROBE, normalize=config.FAISS_NORMALIZE, encoding=config.FAISS_ENCODING):
 		assert notebookid!=""
 		super().__init__()
 		self.emb_d = emb_d  # embedding dimension
 		self.normalize = normalize
 		self.notebookid = notebookid
 		self.tablename = "notebook_" + str(notebookid)
-		self.nlist = nlist
+		self.nlist = nlist  # 0: exact search without inverted lists
 		self.nprobe = nprobe
+		self.encoding = encoding
 
 		self._next_emb_id = 1
 		self._next_emb_id_title = 1
@@ -108,14 +277,40 @@ class NotebookVectorStore(VectorStoreBase):
 		self.clear()
 
 	def clear(self):
-		self.index = faiss.index_factory(self.emb_d, f"IVF{self.nlist},Flat", faiss.METRIC_INNER_PRODUCT)
-		self.index.set_direct_map_type(faiss.DirectMap.Hashtable)
-		self.index.nprobe = self.nprobe
+		if self.nlist:
+			self.index = faiss.index_factory(self.emb_d, f"IVF{self.nlist},{self.encoding}", faiss.METRIC_INNER_PRODUCT)
+			self.index.set_direct_map_type(faiss.DirectMap.Hashtable)
+			self.index.nprobe = self.nprobe
+		else:
+			self.index = faiss.index_factory(self.emb_d, f"IDMap,{self.encoding}", faiss.METRIC_INNER_PRODUCT)
 		self.index_title = faiss.index_factory(self.emb_d, f"IDMap,Flat", faiss.METRIC_INNER_PRODUCT)
 		self.emb_id_map = {}  # embedding id --> [note id, [span]]
 		self.noteid_map = {}  # note id --> [embedding ids, ...]
 		self.emb_id_map_title = {}  # embedding id --> note id
 		self.noteid_map_title = {}  # note id --> embedding id
+		self.emb_count = 0
+
+	def configure(self, nlist=None, nprobe=None, encoding=None):
+		"""
+		Apply faiss settings. A new nprobe takes effect right away,
+		return True if the index has to be rebuilt for the others.
+		"""
+		nlist = self.nlist if nlist is None else nlist
+		encoding = self.encoding if encoding is None else encoding
+		retrain = (nlist, encoding) != (self.nlist, self.encoding)
+		self.nlist, self.encoding = nlist, encoding
+		if nprobe is not None and nprobe != self.nprobe:
+			self.nprobe = nprobe
+			if not retrain and self.nlist:
+				self.index.nprobe = nprobe
+		return retrain
+
+	def min_train_size(self):
+		"""
+		Number of embeddings needed to train the index
+		"""
+		# product quantizers train 256 centroids per sub-vector
+		return max(self.nlist, 256 if self.encoding.startswith('PQ') else 1 if self.encoding != 'Flat' else 0)
 
 	def gen_emb_ids_title(self, n=1):
 		"""
@@ -137,9 +332,10 @@ class NotebookVectorStore(VectorStoreBase):
 
 		if noteid in self.noteid_map:
 			emb_ids = self.noteid_map[noteid]
-			c = self.index.remove_ids(self._conv_nparray(emb_ids))
+			with metrics.faiss_seconds.time(op='remove'):
+				c = self.index.remove_ids(self._conv_nparray(emb_ids))
 			self.modifies += c
-			print(f"removed {c} embeddings")
+			logger.debug(f"removed {c} embeddings")
 			self.emb_count -= c
 			for eid in emb_ids:
 				eid = int(eid)
@@ -165,7 +361,7 @@ class NotebookVectorStore(VectorStoreBase):
 			old_emb_ids = self.noteid_map[noteid]
 			c = self.index.remove_ids(self._conv_nparray(old_emb_ids))
 			self.modifies += c
-			print(f"removed {c} old embeddings")
+			logger.debug(f"removed {c} old embeddings")
 			self.emb_count -= c
 			for eid in old_emb_ids:
 				eid = int(eid)
@@ -190,10 +386,11 @@ class NotebookVectorStore(VectorStoreBase):
 		# add to faiss index
 		chunk_embs = self._conv_nparray(chunk_embs)
 		self.normalize and faiss.normalize_L2(chunk_embs)
-		self.index.add_with_ids(chunk_embs, emb_ids)
+		with metrics.faiss_seconds.time(op='add'):
+			self.index.add_with_ids(chunk_embs, emb_ids)
 		c = len(chunk_embs)
 		self.modifies += c
-		print(f"added {c} embeddings")
+		logger.debug(f"added {c} embeddings")
 		self.emb_count += c
 
 		title_emb = self._conv_nparray([title_emb])
@@ -208,10 +405,11 @@ class NotebookVectorStore(VectorStoreBase):
 		@embs: all chunk embeddings in a notebook
 		"""
 		embs = self._conv_nparray(embs)
-		print(f"train {len(embs)} embeddings ...")
+		logger.info(f"train {len(embs)} embeddings ...")
 		self.normalize and faiss.normalize_L2(embs)
-		self.index.train(embs)
-		print("training done")
+		with metrics.faiss_seconds.time(op='train'):
+			self.index.train(embs)
+		logger.info("training done")
 
 	def search_title(self, query_emb, k=5):
 		query_emb = self._conv_nparray(query_emb)
@@ -219,17 +417,36 @@ class NotebookVectorStore(VectorStoreBase):
 		D, indices = self.index_title.search(query_emb, k)
 		return D, indices
 
-	def search(self, query_emb, k=5):
+	def search(self, query_emb, k=5, nprobe=None):
 		"""
 		Search faiss index
+		@nprobe: inverted lists to probe instead of self.nprobe
 		"""
 		query_emb = self._conv_nparray(query_emb)
 		self.normalize and faiss.normalize_L2(query_emb)
-		D, indices = self.index.search(query_emb, k)
+		params = faiss.SearchParametersIVF(nprobe=nprobe) if nprobe and self.nlist else None
+		D, indices = self.index.search(query_emb, k, params=params)
 		return D, indices
 
+	def search_batch(self, query_embs, title_query_embs=None, k=5, nprobe=None):
+		"""
+		Search faiss indexes for N queries at once, one call per index
+		@query_embs: (N, d) queries against chunk embeddings
+		@title_query_embs: (N, d) queries against title embeddings, skipped if None
+		@nprobe: inverted lists to probe instead of self.nprobe
+		Return D, I, D_title, I_title, each of shape (N, k)
+		"""
+		with metrics.faiss_seconds.time(op='search'):
+			with tracing.span('faiss.search', ntotal=self.index.ntotal, nlist=self.nlist, nprobe=nprobe or self.nprobe):
+				D, I = self.search(query_embs, k=k, nprobe=nprobe)
+			D2, I2 = None, None
+			if title_query_embs is not None and len(title_query_embs)>0:
+				with tracing.span('faiss.search_title', ntotal=self.index_title.ntotal):
+					D2, I2 = self.search_title(title_query_embs, k=k)
+		return D, I, D2, I2
+
 	@classmethod
-	async def saveDB(cls, db_conn, instance, notebookid=None):
+	async def saveDB(cls, db_conn, instance, notebookid=None, commit=True):
 		"""
 		Save a NotebookVectorStore instance to database
 		"""
@@ -250,9 +467,10 @@ class NotebookVectorStore(VectorStoreBase):
 			SET vectorstore = ?
 			WHERE nbid = {notebookid};
 		''', (b_obj,))
-		print(f"vectorstore#{notebookid}: save to db")
+		logger.debug(f"vectorstore#{notebookid}: save to db")
 		await cursor.close()
-		await db_conn.commit()
+		if commit:
+			await db_conn.commit()
 
 	@classmethod
 	async def loadDB(cls, db_conn, notebookid: int):
@@ -270,18 +488,109 @@ class NotebookVectorStore(VectorStoreBase):
 		b_obj = await cursor.fetchone()
 		await cursor.close()
 		if len(b_obj)==0 or not b_obj[0]:
-			print(f"vectorstore#{notebookid}: not found in db")
+			logger.info(f"vectorstore#{notebookid}: not found in db")
 			return None
 
-		instance = pickle.loads(b_obj[0])
-		assert isinstance(instance, cls)
+		# unpickling and deserializing a large index takes a while, keep the event loop going meanwhile
+		instance = await asyncio.to_thread(cls._deserialize, b_obj[0])
 		assert instance.emb_d == config.LLM_EMBED_D
 		assert instance.notebookid == notebookid
+		logger.info(f"vectorstore#{notebookid}: load from db")
+		return instance
+
+	@classmethod
+	def _deserialize(cls, b_obj):
+		instance = pickle.loads(b_obj)
+		assert isinstance(instance, cls)
+		instance.__dict__.setdefault('encoding', 'Flat')  # pickled before encodings were configurable
 		instance.index = faiss.deserialize_index(instance.index)
 		instance.index_title = faiss.deserialize_index(instance.index_title)
-		print(f"vectorstore#{notebookid}: load from db")
 		return instance
 
+	@classmethod
+	async def hydrate(cls, db_conn, budget=config.HYDRATE_MEMORY_BUDGET, limit=config.VECTORSTORE_CACHE_SIZE):
+		"""
+		Load the vectorstores of the most recently used notebooks first,
+		while their serialized sizes add up to at most @budget bytes.
+		A notebook requested before its turn is taken off the plan and loaded
+		by its request, requests for the one being loaded share its load.
+		Return the notebookids loaded.
+		"""
+		cursor = await db_conn.execute('''
+			SELECT nbid, length(vectorstore)
+			FROM Notebooks
+			WHERE vectorstore IS NOT NULL
+			ORDER BY coalesce(CASE WHEN json_valid(meta) THEN json_extract(meta, '$.last_used') END, 0) DESC, nbid DESC;
+		''')
+		rows = await cursor.fetchall()
+		await cursor.close()
+
+		plan = []
+		for nbid, size in rows:
+			if len(plan) >= limit - len(cls.cached_vs):
+				break
+			if nbid in cls.cached_vs or size > budget:
+				continue
+			budget -= size
+			plan.append(nbid)
+		cls.hydrate_plan = set(plan)
+		logger.info(f"vectorstore hydration: {len(plan)} of {len(rows)} notebooks planned")
+
+		loaded = []
+		try:
+			for nbid in plan:
+				if nbid not in cls.hydrate_plan:
+					continue  # promoted, loaded by its request
+				if len(cls.cached_vs) >= limit:
+					break
+				cls.hydrate_plan.discard(nbid)
+				if nbid in cls.cached_vs or nbid in cls.loading:
+					continue
+				try:
+					# hydrated in most recently used order, each one older than those before
+					await cls._load_shared(nbid, db_conn, hydrate=True)
+					loaded.append(nbid)
+				except Exception as err:
+					logger.warning(f"vectorstore#{nbid}: hydration failed: {err!r}")
+		finally:
+			cls.hydrate_plan = set()
+		return loaded
+
+	@classmethod
+	async def saveUsage(cls, db_conn):
+		"""
+		Record when each notebook was last used, for hydrate() after a restart
+		"""
+		await db_conn.executemany('''
+			UPDATE Notebooks
+			SET meta = json_set(CASE WHEN json_valid(meta) THEN meta ELSE '{}' END, '$.last_used', ?)
+			WHERE nbid = ?;
+		''', [(int(t), nbid) for nbid, t in cls.last_used.items()])
+
+	@classmethod
+	async def loadSettings(cls, db_conn, notebookid: int):
+		"""
+		Faiss settings of a notebook from Notebooks.meta $.faiss,
+		as written by tools/vsbench.py, or {} for the config defaults
+		"""
+		cursor = await db_conn.execute(f'''
+			SELECT json_extract(meta, '$.faiss')
+			FROM Notebooks
+			WHERE nbid = {int(notebookid)} AND json_valid(meta);
+		''')
+		row = await cursor.fetchone()
+		await cursor.close()
+		if not row or not row[0]:
+			return {}
+		try:
+			settings = check_settings(json.loads(row[0]))
+		except ValueError:
+			settings = None
+		if settings is None:
+			logger.warning(f"vectorstore#{notebookid}: ignore invalid faiss settings {row[0]!r}")
+			return {}
+		return settings
+
 
 
 
@@ -0,0 +1,155 @@
+import logging
+import asyncio
+import time
+
+import config
+import metrics
+
+from model.vectorstore import NotebookVectorStore
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue():
+	"""
+	Coalesce background writes into group commits.
+	Jobs are keyed, a newer job replaces a pending one with the same key.
+	Notebooks whose vectorstore changed are saved once per batch.
+	A batch is committed once it holds @max_batch jobs or its oldest job
+	has waited @max_delay seconds, whichever comes first.
+	@db_conn is the queue's own writer connection, so no other commit
+	or rollback takes part of a batch with it.
+	"""
+
+	def __init__(self, db_conn, max_batch=config.GROUP_COMMIT_MAX_BATCH, max_delay=config.GROUP_COMMIT_MAX_DELAY):
+		self.db_conn = db_conn
+		self.max_batch = max_batch
+		self.max_delay = max_delay
+		self.jobs = {}  # key --> async fn(db_conn)
+		self.dirty_vs = set()  # notebookids
+		self.waiters = []
+		self._wakeup = asyncio.Event()
+		self._full = asyncio.Event()
+		self._flush_lock = asyncio.Lock()
+		self.stats = {
+			'commits': 0,
+			'failed_commits': 0,
+			'jobs': 0,
+			'coalesced_jobs': 0,
+			'vectorstore_saves': 0,
+			'max_batch_size': 0,
+			'last_batch_size': 0,
+			'commit_seconds_total': 0.0,
+			'commit_seconds_max': 0.0,
+		}
+
+	async def submit(self, key=None, job=None, notebookid=None, wait=config.GROUP_COMMIT_WAIT):
+		"""
+		Queue @job to run in the next group commit and/or mark
+		@notebookid's vectorstore to be saved.
+		With @wait, return only after the batch is committed.
+		"""
+		if job is not None:
+			key = key if key is not None else id(job)
+			if key in self.jobs:
+				self.stats['coalesced_jobs'] += 1
+			self.jobs[key] = job
+			self.stats['jobs'] += 1
+		if notebookid is not None:
+			self.dirty_vs.add(notebookid)
+		self._wakeup.set()
+		if len(self.jobs) >= self.max_batch:
+			self._full.set()
+
+		if wait:
+			waiter = asyncio.get_running_loop().create_future()
+			self.waiters.append(waiter)
+			await waiter
+
+	async def run(self):
+		"""
+		Background task committing batches as they fill up or time out
+		"""
+		logger.info("write-behind queue: start")
+		try:
+			while True:
+				await self._wakeup.wait()
+				try:
+					await asyncio.wait_for(self._full.wait(), self.max_delay)
+				except asyncio.TimeoutError:
+					pass
+				await self.flush()
+		except asyncio.CancelledError:
+			logger.info("write-behind queue: cancelled")
+			raise
+
+	async def flush(self):
+		"""
+		Run all pending jobs and vectorstore saves in one transaction
+		"""
+		async with self._flush_lock:
+			self._wakeup.clear()
+			self._full.clear()
+			jobs, self.jobs = self.jobs, {}
+			dirty_vs, self.dirty_vs = self.dirty_vs, set()
+			waiters, self.waiters = self.waiters, []
+			if not jobs and not dirty_vs:
+				for waiter in waiters:
+					waiter.done() or waiter.set_result(None)
+				return
+
+			t0 = time.perf_counter()
+			error = None
+			try:
+				# take the write lock up front, waiting out other writers for busy_timeout
+				await self.db_conn.execute("BEGIN IMMEDIATE;")
+				for job in jobs.values():
+					await job(self.db_conn)
+				for notebookid in dirty_vs:
+					vs = NotebookVectorStore.cached_vs.get(notebookid)
+					# saveDB serializes without awaiting, so no lock is needed for a consistent snapshot
+					if vs is not None:  # evicted instances were saved on eviction
+						await NotebookVectorStore.saveDB(self.db_conn, vs, notebookid=notebookid, commit=False)
+						self.stats['vectorstore_saves'] += 1
+				await self.db_conn.commit()
+			except Exception as err:
+				# notes stay dirty in the database, the note scanner will chunk them again
+				logger.error(f"write-behind queue: group commit failed: {err!r}")
+				error = err
+				self.stats['failed_commits'] += 1
+				await self.db_conn.rollback()
+				self.dirty_vs |= dirty_vs  # retry vectorstore saves with the next batch
+			elapsed = time.perf_counter() - t0
+			metrics.group_commit_seconds.observe(elapsed)
+
+			batch_size = len(jobs) + len(dirty_vs)
+			self.stats['commits'] += 0 if error else 1
+			self.stats['last_batch_size'] = batch_size
+			self.stats['max_batch_size'] = max(self.stats['max_batch_size'], batch_size)
+			self.stats['commit_seconds_total'] += elapsed
+			self.stats['commit_seconds_max'] = max(self.stats['commit_seconds_max'], elapsed)
+			logger.debug(f"write-behind queue: committed {len(jobs)} jobs, {len(dirty_vs)} vectorstores in {elapsed*1000:.1f}ms")
+
+			for waiter in waiters:
+				if waiter.done():
+					continue
+				if error:
+					waiter.set_exception(error)
+				else:
+					waiter.set_result(None)
+
+	async def close(self):
+		"""
+		Commit what is pending and close the connection
+		"""
+		await self.flush()
+		await self.db_conn.close()
+
+	def info(self):
+		commits = self.stats['commits']
+		return {
+			**self.stats,
+			'pending_jobs': len(self.jobs),
+			'pending_vectorstores': len(self.dirty_vs),
+			'commit_seconds_avg': self.stats['commit_seconds_total'] / commits if commits else 0.0,
+		}
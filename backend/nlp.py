@@ -1,28 +1,45 @@
-import requests
+import time
+import logging
+import threading
 
 import httpx
 import numpy as np
-import nltk.tokenize.texttiling
-import sklearn.metrics.pairwise
 
 import config
+import metrics
+import tracing
 
+logger = logging.getLogger(__name__)
+
+# spacy and nltk take seconds to import, they are loaded on first use or by preload()
 nlp_model = None
+nlp_lock = threading.Lock()
 
 
 def initNLP():
 	global nlp_model
-	if not nlp_model:
-		print("load nlp model")
-		import spacy
-		nlp_model = spacy.load(config.NPL_MODEL_NAME)
-		for p in nlp_model.pipe_names:
-			nlp_model.remove_pipe(p)
-		nlp_model.add_pipe('sentencizer')
+	with nlp_lock:
+		if not nlp_model:
+			logger.info("load nlp model")
+			import spacy
+			model = spacy.load(config.NPL_MODEL_NAME)
+			for p in model.pipe_names:
+				model.remove_pipe(p)
+			model.add_pipe('sentencizer')
+			nlp_model = model
 	return nlp_model
 
 
+def preload():
+	"""
+	Load the nlp model and chunking modules ahead of the first note to chunk
+	"""
+	import nltk.tokenize.texttiling
+	initNLP()
+
+
 def getEmbedLLM(sentences):
+	import requests
 	payload = {
 		"llm": config.LLM_MODEL_NAME,
 		"contents": sentences,
@@ -30,37 +47,69 @@ def getEmbedLLM(sentences):
 	try:
 		response = requests.post(config.LLM_API_URL, json=payload)
 	except Exception as err:
-		print(f"failed to get embeddings: {err}")
+		logger.warning(f"failed to get embeddings: {err}")
 		return None
 	if response.status_code!=200:
 		return None
 	result = response.json()
 	if result['status']!=200 or len(result['contents'])<=0:
-		print(f"llm error: {result['message']}")
+		logger.warning(f"llm error: {result['message']}")
 		return None
 	assert len(result['contents'][0]) == config.LLM_EMBED_D
 	return result['contents']
 
 
+def _parse_server_timing(value):
+	"""
+	{name: milliseconds} of a Server-Timing header
+	"""
+	timings = {}
+	for metric in value.split(','):
+		name, *params = [p.strip() for p in metric.split(';')]
+		for p in params:
+			if p.startswith('dur='):
+				try:
+					timings[name] = float(p[4:])
+				except ValueError:
+					pass
+	return timings
+
+
 async def asyncGetEmbedLLM(sentences):
-	async with httpx.AsyncClient(timeout=config.LLM_HTTP_TIMEOUT) as client:
-		payload = {
-			"llm": config.LLM_MODEL_NAME,
-			"contents": sentences,
-		}
+	t0 = time.perf_counter()
+	outcome = 'error'
+	with tracing.span('llm.embed', texts=len(sentences)) as span:
 		try:
-			response = await client.post(config.LLM_API_URL, json=payload)
-		except httpx.ConnectError as err:
-			print(f"failed to get embeddings: {err}")
-			return None
-		if response.status_code != 200:
-			return None
-		result = response.json()
-		if result['status']!=200 or len(result['contents'])<=0:
-			print(f"llm error: {result['message']}")
-			return None
-		assert len(result['contents'][0]) == config.LLM_EMBED_D
-		return result['contents']
+			async with httpx.AsyncClient(timeout=config.LLM_HTTP_TIMEOUT) as client:
+				payload = {
+					"llm": config.LLM_MODEL_NAME,
+					"contents": sentences,
+				}
+				metrics.embed_texts.inc(len(sentences))
+				headers = {}
+				if span is not None:
+					# the llm server joins the trace and reports its stage timings back
+					headers['traceparent'] = span.traceparent()
+				try:
+					response = await client.post(config.LLM_API_URL, json=payload, headers=headers)
+				except httpx.HTTPError as err:
+					logger.warning(f"failed to get embeddings: {err}")
+					outcome = 'timeout' if isinstance(err, httpx.TimeoutException) else 'error'
+					return None
+				if span is not None:
+					for name, ms in _parse_server_timing(response.headers.get('server-timing', '')).items():
+						span.set_attribute(f'llm.{name}_ms', ms)
+				if response.status_code != 200:
+					return None
+				result = response.json()
+				if result['status']!=200 or len(result['contents'])<=0:
+					logger.warning(f"llm error: {result['message']}")
+					return None
+				assert len(result['contents'][0]) == config.LLM_EMBED_D
+				outcome = 'ok'
+				return result['contents']
+		finally:
+			metrics.embed_request_seconds.observe(time.perf_counter() - t0, outcome=outcome)
 
 
 def parseText(text):
@@ -101,14 +150,22 @@ def splitDoc(doc):
 	return ss, ss_spans
 
 
+def pairwise_cos_sim(a, b):
+	"""
+	Cosine similarity of each row of @a with the same row of @b, 0 for zero vectors
+	"""
+	a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+	dots = np.einsum('ij,ij->i', a, b)
+	norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+	return np.divide(dots, norms, out=np.zeros_like(dots), where=norms>0)
+
+
 def makeChunks(sentences, spans, sent_embs):
 	if len(sentences)==1:
 		return sentences, spans
 
-	gap_scores = sklearn.metrics.pairwise.cosine_similarity(sent_embs[:-1], sent_embs[1:])
-	gap_scores = np.diag(gap_scores)  # TODO: rewrite similarity function, only calculate diagonal values
-	# from sentence_transformers.utils import pairwise_cos_sim
-	# gap_scores = model.similarity_pairwise(sent_embs[:-1], sent_embs[1:])
+	import nltk.tokenize.texttiling
+	gap_scores = pairwise_cos_sim(sent_embs[:-1], sent_embs[1:])
 	tt = nltk.tokenize.texttiling.TextTilingTokenizer(smoothing_width=min(len(sentences)//8, 11)-1)
 	smooth_scores = tt._smooth_scores(gap_scores)
 	depth_scores = tt._depth_scores(smooth_scores)
@@ -0,0 +1,114 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+import collections
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+profile_lock = threading.Lock()  # one profile at a time
+
+
+def _frame_name(frame):
+	code = frame.f_code
+	# collapsed stack frames are ';' separated, keep them free of it
+	return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+
+
+def _fold(frame):
+	"""
+	Stack of @frame, root first, as one collapsed stack line
+	"""
+	names = []
+	while frame is not None:
+		names.append(_frame_name(frame))
+		frame = frame.f_back
+	return ';'.join(reversed(names))
+
+
+def sample(seconds, interval, thread_ids=None):
+	"""
+	Sample stacks of the threads in @thread_ids, or of all threads but this one,
+	every @interval for @seconds.
+	Return {collapsed stack: count} and the number of sampling rounds.
+	"""
+	me = threading.get_ident()
+	names = {t.ident: t.name for t in threading.enumerate()}
+	stacks = collections.Counter()
+	rounds = 0
+	deadline = time.perf_counter() + seconds
+	while time.perf_counter() < deadline:
+		for tid, frame in sys._current_frames().items():
+			if tid == me or (thread_ids is not None and tid not in thread_ids):
+				continue
+			thread = names.get(tid) or str(tid)
+			stacks[f"{thread};{_fold(frame)}"] += 1
+		rounds += 1
+		time.sleep(interval)
+	return stacks, rounds
+
+
+def collapsed(stacks):
+	"""
+	Folded stack format of flamegraph.pl, speedscope and friends
+	"""
+	return ''.join(f"{stack} {n}\n" for stack, n in stacks.most_common())
+
+
+def _task_name(loop):
+	# read from the watchdog thread while the loop is blocked, good enough for a diagnosis
+	try:
+		task = asyncio.current_task(loop)
+	except RuntimeError:
+		return None
+	if task is None:
+		return None
+	coro = task.get_coro()
+	return f"{task.get_name()} {getattr(coro, '__qualname__', coro)}"
+
+
+async def loop_lag_monitor(app, interval=config.LOOP_LAG_INTERVAL, threshold=config.LOOP_LAG_THRESHOLD):
+	"""
+	Measure event loop lag with a heartbeat coroutine.
+	A watchdog thread logs the stack of the loop thread and its running task
+	when the heartbeat is late by more than @threshold, once per stall.
+	"""
+	loop = asyncio.get_running_loop()
+	loop_thread = threading.get_ident()
+	last_beat = time.monotonic()
+	stopped = threading.Event()
+
+	def _watchdog():
+		reported = None
+		while not stopped.wait(interval):
+			beat = last_beat
+			lag = time.monotonic() - beat - interval
+			if lag < threshold or reported == beat:
+				continue
+			reported = beat
+			frame = sys._current_frames().get(loop_thread)
+			stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+			metrics.loop_stalls.inc()
+			logger.warning(f"event loop blocked for {lag*1000:.0f}ms in task {_task_name(loop)}:\n{stack}")
+
+	watchdog = threading.Thread(target=_watchdog, name='loop-lag-watchdog', daemon=True)
+	watchdog.start()
+	logger.info("loop lag monitor: start")
+	try:
+		while True:
+			t0 = time.monotonic()
+			await asyncio.sleep(interval)
+			last_beat = time.monotonic()
+			metrics.loop_lag_seconds.observe(max(0.0, last_beat - t0 - interval))
+	except asyncio.CancelledError:
+		logger.info("loop lag monitor: cancelled")
+		raise
+	finally:
+		stopped.set()
@@ -0,0 +1,64 @@
+import numpy as np
+
+import config
+
+
+# result legs in the order they are stacked into candidate arrays
+LEGS = ('fts', 'content', 'title')
+
+
+def fuse_rrf(ranks, scores, weights, rrf_k=config.RANK_RRF_K):
+	"""
+	Reciprocal-rank fusion.
+	@ranks: (n_legs, n_candidates) 1-based ranks, 0 where a candidate is absent from a leg
+	"""
+	present = ranks > 0
+	contrib = np.where(present, 1.0 / (rrf_k + np.where(present, ranks, 1)), 0.0)
+	return weights @ contrib
+
+
+def fuse_weighted(ranks, scores, weights, rrf_k=None):
+	"""
+	Min-max normalize each leg's scores over its own candidates,
+	then take a weighted sum. Higher score is better in every leg.
+	@scores: (n_legs, n_candidates) raw scores, nan where a candidate is absent from a leg
+	"""
+	present = ~np.isnan(scores)
+	lo = np.min(np.where(present, scores, np.inf), axis=1, keepdims=True)
+	hi = np.max(np.where(present, scores, -np.inf), axis=1, keepdims=True)
+	span = np.where(hi > lo, hi - lo, 1.0)
+	with np.errstate(invalid='ignore'):
+		normed = np.where(present, (scores - lo) / span, 0.0)
+	# a leg holding a single candidate normalizes to 0, count it as a full match instead
+	normed = np.where(present & (hi == lo), 1.0, normed)
+	return weights @ normed
+
+
+FUSIONS = {
+	'rrf': fuse_rrf,
+	'weighted': fuse_weighted,
+}
+
+
+def fuse(candidates, k, method=config.RANK_FUSION, weights=config.RANK_WEIGHTS):
+	"""
+	Rank candidates from all result legs in one pass.
+	@candidates: {noteid: {leg: (rank, score), ...}, ...}
+	@weights: {leg: weight, ...}
+	Return [(noteid, fused_score), ...] of at most @k items, best first.
+	"""
+	if not candidates:
+		return []
+
+	nids = np.fromiter(candidates.keys(), dtype=np.int64, count=len(candidates))
+	ranks = np.zeros((len(LEGS), len(nids)), dtype=np.float64)
+	scores = np.full((len(LEGS), len(nids)), np.nan, dtype=np.float64)
+	for j, legs in enumerate(candidates.values()):
+		for i, leg in enumerate(LEGS):
+			if leg in legs:
+				ranks[i, j], scores[i, j] = legs[leg]
+	w = np.array([weights.get(leg, 0.0) for leg in LEGS], dtype=np.float64)
+
+	fused = FUSIONS[method](ranks, scores, w)
+	order = np.argsort(-fused, kind='stable')[:k]
+	return [(int(nids[i]), float(fused[i])) for i in order]
@@ -1,29 +1,47 @@
+import logging
+import asyncio
 import collections
 import math
+import time
+import sqlite3
+
+import anyio
+import numpy as np
 
 import nlp
+import cache
+import metrics
+import tracing
 import model
+import config
+import ranking
+
+logger = logging.getLogger(__name__)
 
 
 async def quick_search(request, notebookid, keyword, k=5, snippet_size=48, is_quoted=True):
 	tablename = f"notebook_{notebookid}"
 	tablename_fts = tablename+"_fts"
 
-	cursor = await request.app.state.db_conn.cursor()
 	format_title = f"simple_highlight({tablename_fts}, 0, '<b>', '</b>') title" if is_quoted else f"title"
 	format_content = f"simple_snippet({tablename_fts}, 1, '<b>', '</b>', ' ... ', {snippet_size}) content" if is_quoted else f"simple_snippet({tablename_fts}, 1, '', '', '...', {snippet_size}) content"
 	format_content = f"content" if snippet_size==-1 else format_content
-	await cursor.execute(f'''
-		SELECT
-			rowid,
-			{format_title},
-			{format_content},
-			simple_highlight_pos({tablename_fts}, 0),
-			simple_highlight_pos({tablename_fts}, 1)
-		FROM {tablename_fts} WHERE {tablename_fts} MATCH simple_query('{keyword}');
-	''')
-	rows = await cursor.fetchmany(size=k)
-	await cursor.close()
+	async with request.app.state.db_pool.reader() as db_conn:
+		cursor = await db_conn.cursor()
+		with metrics.sqlite_query_seconds.time(query='fts_quick'):
+			await cursor.execute(f'''
+				SELECT
+					rowid,
+					{format_title},
+					{format_content},
+					simple_highlight_pos({tablename_fts}, 0),
+					simple_highlight_pos({tablename_fts}, 1)
+				FROM {tablename_fts} WHERE {tablename_fts} MATCH simple_query(?)
+				ORDER BY rank
+				LIMIT ?;
+			''', (keyword, k))
+			rows = await cursor.fetchall()
+		await cursor.close()
 
 	result = {
 		'query': keyword,
@@ -41,323 +59,568 @@ async def quick_search(request, notebookid, keyword, k=5, snippet_size=48, is_qu
 	return result
 
 
+def prefix_query(keyword):
+	"""
+	FTS5 match expression for text being typed,
+	every term is a phrase and the last, unfinished one a prefix
+	"""
+	terms = ['"%s"' % t.replace('"', '""') for t in keyword.split()]
+	if terms and not keyword[-1].isspace():
+		terms[-1] += '*'
+	return ' '.join(terms)
+
+
+async def typeahead_search(request, notebookid, keyword, k=5):
+	"""
+	Cheap FTS search for every keystroke: prefix match served by the index's
+	prefix tables, ranked and cut to @k inside SQLite, titles only, no snippets
+	"""
+	cache_key = cache.results.key('prefix', [notebookid], {'kw': keyword, 'k': k})
+	result = cache.results.get(cache_key)
+	if result is not None:
+		return result
+
+	query = prefix_query(keyword)
+	rows = []
+	if query:
+		tablename_fts = f"notebook_{notebookid}_fts"
+		async with request.app.state.db_pool.reader() as db_conn:
+			try:
+				with metrics.sqlite_query_seconds.time(query='fts_prefix'):
+					cursor = await db_conn.execute(f'''
+						SELECT rowid, title
+						FROM {tablename_fts} WHERE {tablename_fts} MATCH ?
+						ORDER BY rank
+						LIMIT ?;
+					''', (query, k))
+					rows = await cursor.fetchall()
+				await cursor.close()
+			except sqlite3.OperationalError as err:
+				# terms the tokenizer drops entirely leave an invalid expression
+				logger.warning(f"type-ahead query {query!r} failed: {err}")
 
-def snippet(text, bold_spans, highlight_spans, window=20):
-	all_spans = sorted(bold_spans + highlight_spans)
-	if len(all_spans)==0:
-		return None
+	result = {
+		'query': keyword,
+		'size': len(rows),
+		'result': [{
+			'notebookid': notebookid,
+			'noteid': str(r[0]),
+			'title': r[1],
+		} for r in rows],
+	}
+	cache.results.put(cache_key, result)
+	return result
 
-	clusters = []
-	prev_s, prev_e = all_spans[0]
-	for s, e in all_spans[1:]:
-		if s <= prev_e + window * 2:
-			prev_e = max(prev_e, e)
-		else:
-			clusters.append((prev_s, prev_e))
-			prev_s, prev_e = s, e
-	clusters.append((prev_s, prev_e))
 
-	# tags
-	tags = []
-	for s, e in bold_spans:
-		tags.append((s, 0, "b"))
-		tags.append((e, 1, "b"))
-	for s, e in highlight_spans:
-		tags.append((s, 0, "h"))
-		tags.append((e, 1, "h"))
-	tags = sorted(tags, key=lambda tag: tag[0])
 
+def snippet(text, bold_spans, highlight_spans, window=20, max_snippets=config.SNIPPET_MAX):
+	"""
+	Cut windows of @text around matched spans, marking @bold_spans with <b>
+	and @highlight_spans with <h>. Spans whose windows overlap share a snippet.
+	Return a list of marked up snippets, or None if there are no spans.
+	"""
+	spans = sorted([(s, e, "b") for s, e in bold_spans] + [(s, e, "h") for s, e in highlight_spans])
+	if len(spans)==0:
+		return None
+
+	# cluster spans, each cluster keeps the spans it covers
+	clusters = []  # [[start, end, [(s, e, tag), ...]], ...]
+	for s, e, tag in spans:
+		if clusters and s <= clusters[-1][1] + window * 2:
+			clusters[-1][1] = max(clusters[-1][1], e)
+			clusters[-1][2].append((s, e, tag))
+		else:
+			clusters.append([s, e, [(s, e, tag)]])
 
 	snippets = []
-	for cluster_start, cluster_end in clusters:
+	for cluster_start, cluster_end, members in clusters[:max_snippets]:
+		# long chunk spans would swallow the note, cap the snippet length
 		snippet_start = max(0, cluster_start - window)
-		snippet_end = min(len(text), cluster_end + window)
-		snippet_text = text[snippet_start:snippet_end]
-
-		def shift(tags):
-			out = []
-			for tag in tags:
-				if tag[0] < snippet_start or tag[0] > snippet_end:
-					continue
-				out.append((tag[0]-snippet_start, tag[1], tag[2]))
-			return out
+		snippet_end = min(len(text), cluster_end + window, snippet_start + window * 6)
 
-		snippet_tags = shift(tags)
-		# if snippet_tags==[]:
-		# 	return ""
-
-		def to_marker(tag):
-			return f"<{tag[2]}>" if tag[1]==0 else f"</{tag[2]}>"
+		# markers clipped to the snippet, closing before opening at the same position
+		tags = []
+		for s, e, tag in members:
+			s, e = max(s, snippet_start), min(e, snippet_end)
+			if s < e:
+				tags.append((s, 1, f"<{tag}>"))
+				tags.append((e, 0, f"</{tag}>"))
+		tags.sort()
 
 		result = []
-		pos = snippet_tags[0][0]
-		result.append(snippet_text[0:pos])
-		result.append(to_marker(snippet_tags[0]))
-		for tag in snippet_tags[1:]:
-			result.append(snippet_text[pos:tag[0]])
-			result.append(to_marker(tag))
-			pos = tag[0]
-		result.append(snippet_text[pos:])
+		pos = snippet_start
+		for p, _, marker in tags:
+			result.append(text[pos:p])
+			result.append(marker)
+			pos = p
+		result.append(text[pos:snippet_end])
 		snippets.append(''.join(result))
 
 	return snippets
 
 
-async def vsearch(request, notebookid, keyword, k=10, search_title=True, search_fts=True):
+_offset_tables = collections.OrderedDict()  # cache key --> byte offset to char offset table
+_offset_tables_nbytes = 0
+
+
+def _offset_table(text, cache_key=None):
+	"""
+	Build (or fetch from cache) a table mapping every utf-8 byte offset
+	of @text to its character offset
+	"""
+	global _offset_tables_nbytes
+	if cache_key is not None and cache_key in _offset_tables:
+		_offset_tables.move_to_end(cache_key)
+		return _offset_tables[cache_key]
+
+	# a byte starts a character unless it is a 0b10xxxxxx continuation byte
+	b_text = np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+	table = np.zeros(len(b_text)+1, dtype=np.int32)
+	np.cumsum((b_text & 0xC0) != 0x80, out=table[1:])
+
+	if cache_key is not None:
+		_offset_tables[cache_key] = table
+		_offset_tables_nbytes += table.nbytes
+		while _offset_tables_nbytes > config.SNIPPET_OFFSET_CACHE_BYTES and _offset_tables:
+			_, evicted = _offset_tables.popitem(last=False)
+			_offset_tables_nbytes -= evicted.nbytes
+	return table
+
+
+def _offset_table_key(notebookid, noteid, lastedit, text):
+	"""
+	Cache key of a note's offset table, lastedit has 1 second resolution,
+	the content's length and hash tell apart edits within a second
+	"""
+	return (notebookid, noteid, lastedit, len(text), hash(text))
+
+
+def _parse_positions(text, pos_str, cache_key=None) -> list[list[int, int], ...]:
+	"""
+	convert byte positions to string positions
+	"""
+	if not pos_str:
+		return []
+	b_pos = [int(p) for p in pos_str.replace(';', ',').split(',') if p.strip()]
+	if text.isascii():
+		pos = b_pos
+	else:
+		table = _offset_table(text, cache_key)
+		pos = table[np.array(b_pos, dtype=np.int64)].tolist()
+	return [pos[i:i+2] for i in range(0, len(pos)-1, 2)]  # [[start, end], ...]
+
+
+async def _embed_query(keyword, search_title=True):
+	"""
+	Embed a search keyword for content search, and for title search if @search_title
+	"""
+	querys = ['This is a query about: '+keyword+'.']
+	if search_title:
+		querys.append(keyword)
+	return await nlp.asyncGetEmbedLLM(querys)
+
+
+def _vector_candidates(vs, D, I, D2, I2, candidates, chunk_positions):
+	"""
+	Map one query's faiss hits back to notes, adding 'content' and 'title'
+	legs to @candidates and chunk spans to @chunk_positions.
+	Return embedding ids found in the content and title indexes but no longer mapped
+	"""
+	# content matches, later chunks of the same note add less to its score
+	orphan_eids = []
+	content_scores = {}
+	for d, eid in zip(D, I):
+		if eid==-1:
+			continue
+		if eid not in vs.emb_id_map:
+			orphan_eids.append(eid)
+			continue
+		nid, span = vs.emb_id_map[eid]
+		nid = int(nid)
+		chunk_positions.setdefault(nid, []).append(span)
+		content_scores[nid] = content_scores.get(nid, 0.0) + float(d) / math.sqrt(len(chunk_positions[nid]))
+	content_scores = sorted(content_scores.items(), key=lambda item: item[1], reverse=True)
+	for i, (nid, score) in enumerate(content_scores):
+		candidates.setdefault(nid, {})['content'] = (i+1, score)
+
+	# title matches
+	orphan_title_eids = []
+	if I2 is not None:
+		i = 0
+		for d, eid in zip(D2, I2):
+			if eid==-1:
+				continue
+			if eid not in vs.emb_id_map_title:
+				orphan_title_eids.append(eid)
+				continue
+			i += 1
+			candidates.setdefault(int(vs.emb_id_map_title[eid]), {})['title'] = (i, float(d))
+
+	return orphan_eids, orphan_title_eids
+
+
+async def _search_index(vs, content_q, title_q, k, high_recall, t0):
+	"""
+	Search a notebook's faiss indexes with the nprobe and candidate k its
+	tuner picks for the current load, or exhaustively if @high_recall.
+	Call it holding the index lock, @t0 being perf_counter() before waiting for it.
+	Return D, I, D_title, I_title and whether the search was cut down
+	"""
+	tuner = model.NotebookVectorStore.tuner(vs.notebookid)
+	nprobe, k_candidates = tuner.plan(vs, k, high_recall)
+	reduced = not high_recall and tuner.level > 0
+	metrics.vector_searches.inc(mode='high_recall' if high_recall else 'reduced' if reduced else 'full')
+	D, I, D2, I2 = await anyio.to_thread.run_sync(vs.search_batch, content_q, title_q, k_candidates, nprobe)
+	if not high_recall:
+		tuner.observe(vs, time.perf_counter() - t0, n=len(content_q))
+	return D, I, D2, I2, reduced
+
+
+async def vsearch(request, notebookid, keyword, k=10, search_title=True, search_fts=True, fusion=config.RANK_FUSION, weights=config.RANK_WEIGHTS, query_embs=None, snippet_size=0, high_recall=False):
+	"""
+	Hybrid FTS + semantic search within a notebook
+	@query_embs: precomputed query embeddings from _embed_query(), skips the llm call
+	@snippet_size: return snippets with this window around matches instead of full content, 0 to disable
+	@high_recall: probe every inverted list with more candidates, however busy the index is
+	"""
 	result = {}
 	tablename = f"notebook_{notebookid}"
 
 	search_vector = True
-	vs = await model.NotebookVectorStore.getVectorStore(notebookid, request.app.state.db_conn)
+	with tracing.span('vectorstore.get'):
+		vs = await model.NotebookVectorStore.getVectorStore(notebookid, request.app.state.db_conn)
 	if not vs.index or vs.index.ntotal<=0 or not vs.index.is_trained:
 		search_vector = False
 
-	nids = set()
-	cursor = await request.app.state.db_conn.cursor()
-	rows = []
-
-	def _parse_positions(text, pos_str) -> list[list[int, int], ...]:
-		"""
-		convert byte positions to string positions
-		"""
-		if not pos_str:
-			return []
-		codec = 'utf-8'
-		b_text = text.encode(codec)
-
-		positions = []
-		pair = []
-		b_pp = 0
-		pp = 0
-		for s in pos_str.replace(';', ',').split(','):
-			s = s.strip()
-			if len(s)==0:
-				continue
-			b_p = int(s)
-			seg = b_text[b_pp:b_p].decode(codec)
-			p = pp+len(seg)
-			b_pp = b_p
-			pp = p
-			pair.append(p) # [start, end]
-			if len(pair)>=2:
-				positions.append(pair)
-				pair = []
-		return positions
-
-	# fts search
-	if search_fts:
+	async def _fts_leg():
 		tablename_fts = tablename+"_fts"
 		sql1 = f"simple_highlight_pos({tablename_fts}, 0)," if search_title else "'',"
-		sql2 = f"'\"{keyword}\"'" if search_title else f"'-title:\"{keyword}\"'"
-		await cursor.execute(f'''
-			SELECT
-				rowid,
-				rank,
-				{sql1}
-				simple_highlight_pos({tablename_fts}, 1)
-			FROM {tablename_fts}
-			WHERE {tablename_fts} MATCH {sql2}
-			ORDER BY rank
-			LIMIT {k};
-		''')
-		rows = await cursor.fetchmany(size=k)
-
-	# prepare fts positions
-	fts_positions = collections.OrderedDict()
-	for row in rows:
-		docid = int(row[0])
-		fts_positions[docid] = row
-		nids.add(docid)
+		phrase = '"%s"' % keyword.replace('"', '""')
+		match = phrase if search_title else f"-title:{phrase}"
+		async with request.app.state.db_pool.reader() as db_conn:
+			cursor = await db_conn.cursor()
+			try:
+				with metrics.sqlite_query_seconds.time(query='fts_vsearch'):
+					await cursor.execute(f'''
+						SELECT
+							rowid,
+							rank,
+							{sql1}
+							simple_highlight_pos({tablename_fts}, 1)
+						FROM {tablename_fts}
+						WHERE {tablename_fts} MATCH ?
+						ORDER BY rank
+						LIMIT ?;
+					''', (match, k))
+					return await cursor.fetchmany(size=k)
+			finally:
+				await cursor.close()
+
+	async def _run_leg(leg, coro, timeout):
+		with tracing.span(leg) as s:
+			try:
+				return await asyncio.wait_for(coro, timeout)
+			except asyncio.TimeoutError:
+				logger.warning(f"vsearch: {leg} leg timed out after {timeout}s")
+				if s is not None:
+					s.set_attribute('timed_out', True)
+				degraded.append(leg)
+				return None
+			except sqlite3.Error as e:
+				logger.warning(f"vsearch: {leg} leg failed: {e}")
+				if s is not None:
+					s.set_attribute('error', str(e))
+				degraded.append(leg)
+				return None
+
+	async def _skip_leg(value=None):
+		return value
+
+	# fts query and query embedding run concurrently, each bounded by its own timeout
+	degraded = []
+	if query_embs is not None or not search_vector:
+		embed_leg = _skip_leg(query_embs)
+	else:
+		embed_leg = _run_leg('embedding', _embed_query(keyword, search_title), config.SEARCH_EMBED_TIMEOUT)
+	rows, embs = await asyncio.gather(
+		_run_leg('fts', _fts_leg(), config.SEARCH_FTS_TIMEOUT) if search_fts else _skip_leg(),
+		embed_leg,
+	)
+	rows = rows or []
+
+	# collect candidates from every result leg
+	candidates = {}  # noteid --> {leg: (rank, score), ...}
+	fts_positions = {}  # noteid --> (title byte positions, content byte positions)
+	for i, (docid, score, b_pos_title, b_pos_content) in enumerate(rows):
+		nid = int(docid)
+		fts_positions[nid] = (b_pos_title, b_pos_content)
+		candidates.setdefault(nid, {})['fts'] = (i+1, -score)  # fts5 rank is lower-is-better
 
 	# semantic search
-	matches_content = []
-	matches_title = []
+	chunk_positions = {}  # noteid --> [[s, e], ...]
+	orphan_eids = []
+	orphan_title_eids = []
 	if search_vector:
-		querys = ['This is a query about: '+keyword+'.']
-		if search_title:
-			querys.append(keyword)
-		embs = await nlp.asyncGetEmbedLLM(querys)
 		if not embs:
 			search_vector = False
-			print("llm server down!")
+			logger.warning("llm server down!")
 		else:
-			D, I = vs.search([embs[0]], k=k)
-			D = D[0]
-			I = I[0]
-			matches_content = [vs.emb_id_map[i] for i in I if i!=-1 and i in vs.emb_id_map]  # [(nid, [s, e]), ...]
-			nids = {int(m[0]) for m in matches_content}  # set()
-			orphan_eids = [i for i in I if i!=-1 and i not in vs.emb_id_map]
-			if len(orphan_eids)>0:
-				print("remove orphan eids:", orphan_eids)
-				vs.index.remove_ids(vs._conv_nparray(orphan_eids))
-				vs.modifies += len(orphan_eids)
-
-			D2, I2 = None, None
-			if search_title:
-				D2, I2 = vs.search_title([embs[1]], k=k)
-				D2 = D2[0]
-				I2 = I2[0]
-				matches_title = [int(vs.emb_id_map_title[i]) for i in I2 if i!=-1 and i in vs.emb_id_map_title]  # [nid, ...]
-				nids.update(matches_title)
-				orphan_title_eids = [i for i in I2 if i!=-1 and i not in vs.emb_id_map_title]
-				if len(orphan_title_eids)>0:
-					print("remove orphan title eids:", orphan_title_eids)
-					vs.index_title.remove_ids(vs._conv_nparray(orphan_title_eids))
-					vs.modifies += len(orphan_title_eids)
+			with tracing.span('vector'):
+				# hold the index lock until orphan ids are dropped, so no add/remove interleaves
+				t0 = time.perf_counter()
+				async with model.NotebookVectorStore.hold(notebookid, request.app.state.db_conn, track_use=False) as vs:
+					# content and title searches share one trip off the event loop
+					D, I, D2, I2, reduced = await _search_index(vs, [embs[0]], embs[1:], k, high_recall, t0)
+					if reduced:
+						degraded.append('nprobe')
+					orphan_eids, orphan_title_eids = _vector_candidates(vs, D[0], I[0],
+						D2[0] if search_title else None, I2[0] if search_title else None,
+						candidates, chunk_positions)
+					if len(orphan_eids)>0:
+						logger.info("remove orphan eids: %s", orphan_eids)
+						vs.index.remove_ids(vs._conv_nparray(orphan_eids))
+						vs.modifies += len(orphan_eids)
+					if len(orphan_title_eids)>0:
+						logger.info("remove orphan title eids: %s", orphan_title_eids)
+						vs.index_title.remove_ids(vs._conv_nparray(orphan_title_eids))
+						vs.modifies += len(orphan_title_eids)
 
 	# fetch all related notes
-	nids = ','.join([str(nid) for nid in nids])
-	await cursor.execute(f'''
-		SELECT
-			docid,
-			title,
-			content,
-			CAST(strftime('%s', lastedit) AS INTEGER),
-			meta
-		FROM {tablename}
-		WHERE docid in ({nids});
-	''')
-	rows = await cursor.fetchall()
-	await cursor.close()
+	nids = ','.join([str(nid) for nid in candidates])
+	with tracing.span('fetch_notes'):
+		async with request.app.state.db_pool.reader() as db_conn:
+			cursor = await db_conn.cursor()
+			with metrics.sqlite_query_seconds.time(query='fetch_notes'):
+				await cursor.execute(f'''
+					SELECT
+						docid,
+						title,
+						content,
+						CAST(strftime('%s', lastedit) AS INTEGER),
+						meta
+					FROM {tablename}
+					WHERE docid in ({nids});
+				''')
+				rows = await cursor.fetchall()
+			await cursor.close()
 
 	fetched_notes = {}
 	for row in rows:
 		docid = int(row[0])
 		fetched_notes[docid] = row
 
-	# prepare fts search results
-	fts_rank = collections.OrderedDict()
-	if search_fts:
-		for i, (nid, score, b_pos_title, b_pos_content) in enumerate(fts_positions.values()):
-			if nid not in fetched_notes:
-				# if we recently deleted a note and fts index hasn't updated yet
-				continue
-			row = fetched_notes[nid]
-			title = row[1]
-			content = row[2]
-			str_pos_title = _parse_positions(title, b_pos_title)
-			str_pos_content = _parse_positions(content, b_pos_content)
-			fts_rank[nid] = {
-				'rank': i+1,
-				'score': score,
-				'noteid': nid,
-				'title': title,
-				'title_pos': str_pos_title,
-				'content_pos': str_pos_content,
-			}
+	with tracing.span('merge'):
+		# drop notes deleted since their index entries were written, then rank everything in one pass
+		candidates = {nid: legs for nid, legs in candidates.items() if nid in fetched_notes}
+		ranked = ranking.fuse(candidates, k, method=fusion, weights=weights)
 
-	# prepare content semantic search results
-	content_rank = collections.OrderedDict()
-	if search_vector:
-		for i, (nid, [s, e]) in enumerate(matches_content):
-			if nid not in fetched_notes:
-				# nid has been deleted
-				continue
-			row = fetched_notes[nid]
-			if nid in content_rank:
-				r = content_rank[nid]
-				r['chunk_pos'].append([s, e])
-				r['score'] += float(D[i]) / math.sqrt(len(r['chunk_pos']))
-			else:
-				content_rank[nid] = {
-					'score': float(D[i]),
-					'noteid': nid,
-					'title': row[1],
-					'chunk_pos': [[s, e]],
-				}
-		content_rank = collections.OrderedDict(collections.OrderedDict(sorted(content_rank.items(), key=lambda item: item[1]['score'], reverse=True)))
-		for i, v in enumerate(content_rank.values()):
-			v['rank'] = i+1
-
-	# prepare title semantic search results
-	title_rank = collections.OrderedDict()
-	if search_vector and search_title:
-		for i, nid in enumerate(matches_title):
-			if nid not in fetched_notes:
-				# nid has been deleted
-				continue
+		merged_rank = []
+		for i, (nid, score) in enumerate(ranked):
 			row = fetched_notes[nid]
-			title_rank[nid] = {
+			legs = candidates[nid]
+			r = {
 				'rank': i+1,
-				'score': float(D2[i]),
+				'score': score,
 				'noteid': nid,
 				'title': row[1],
+				'lastedit': row[3],
 			}
+			if 'fts' in legs:
+				b_pos_title, b_pos_content = fts_positions[nid]
+				r['fts_score'] = legs['fts'][1]
+				r['title_pos'] = _parse_positions(row[1], b_pos_title)
+				r['content_pos'] = _parse_positions(row[2], b_pos_content, cache_key=_offset_table_key(notebookid, nid, row[3], row[2]))
+			if 'content' in legs:
+				r['vscore'] = legs['content'][1]
+				r['chunk_pos'] = chunk_positions[nid]
+			if search_vector and search_title:
+				r['title_vmatch'] = 'title' in legs
+				if 'title' in legs:
+					r['title_vscore'] = legs['title'][1]
+			if snippet_size > 0:
+				r['snippets'] = snippet(row[2], r.get('content_pos', []), r.get('chunk_pos', []), window=snippet_size) \
+					or [row[2][:snippet_size*2]]
+			else:
+				r['content'] = row[2]
+			merged_rank.append(r)
 
-	# merge both content and title semantic search results
-	result_semantic = collections.OrderedDict()
-	if search_vector and content_rank:
-		result_content = content_rank
-		if title_rank:
-			result_title = title_rank
-			for k, v in result_content.items():
-				v2 = v.copy()
-				if k in result_title:
-					v2['score'] += result_title[k]['score']/2
-					v2['title_vmatch'] = True
-				else:
-					v2['title_vmatch'] = False
-				result_semantic[k] = v2
-			for k, v in result_title.items():
-				if k in result_semantic:
-					continue
-				v2 = v.copy()
-				v2['score'] /= 2
-				v2['title_vmatch'] = True
-				result_semantic[k] = v2
-			result_semantic = collections.OrderedDict(collections.OrderedDict(sorted(result_semantic.items(), key=lambda item: item[1]['score'], reverse=True)))
-
-	# merge fts result with semantic result
-	merged_rank = []
-	i = 0
-
-	# first take 3/5 of FTS results
-	split_idx = int(k*3/5) if search_vector else k
-	for k, v in fts_rank.items():
-		v2 = v.copy()
-		v2['rank'] = i+1
-		if k in result_semantic:
-			v3 = result_semantic.pop(k)
-			v2['vscore'] = v3['score']
-			if 'chunk_pos' in v3:
-				v2['chunk_pos'] = v3['chunk_pos']
-			if 'title_vmatch' in v3:
-				v2['title_vmatch'] = v3['title_vmatch']
-		merged_rank.append(v2)
-		i += 1
-		if i>=split_idx:
-			break
-
-	# fill the rest with semantic results
-	for k, v in result_semantic.items():
-		v2 = v.copy()
-		v2['rank'] = i+1
-		v2['vscore'] = v2.pop('score')
-		if k in fts_rank:
-			v3 = fts_rank.pop(k)
-			v2['score'] = v3['score']
-			v2['title_pos'] = v3['score']
-			v2['content_pos'] = v3['content_pos']
-		merged_rank.append(v2)
-		i += 1
-		if i>=k:
-			break
-
-	# add text content to merged results
-	for r in merged_rank:
-		row = fetched_notes[r['noteid']]
-		r['content'] = row[2]
-		r['lastedit'] = row[3]
-		# chunk_pos = r.get('chunk_pos', [])
-		# content_pos = r.get('content_pos', [])
-		# r['snippet'] = snippet(fetched_notes[r['noteid']][2], content_pos, chunk_pos, window=100)
-
+	result['fusion'] = fusion
+	result['degraded'] = degraded
 	result['ranking'] = merged_rank
 
 	# setup vector index rebuild task for background workers
-	if search_vector:
-		if len(orphan_eids)>0 or len(orphan_title_eids):
-			await model.NotebookVectorStore.saveDB(request.app.state.db_conn, vs, notebookid)
-			await request.app.state.rebuild_queue.put(notebookid)
+	if len(orphan_eids)>0 or len(orphan_title_eids)>0:
+		await request.app.state.write_queue.submit(notebookid=notebookid)
+		await request.app.state.rebuild_queue.put(notebookid)
 
 	return result
+
+
+async def vsearch_batch(request, keywords, notebookids, k=10, search_title=True, fusion=config.RANK_FUSION, weights=config.RANK_WEIGHTS, high_recall=False):
+	"""
+	Semantic search for many queries at once.
+	All queries are embedded in one llm call, and each notebook is searched
+	with one faiss call over the matrix of its queries.
+	@notebookids: notebook to search for each keyword
+	@high_recall: probe every inverted list with more candidates, however busy the index is
+	"""
+	assert len(keywords)==len(notebookids)
+	n = len(keywords)
+	querys = ['This is a query about: '+keyword+'.' for keyword in keywords]
+	if search_title:
+		querys.extend(keywords)
+	embs = await nlp.asyncGetEmbedLLM(querys)
+	if not embs:
+		logger.warning("llm server down!")
+		return None
+
+	# group queries by notebook
+	groups = {}  # notebookid --> [query index, ...]
+	for qi, notebookid in enumerate(notebookids):
+		groups.setdefault(notebookid, []).append(qi)
+
+	results = [None] * n
+	for notebookid, qis in groups.items():
+		content_q = [embs[qi] for qi in qis]
+		title_q = [embs[n+qi] for qi in qis] if search_title else None
+		# load it before the clock starts, the tuner only times waiting for the index and searching it
+		await model.NotebookVectorStore.getVectorStore(notebookid, request.app.state.db_conn)
+		t0 = time.perf_counter()
+		async with model.NotebookVectorStore.hold(notebookid, request.app.state.db_conn, track_use=False) as vs:
+			if not vs.index or vs.index.ntotal<=0 or not vs.index.is_trained:
+				for qi in qis:
+					results[qi] = {'query': keywords[qi], 'notebookid': notebookid, 'fusion': fusion, 'ranking': []}
+				continue
+			D, I, D2, I2, _ = await _search_index(vs, content_q, title_q, k, high_recall, t0)
+
+			# map embedding ids back to notes
+			per_query = []
+			for row in range(len(qis)):
+				candidates = {}
+				chunk_positions = {}
+				_vector_candidates(vs, D[row], I[row],
+					D2[row] if search_title else None, I2[row] if search_title else None,
+					candidates, chunk_positions)
+				per_query.append((candidates, chunk_positions))
+
+		# fetch titles of every matched note in this notebook at once
+		nids = {nid for candidates, _ in per_query for nid in candidates}
+		async with request.app.state.db_pool.reader() as db_conn:
+			cursor = await db_conn.cursor()
+			with metrics.sqlite_query_seconds.time(query='fetch_titles'):
+				await cursor.execute(f'''
+					SELECT
+						docid,
+						title,
+						CAST(strftime('%s', lastedit) AS INTEGER)
+					FROM notebook_{notebookid}
+					WHERE docid in ({','.join([str(nid) for nid in nids])});
+				''')
+				fetched_notes = {int(row[0]): row for row in await cursor.fetchall()}
+			await cursor.close()
+
+		for qi, (candidates, chunk_positions) in zip(qis, per_query):
+			candidates = {nid: legs for nid, legs in candidates.items() if nid in fetched_notes}
+			ranked_notes = []
+			for i, (nid, score) in enumerate(ranking.fuse(candidates, k, method=fusion, weights=weights)):
+				legs = candidates[nid]
+				r = {
+					'rank': i+1,
+					'score': score,
+					'noteid': nid,
+					'title': fetched_notes[nid][1],
+					'lastedit': fetched_notes[nid][2],
+				}
+				if 'content' in legs:
+					r['vscore'] = legs['content'][1]
+					r['chunk_pos'] = chunk_positions[nid]
+				if search_title:
+					r['title_vmatch'] = 'title' in legs
+					if 'title' in legs:
+						r['title_vscore'] = legs['title'][1]
+				ranked_notes.append(r)
+			results[qi] = {'query': keywords[qi], 'notebookid': notebookid, 'fusion': fusion, 'ranking': ranked_notes}
+
+	return results
+
+
+# result fields holding the raw score of each leg
+LEG_SCORES = {'fts': 'fts_score', 'content': 'vscore', 'title': 'title_vscore'}
+
+
+def _merge_rankings(results, k, fusion=config.RANK_FUSION, weights=config.RANK_WEIGHTS):
+	"""
+	Rank the results of several notebooks in one fusion over their raw leg scores,
+	each notebook's fused scores are relative to its own candidates.
+	Return the global top-@k, ranks and scores rewritten.
+	"""
+	candidates = {i: {} for i in range(len(results))}  # noteids repeat across notebooks, key by position
+	for leg, field in LEG_SCORES.items():
+		scored = sorted((i for i, r in enumerate(results) if field in r), key=lambda i: results[i][field], reverse=True)
+		for rank, i in enumerate(scored):
+			candidates[i][leg] = (rank+1, results[i][field])
+
+	merged_rank = []
+	for rank, (i, score) in enumerate(ranking.fuse(candidates, k, method=fusion, weights=weights)):
+		r = results[i]
+		r['rank'], r['score'] = rank+1, score
+		merged_rank.append(r)
+	return merged_rank
+
+
+async def federated_search(request, notebookids, keyword, k=10, search_title=True, search_fts=True, fusion=config.RANK_FUSION, weights=config.RANK_WEIGHTS, budget=config.SEARCH_FEDERATED_BUDGET, snippet_size=0, high_recall=False):
+	"""
+	Search all @notebookids concurrently with one shared query embedding,
+	then merge each notebook's top-k into a global top-k.
+	Notebooks that don't finish within @budget seconds are left out
+	and listed as incomplete, those searched in a reduced way are
+	listed with how in degraded_notebooks.
+	"""
+	loop = asyncio.get_running_loop()
+	deadline = loop.time() + budget
+
+	# embed the query once for every notebook
+	query_embs = None
+	degraded = []
+	try:
+		query_embs = await asyncio.wait_for(_embed_query(keyword, search_title), min(config.SEARCH_EMBED_TIMEOUT, budget))
+	except asyncio.TimeoutError:
+		logger.warning("federated search: embedding timed out")
+	if not query_embs:
+		degraded.append('embedding')
+		query_embs = []  # fts only, don't let every notebook retry the llm
+
+	tasks = {
+		asyncio.create_task(vsearch(request, nbid, keyword, k=k, search_title=search_title, search_fts=search_fts,
+			fusion=fusion, weights=weights, query_embs=query_embs, snippet_size=snippet_size, high_recall=high_recall)): nbid
+		for nbid in notebookids
+	}
+	done, pending = await asyncio.wait(tasks, timeout=max(0, deadline-loop.time()))
+	for task in pending:
+		task.cancel()
+
+	results = []
+	timedout = [tasks[task] for task in pending]
+	degraded_notebooks = {}  # str(notebookid) --> what each notebook's search left out
+	for task in done:
+		nbid = tasks[task]
+		if task.exception():
+			logger.warning(f"federated search: notebook#{nbid} failed: {task.exception()!r}")
+			timedout.append(nbid)
+			continue
+		if task.result()['degraded']:
+			degraded_notebooks[str(nbid)] = task.result()['degraded']
+		for r in task.result()['ranking']:
+			r['notebookid'] = nbid
+			results.append(r)
+	merged_rank = _merge_rankings(results, k, fusion, weights)
+
+	return {
+		'query': keyword,
+		'fusion': fusion,
+		'degraded': degraded,
+		'notebooks': len(notebookids),
+		'incomplete': timedout,
+		'degraded_notebooks': degraded_notebooks,
+		'ranking': merged_rank,
+	}
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+import aiosqlite
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import model
+
+
+@pytest.fixture
+def anyio_backend():
+	return 'asyncio'
+
+
+@pytest.fixture
+async def db_conn(tmp_path):
+	"""
+	A database with notebook#1 and its FTS index,
+	on sqlite's default tokenizer instead of libsimple
+	"""
+	conn = await aiosqlite.connect(tmp_path / 'test.db')
+	await model.Notebook.initDB(conn)
+	await model.db_init_table_fts(conn, 'notebook_1')
+	await conn.commit()
+	yield conn
+	await conn.close()
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+	"""
+	The backend app without its lifespan, tests set up app.state themselves
+	"""
+	(tmp_path / 'static').mkdir()
+	monkeypatch.chdir(tmp_path)
+	import main
+	return main.app
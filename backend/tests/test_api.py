@@ -0,0 +1,117 @@
+import json
+import types
+
+import pytest
+import httpx
+import starlette.requests
+
+import config
+import model
+import search
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_fts_stats(app, db_conn):
+	app.state.db_pool = model.DBPool(db_conn, [db_conn])
+	async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+		resp = await client.get('/api/stats/fts')
+	assert resp.status_code == 200
+	stats = resp.json()['content']
+	assert list(stats) == ['1']
+	assert stats['1']['segments'] >= 1
+	assert stats['1']['merge_steps'] == 0
+
+
+async def _post_batch(app, payload, uid=1):
+	import main
+	body = json.dumps(payload).encode()
+
+	async def receive():
+		return {'type': 'http.request', 'body': body, 'more_body': False}
+	request = starlette.requests.Request({
+		'type': 'http', 'method': 'POST', 'path': '/api/note/vsearch', 'query_string': b'',
+		'headers': [(b'content-type', b'application/json')], 'app': app,
+		'user': types.SimpleNamespace(uid=uid, is_authenticated=True),
+	}, receive)
+	resp = await main.vector_search_batch.__wrapped__(request)
+	return resp.status_code, json.loads(resp.body)
+
+
+@pytest.fixture
+def batch_calls(app, db_conn, monkeypatch):
+	calls = []
+
+	async def vsearch_batch(request, keywords, notebookids, **kwargs):
+		calls.append({'notebookids': notebookids, **kwargs})
+		return [{'query': kw, 'notebookid': nbid, 'fusion': kwargs['fusion'], 'ranking': []} for kw, nbid in zip(keywords, notebookids)]
+
+	monkeypatch.setattr(search, 'vsearch_batch', vsearch_batch)
+	app.state.db_pool = model.DBPool(db_conn, [db_conn])
+	return calls
+
+
+async def test_vsearch_batch_fusion(app, batch_calls):
+	status, _ = await _post_batch(app, {'kws': ['a', 'b'], 'notebookids': [1]})
+	assert status == 200
+	status, _ = await _post_batch(app, {'kws': ['a'], 'notebookids': [1], 'fusion': 'rrf', 'weights': {'title': 2}})
+	assert status == 200
+	status, _ = await _post_batch(app, {'kws': ['a'], 'notebookids': [1], 'weights': {'title': -1}})
+	assert status == 400
+	assert batch_calls[0]['fusion'] == config.RANK_FUSION and batch_calls[0]['weights'] == config.RANK_WEIGHTS
+	assert batch_calls[1]['fusion'] == 'rrf' and batch_calls[1]['weights'] == {**config.RANK_WEIGHTS, 'title': 2.0}
+
+
+async def test_vsearch_batch_checks_notebooks(app, db_conn, batch_calls):
+	await db_conn.execute("INSERT INTO Notebooks (nbid, owner, meta) VALUES (2, 2, '{}');")
+	await db_conn.commit()
+	status, body = await _post_batch(app, {'kws': ['a', 'b'], 'notebookids': [1, 99]})
+	assert (status, body['content']) == (404, {'notebookids': [99]})
+	status, body = await _post_batch(app, {'kws': ['a'], 'notebookids': [2]})
+	assert (status, body['content']) == (404, {'notebookids': [2]})
+	status, _ = await _post_batch(app, {'kws': ['a'], 'notebookids': [2]}, uid=2)
+	assert status == 200
+	assert [call['notebookids'] for call in batch_calls] == [[2]]
+
+	async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+		resp = await client.post('/api/note/vsearch', json={'kws': ['a'], 'notebookids': [1]})
+	assert resp.json()['status'] == "login required"
+
+
+async def test_import_requires_login(app):
+	async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+		resp = await client.post('/api/note/1/import', content=b'{"title": "t", "textcontent": "c"}\n')
+		assert resp.json()['status'] == "login required"
+		resp = await client.get('/api/note/1/import/abc')
+		assert resp.json()['status'] == "login required"
+
+
+async def _get_notebook(app, query_string):
+	import main
+	request = starlette.requests.Request({
+		'type': 'http', 'method': 'GET', 'path': '/api/notebook/1', 'headers': [],
+		'query_string': query_string.encode(), 'path_params': {'notebookid': 1}, 'app': app,
+	})
+	resp = await main.get_notebook.__wrapped__(request)
+	assert resp.status_code == 200
+	return json.loads(resp.body)['content']
+
+
+async def test_get_notebook_cursor_round_trip(app, db_conn, monkeypatch):
+	app.state.db_pool = model.DBPool(db_conn, [db_conn])
+	monkeypatch.setattr(model, 'note_counts', {})
+	monkeypatch.setattr(model, 'note_counts_gen', {})
+	# pairs of notes edited in the same second, the cursor must not skip or repeat one of a pair
+	await model.Note.db_insert_many(db_conn, 1, [(f't{i}', f'c{i}', 1700000000 + i // 2) for i in range(7)])
+	await db_conn.commit()
+	cursor = await db_conn.execute("SELECT docid FROM notebook_1 ORDER BY lastedit DESC, docid DESC;")
+	expected = [docid for docid, in await cursor.fetchall()]
+	await cursor.close()
+
+	page = await _get_notebook(app, 'pagesize=2')
+	assert page['total_n'] == len(expected)
+	noteids = [n['noteid'] for n in page['notes']]
+	while page['next_cursor']:
+		page = await _get_notebook(app, f"pagesize=2&cursor={page['next_cursor']}")
+		noteids += [n['noteid'] for n in page['notes']]
+	assert noteids == expected
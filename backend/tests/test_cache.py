@@ -0,0 +1,50 @@
+import httpx
+import pytest
+
+import cache
+import model
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def results(monkeypatch):
+	results = cache.ResultCache(max_bytes=1024*1024, max_entries=8)
+	monkeypatch.setattr(cache, 'results', results)
+	return results
+
+
+def test_bump_drops_results_of_the_notebook(results):
+	key1 = results.key('fts', [1], {'kw': 'a'})
+	key12 = results.key('federated', [1, 2], {'kw': 'a'})
+	key2 = results.key('fts', [2], {'kw': 'a'})
+	for key in (key1, key12, key2):
+		results.put(key, {'ranking': [key[0]]})
+	results.bump(1)
+	assert results.get(key1) is None and results.get(key12) is None
+	assert results.get(key2) == {'ranking': ['fts']}
+	assert results.get(results.key('fts', [1], {'kw': 'a'})) is None
+	assert results.info()['invalidations'] == 2
+
+
+def test_put_after_bump_is_dropped(results):
+	# the query started before the notebook changed
+	key = results.key('fts', [1], {'kw': 'a'})
+	results.bump(1)
+	results.put(key, {'ranking': []})
+	assert results.info()['entries'] == 0
+
+
+async def test_note_write_invalidates_results(app, db_conn, results):
+	app.state.db_conn = db_conn
+	key = results.key('fts', [1], {'kw': 'hello'})
+	results.put(key, {'ranking': [{'noteid': 1}]})
+	assert results.get(results.key('fts', [1], {'kw': 'hello'})) is not None
+
+	async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+		resp = await client.post('/api/note/1/1/update', json={'notebookid': 1, 'noteid': 1, 'title': 'bye', 'textcontent': 'world'})
+	assert resp.status_code == 200
+	assert results.get(results.key('fts', [1], {'kw': 'hello'})) is None
+	assert results.get(key) is None
+	note = await model.Note.db_load(db_conn, 1, 1)
+	assert note.title == 'bye'
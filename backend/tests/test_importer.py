@@ -0,0 +1,173 @@
+import io
+import json
+import types
+import asyncio
+import zipfile
+import collections
+
+import pytest
+import aiosqlite
+import starlette.requests
+
+import config
+import model
+import exporter
+import importer
+
+pytestmark = pytest.mark.anyio
+
+
+def _zip(members, compression=zipfile.ZIP_DEFLATED):
+	buf = io.BytesIO()
+	with zipfile.ZipFile(buf, 'w', compression=compression) as zf:
+		for name, data in members.items():
+			zf.writestr(name, data)
+	buf.seek(0)
+	return buf
+
+
+def test_iter_zip_records():
+	buf = _zip({
+		'b.md': 'second note',
+		'a.ndjson': '{"title": "t1", "textcontent": "c1"}\n\n{"title": "t2", "textcontent": "c2"}\n',
+		'image.png': b'\x89PNG',
+	})
+	records = list(importer._iter_zip(buf))
+	assert records[:2] == [b'{"title": "t1", "textcontent": "c1"}\n', b'{"title": "t2", "textcontent": "c2"}\n']
+	assert records[2]['title'] == 'b' and records[2]['textcontent'] == 'second note'
+	assert len(records) == 3
+
+
+def test_iter_zip_rejects_bomb():
+	buf = _zip({'bomb.txt': b'\0' * (config.IMPORT_ZIP_READ_SIZE * 64)})
+	with pytest.raises(zipfile.BadZipFile, match="compressed over"):
+		list(importer._iter_zip(buf))
+
+
+def test_iter_zip_rejects_large_member(monkeypatch):
+	monkeypatch.setattr(config, 'IMPORT_ZIP_MAX_MEMBER_SIZE', 1000)
+	buf = _zip({'big.md': 'x' * 1001}, compression=zipfile.ZIP_STORED)
+	with pytest.raises(zipfile.BadZipFile, match="uncompressed"):
+		list(importer._iter_zip(buf))
+
+
+def test_iter_zip_rejects_many_members(monkeypatch):
+	monkeypatch.setattr(config, 'IMPORT_ZIP_MAX_MEMBERS', 2)
+	buf = _zip({f'{i}.md': 'note' for i in range(3)})
+	with pytest.raises(zipfile.BadZipFile, match="files"):
+		list(importer._iter_zip(buf))
+
+
+@pytest.fixture
+async def import_app(db_conn, tmp_path, monkeypatch):
+	"""
+	App state for ingest() without a request writer, imports open their own connection
+	"""
+	async def db_connect(db_path, readonly=False):
+		return await aiosqlite.connect(db_path)
+
+	await model.Imports.initDB(db_conn)
+	await db_conn.commit()
+	monkeypatch.setattr(config, 'DB_PATH', tmp_path / 'test.db')
+	monkeypatch.setattr(model, 'db_connect', db_connect)
+	monkeypatch.setattr(config, 'IMPORT_BATCH_SIZE', 2)
+	state = types.SimpleNamespace(db_conn=None, importing=collections.Counter(), import_queue=asyncio.Queue())
+	return types.SimpleNamespace(state=state)
+
+
+async def _records(n, error=None):
+	for i in range(n):
+		yield {'title': f't{i}', 'textcontent': f'c{i}'}
+	yield b'not json'
+	if error:
+		raise error
+
+
+async def _count_notes(db_conn):
+	cursor = await db_conn.execute("SELECT count(*) FROM notebook_1;")
+	n, = await cursor.fetchone()
+	await cursor.close()
+	return n
+
+
+async def test_ingest_interrupted_reports_committed_records(import_app, db_conn):
+	job = await model.Imports.start(db_conn, 'imp', 1)
+	await db_conn.commit()
+	job = await importer.ingest(import_app, job, _records(3, starlette.requests.ClientDisconnect()))
+	# the third note and the invalid record were in the dropped batch
+	assert (job['status'], job['n_records'], job['n_inserted'], job['n_invalid'], job['errors']) == ('interrupted', 2, 2, 0, [])
+	saved = await model.Imports.load(db_conn, 'imp')
+	assert (saved['status'], saved['n_records'], saved['n_inserted']) == ('interrupted', 2, 2)
+	assert await _count_notes(db_conn) == 3
+	assert import_app.state.import_queue.qsize() == 2
+
+	# resuming skips the committed records
+	job = await model.Imports.start(db_conn, 'imp', 1)
+	await db_conn.commit()
+	job = await importer.ingest(import_app, job, _records(3))
+	assert (job['status'], job['n_records'], job['n_inserted'], job['n_invalid']) == ('done', 4, 3, 1)
+	cursor = await db_conn.execute("SELECT rowid FROM notebook_1_fts WHERE notebook_1_fts MATCH 't2';")
+	assert await cursor.fetchall() == [(4,)]
+	await cursor.close()
+
+
+async def test_ingest_failure_keeps_committed_batches(import_app, db_conn):
+	job = await model.Imports.start(db_conn, 'imp', 1)
+	await db_conn.commit()
+	with pytest.raises(RuntimeError):
+		await importer.ingest(import_app, job, _records(3, RuntimeError("broken stream")))
+	assert (job['status'], job['n_records'], job['n_inserted']) == ('failed', 2, 2)
+	assert await _count_notes(db_conn) == 3
+	# FTS sync triggers are back
+	await db_conn.execute("INSERT INTO notebook_1 (title, content, lastedit, meta, dirty) VALUES ('later', 'note', CURRENT_TIMESTAMP, '{}', 1);")
+	cursor = await db_conn.execute("SELECT count(*) FROM notebook_1_fts WHERE notebook_1_fts MATCH 'later';")
+	assert await cursor.fetchone() == (1,)
+	await cursor.close()
+
+
+async def _new_notebook(db_conn, nbid):
+	await db_conn.execute("INSERT INTO Notebooks (nbid, owner, meta) VALUES (?, 1, '{}');", (nbid,))
+	await db_conn.execute(f"CREATE TABLE notebook_{nbid} (docid INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT, content TEXT, lastedit TIMESTAMP, meta TEXT, dirty INTEGER);")
+	await model.db_init_table_fts(db_conn, f'notebook_{nbid}')
+	await db_conn.commit()
+
+
+async def _notes(db_conn, nbid):
+	cursor = await db_conn.execute(f"SELECT title, content, CAST(strftime('%s', lastedit) AS INTEGER), meta, dirty FROM notebook_{nbid} ORDER BY docid;")
+	rows = await cursor.fetchall()
+	await cursor.close()
+	return [(title, content, lastedit, json.loads(meta or '{}')) for title, content, lastedit, meta, _ in rows]
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'zip'])
+async def test_export_import_round_trip(import_app, db_conn, fmt):
+	await db_conn.executemany("INSERT INTO notebook_1 (title, content, lastedit, meta, dirty) VALUES (?, ?, datetime(?, 'unixepoch'), ?, 0);", [
+		('tagged', 'ünïcödé content\nsecond line', 1600000000, json.dumps({'tags': ['a', 'b'], 'n_chunk': 2, 'embed_d': 768})),
+		('plain', 'no meta', 1700000000, None),
+	])
+	await db_conn.commit()
+	export = b''.join([block async for block in exporter.iter_export(1)])
+
+	await _new_notebook(db_conn, 2)
+	if fmt == 'zip':
+		records = importer.iter_zip(_stream(_zip({'export/notes.ndjson': export}).getvalue()))
+	else:
+		records = importer.iter_ndjson(_stream(export))
+	job = await model.Imports.start(db_conn, 'imp', 2)
+	await db_conn.commit()
+	job = await importer.ingest(import_app, job, records)
+	assert (job['status'], job['n_inserted'], job['n_invalid']) == ('done', 3, 0)
+
+	# chunk bookkeeping is not carried over, imported notes are chunked anew
+	expected = [(title, content, lastedit, {k: v for k, v in meta.items() if k not in ('n_chunk', 'embed_d')})
+		for title, content, lastedit, meta in await _notes(db_conn, 1)]
+	assert await _notes(db_conn, 2) == expected
+	assert expected[1][3] == {'tags': ['a', 'b']}
+	cursor = await db_conn.execute("SELECT count(*) FROM notebook_2 WHERE dirty = 1;")
+	assert await cursor.fetchone() == (3,)
+	await cursor.close()
+
+
+async def _stream(data, size=7):
+	for i in range(0, len(data), size):
+		yield data[i:i+size]
@@ -0,0 +1,155 @@
+import json
+import pickle
+
+import numpy as np
+import pytest
+
+import config
+import model
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_db_insert_many_returns_own_docids(db_conn):
+	# notebook#1 starts with one note, which is not part of the import
+	docids = await model.Note.db_insert_many(db_conn, 1, [('t1', 'c1', 0), ('t2', 'c2', None)])
+	assert docids == [2, 3]
+	cursor = await db_conn.execute("SELECT docid, title, dirty, lastedit IS NOT NULL FROM notebook_1 ORDER BY docid;")
+	rows = await cursor.fetchall()
+	assert rows == [(1, 'hello world', 1, 1), (2, 't1', 1, 1), (3, 't2', 1, 1)]
+	assert await model.Note.db_insert_many(db_conn, 1, []) == []
+
+
+async def _legacy_notebook(db_conn):
+	# notebook#1 as stored before the chunks table
+	for column in ('chunk_embs BLOB', 'title_emb BLOB', 'chunk_spans TEXT'):
+		await db_conn.execute(f"ALTER TABLE notebook_1 ADD COLUMN {column};")
+	await db_conn.execute("UPDATE notebook_1 SET chunk_embs = ?, title_emb = ?, chunk_spans = ? WHERE docid = 1;",
+		(pickle.dumps([np.ones(4), np.zeros(4)]), pickle.dumps(np.full(4, 2.0)), json.dumps([[0, 5], [5, 10]])))
+	await model.Chunks.initDB(db_conn)
+
+
+async def _columns(db_conn):
+	cursor = await db_conn.execute("PRAGMA table_info(notebook_1);")
+	columns = {row[1] for row in await cursor.fetchall()}
+	await cursor.close()
+	return columns
+
+
+async def test_chunks_migrate_keeps_legacy_columns(db_conn):
+	await _legacy_notebook(db_conn)
+	await model.Chunks.migrate(db_conn, 1)
+	assert 'chunk_embs' in await _columns(db_conn)
+	assert (await model.Chunks.fetch_title_emb(db_conn, 1, 1)).tolist() == [2.0] * 4
+
+	# migrated once, later starts don't overwrite newer chunks with the old columns
+	await model.Chunks.store(db_conn, 1, 1, np.full(4, 3.0), [np.ones(4)], [[0, 10]])
+	await model.Chunks.migrate(db_conn, 1)
+	assert (await model.Chunks.fetch_title_emb(db_conn, 1, 1)).tolist() == [3.0] * 4
+
+
+async def test_chunks_migrate_drops_columns_when_asked(db_conn, monkeypatch):
+	await _legacy_notebook(db_conn)
+	monkeypatch.setattr(config, 'CHUNKS_DROP_LEGACY_COLUMNS', True)
+	# dropped on a start after the one that copied them
+	await model.Chunks.migrate(db_conn, 1)
+	assert 'chunk_embs' in await _columns(db_conn)
+	await db_conn.commit()
+	await model.Chunks.migrate(db_conn, 1)
+	assert not {'chunk_embs', 'title_emb', 'chunk_spans'} & await _columns(db_conn)
+	assert (await model.Chunks.fetch_title_emb(db_conn, 1, 1)).tolist() == [2.0] * 4
+
+
+def test_fts_varint():
+	assert model._fts_varint(b'\x05', 0) == (5, 1)
+	assert model._fts_varint(b'\x00\x81\x00', 1) == (128, 3)
+	assert model._fts_varint(b'\xff\x7f', 0) == (0x3fff, 2)
+	assert model._fts_varint(b'\xff' * 9, 0) == (2**64 - 1, 9)
+
+
+async def test_db_fts_structure(db_conn):
+	# notebook#1's index was built in one transaction, each commit below adds a segment
+	levels = await model.db_fts_structure(db_conn, 'notebook_1')
+	assert [n for n, _ in levels] == [1]
+	for i in range(3):
+		await model.Note.db_insert_many(db_conn, 1, [(f'title {i}', f'content {i}', None)])
+		await db_conn.commit()
+	levels = await model.db_fts_structure(db_conn, 'notebook_1')
+	assert levels[0][0] == 4
+	segids = [segid for _, segs in levels for segid, _ in segs]
+	assert len(set(segids)) == 4
+	assert all(pages >= 1 for _, segs in levels for _, pages in segs)
+	stats = await model.db_fts_stats(db_conn, 'notebook_1')
+	assert stats['segments'] == 4 and stats['levels'][0] == 4
+
+	await db_conn.execute("INSERT INTO notebook_1_fts(notebook_1_fts) VALUES('optimize');")
+	await db_conn.commit()
+	stats = await model.db_fts_stats(db_conn, 'notebook_1')
+	assert stats['segments'] == 1
+
+
+async def test_db_fts_structure_empty(db_conn):
+	await db_conn.execute("DELETE FROM notebook_1;")
+	await db_conn.execute("INSERT INTO notebook_1_fts(notebook_1_fts) VALUES('rebuild');")
+	await db_conn.commit()
+	levels = await model.db_fts_structure(db_conn, 'notebook_1')
+	assert sum(n for n, _ in levels or []) == 0
+	stats = await model.db_fts_stats(db_conn, 'notebook_1')
+	assert stats['segments'] == 0 and stats['pages'] == 0
+
+
+async def _dirty(db_conn, docid):
+	cursor = await db_conn.execute("SELECT dirty, json_extract(meta, '$.n_chunk') FROM notebook_1 WHERE docid = ?;", (docid,))
+	row = await cursor.fetchone()
+	await cursor.close()
+	return row
+
+
+async def test_db_mark_chunked(db_conn):
+	note = await model.Note.db_load(db_conn, 1, 1)
+	assert await note.db_mark_chunked(db_conn, 3, 768)
+	assert await _dirty(db_conn, 1) == (0, 3)
+
+
+async def test_db_mark_chunked_skips_edited_note(db_conn):
+	note = await model.Note.db_load(db_conn, 1, 1)
+	# edited within the same second as the load
+	await model.Note.db_update(db_conn, 1, 1, 'hello world', 'edited')
+	assert not await note.db_mark_chunked(db_conn, 3, 768)
+	assert await _dirty(db_conn, 1) == (1, None)
+
+	note = await model.Note.db_load(db_conn, 1, 1)
+	await db_conn.execute("DELETE FROM notebook_1 WHERE docid = 1;")
+	assert not await note.db_mark_chunked(db_conn, 3, 768)
+
+
+@pytest.fixture
+def note_counts(monkeypatch):
+	monkeypatch.setattr(model, 'note_counts', {})
+	monkeypatch.setattr(model, 'note_counts_gen', {})
+
+
+async def test_note_count_follows_commits(db_conn, note_counts):
+	assert await model.db_count_notes(db_conn, 1) == 1
+	await model.Note.db_insert(db_conn, 1, 't', 'c')
+	await db_conn.rollback()
+	assert await model.db_count_notes(db_conn, 1) == 1
+	await model.Note.db_insert(db_conn, 1, 't', 'c')
+	await db_conn.commit()
+	model.forget_note_count(1)
+	assert await model.db_count_notes(db_conn, 1) == 2
+	assert model.note_counts == {1: 2}
+
+
+async def test_note_count_not_cached_across_commit(db_conn, note_counts):
+	class Conn():
+		# a commit lands while the count is read
+		async def execute(self, sql):
+			cursor = await db_conn.execute(sql)
+			model.forget_note_count(1)
+			return cursor
+
+	assert await model.db_count_notes(Conn(), 1) == 1
+	assert model.note_counts == {}
+	assert await model.db_count_notes(db_conn, 1) == 1
+	assert model.note_counts == {1: 1}
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+import ranking
+
+WEIGHTS = {'fts': 1.0, 'content': 1.0, 'title': 0.5}
+
+
+def test_fuse_empty():
+	assert ranking.fuse({}, 10) == []
+
+
+@pytest.mark.parametrize('method', list(ranking.FUSIONS))
+def test_fuse_ties_keep_candidate_order(method):
+	candidates = {
+		5: {'content': (1, 0.8)},
+		3: {'content': (1, 0.8)},
+		9: {'content': (1, 0.8)},
+	}
+	ranked = ranking.fuse(candidates, 10, method=method, weights=WEIGHTS)
+	assert [nid for nid, _ in ranked] == [5, 3, 9]
+	assert len({score for _, score in ranked}) == 1
+
+
+@pytest.mark.parametrize('method', list(ranking.FUSIONS))
+def test_fuse_empty_legs(method):
+	# no fts or title results at all, only the content leg counts
+	candidates = {
+		1: {'content': (2, 0.5)},
+		2: {'content': (1, 0.9)},
+	}
+	ranked = ranking.fuse(candidates, 10, method=method, weights=WEIGHTS)
+	assert [nid for nid, _ in ranked] == [2, 1]
+	assert all(np.isfinite(score) for _, score in ranked)
+
+
+@pytest.mark.parametrize('method', list(ranking.FUSIONS))
+def test_fuse_cuts_to_k(method):
+	candidates = {nid: {'fts': (nid, -float(nid))} for nid in range(1, 8)}
+	ranked = ranking.fuse(candidates, 3, method=method, weights=WEIGHTS)
+	assert [nid for nid, _ in ranked] == [1, 2, 3]
+
+
+def test_fuse_rrf_scores():
+	ranks = np.array([[1, 0], [2, 1], [0, 0]], dtype=np.float64)
+	scores = np.full(ranks.shape, np.nan)
+	w = np.array([1.0, 1.0, 0.5])
+	fused = ranking.fuse_rrf(ranks, scores, w, rrf_k=60)
+	assert fused == pytest.approx([1/61 + 1/62, 1/61])
+
+
+def test_fuse_weighted_scores():
+	scores = np.array([
+		[-1.0, -3.0, np.nan],  # fts, normalized over its two candidates
+		[np.nan, 0.7, np.nan],  # a lone candidate counts as a full match
+		[np.nan, np.nan, np.nan],  # empty leg
+	])
+	w = np.array([1.0, 1.0, 0.5])
+	fused = ranking.fuse_weighted(np.zeros(scores.shape), scores, w)
+	assert fused == pytest.approx([1.0, 1.0, 0.0])
+
+
+def test_fuse_weighted_tied_leg():
+	scores = np.array([[0.5, 0.5], [np.nan, np.nan], [np.nan, np.nan]])
+	fused = ranking.fuse_weighted(np.zeros(scores.shape), scores, np.array([1.0, 1.0, 0.5]))
+	assert fused == pytest.approx([1.0, 1.0])
+
+
+def test_fuse_weights():
+	candidates = {
+		1: {'title': (1, 0.9)},
+		2: {'content': (1, 0.9)},
+	}
+	ranked = ranking.fuse(candidates, 10, method='rrf', weights=WEIGHTS)
+	assert [nid for nid, _ in ranked] == [2, 1]
+	ranked = ranking.fuse(candidates, 10, method='rrf', weights={'content': 0.1, 'title': 1.0})
+	assert [nid for nid, _ in ranked] == [1, 2]
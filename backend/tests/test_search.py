@@ -0,0 +1,167 @@
+import asyncio
+import types
+
+import pytest
+
+import model
+import search
+
+pytestmark = pytest.mark.anyio
+
+
+def _result(nbid, degraded=()):
+	return {
+		'fusion': 'rrf',
+		'degraded': list(degraded),
+		'ranking': [{'rank': 1, 'score': 1/61, 'noteid': 1, 'title': f'note of #{nbid}', 'vscore': 0.5}],
+	}
+
+
+@pytest.fixture
+def notebooks(monkeypatch):
+	"""
+	Stub vsearch: #1 complete, #2 reduced nprobe, #3 failing, #4 too slow
+	"""
+	async def _embed_query(keyword, search_title):
+		return [[0.0], [0.0]]
+
+	async def vsearch(request, nbid, keyword, **kwargs):
+		if nbid == 3:
+			raise RuntimeError("broken index")
+		if nbid == 4:
+			await asyncio.sleep(10)
+		return _result(nbid, degraded=['nprobe'] if nbid == 2 else [])
+
+	monkeypatch.setattr(search, '_embed_query', _embed_query)
+	monkeypatch.setattr(search, 'vsearch', vsearch)
+
+
+async def test_federated_search_reports_degraded(notebooks):
+	result = await search.federated_search(None, [1, 2, 3, 4], 'kw', budget=0.2)
+	assert result['degraded'] == []
+	assert sorted(result['incomplete']) == [3, 4]
+	assert result['degraded_notebooks'] == {'2': ['nprobe']}
+	assert sorted(r['notebookid'] for r in result['ranking']) == [1, 2]
+
+
+async def test_federated_search_complete(notebooks):
+	result = await search.federated_search(None, [1], 'kw', budget=0.2)
+	assert result['degraded'] == [] and result['incomplete'] == [] and result['degraded_notebooks'] == {}
+
+
+def test_merge_rankings_by_relevance():
+	# each notebook's own #1 has the same fused score, the raw scores tell them apart
+	results = [
+		{'rank': 1, 'score': 1/61, 'noteid': 7, 'notebookid': 1, 'vscore': 0.2},
+		{'rank': 1, 'score': 1/61, 'noteid': 7, 'notebookid': 2, 'vscore': 0.9},
+		{'rank': 2, 'score': 1/62, 'noteid': 8, 'notebookid': 2, 'vscore': 0.8},
+	]
+	for fusion in ('rrf', 'weighted'):
+		merged = search._merge_rankings([dict(r) for r in results], 3, fusion=fusion)
+		assert [(r['notebookid'], r['noteid']) for r in merged] == [(2, 7), (2, 8), (1, 7)]
+		assert [r['rank'] for r in merged] == [1, 2, 3]
+
+
+def test_merge_rankings_legs_and_k():
+	results = [
+		{'noteid': 1, 'notebookid': 1, 'fts_score': -1.0},
+		{'noteid': 1, 'notebookid': 2, 'fts_score': -3.0, 'vscore': 0.7, 'title_vscore': 0.6},
+	]
+	merged = search._merge_rankings(results, 1, fusion='rrf')
+	assert len(merged) == 1 and merged[0]['notebookid'] == 2
+	assert search._merge_rankings([], 5) == []
+
+
+@pytest.mark.parametrize('keyword, query', [
+	('', ''),
+	('   ', ''),
+	('hel', '"hel"*'),
+	('hello wor', '"hello" "wor"*'),
+	('hello world ', '"hello" "world"'),
+	('say "hi', '"say" """hi"*'),
+	('a"b" OR NOT', '"a""b""" "OR" "NOT"*'),
+	('col:x (y', '"col:x" "(y"*'),
+])
+def test_prefix_query(keyword, query):
+	assert search.prefix_query(keyword) == query
+
+
+@pytest.mark.parametrize('keyword', ['hel', 'say "hi', 'a"b" OR NOT', 'col:x (y', 'hello* -world ', 'NEAR(a b'])
+async def test_prefix_query_is_valid_fts(db_conn, keyword):
+	cursor = await db_conn.execute("SELECT rowid FROM notebook_1_fts WHERE notebook_1_fts MATCH ?;", (search.prefix_query(keyword),))
+	await cursor.fetchall()
+	await cursor.close()
+
+
+async def test_prefix_query_matches(db_conn):
+	cursor = await db_conn.execute("SELECT rowid FROM notebook_1_fts WHERE notebook_1_fts MATCH ?;", (search.prefix_query('hello wor'),))
+	assert await cursor.fetchall() == [(1,)]
+	await cursor.close()
+
+
+def test_parse_positions_non_ascii():
+	text = 'héllo wörld, hello world'
+	b_text = text.encode('utf-8')
+	b_pos = [b_text.index(b'h\xc3\xa9llo'), b_text.index(b' w\xc3\xb6rld'), b_text.rindex(b'world'), len(b_text)]
+	assert search._parse_positions(text, ';'.join(f'{s},{e}' for s, e in zip(b_pos[::2], b_pos[1::2]))) == [[0, 5], [19, 24]]
+	assert search._parse_positions('hello', '0,5') == [[0, 5]]
+	assert search._parse_positions(text, '') == []
+
+
+def test_offset_table_key_tells_apart_edits(monkeypatch):
+	monkeypatch.setattr(search, '_offset_tables', search.collections.OrderedDict())
+	monkeypatch.setattr(search, '_offset_tables_nbytes', 0)
+	# two edits within the same second of lastedit
+	word = 'ünïcödé'
+	b_len = len(word.encode('utf-8'))
+	before = word
+	after = f'{word} and more, {word}'
+	key = search._offset_table_key(1, 1, 100, before)
+	assert search._parse_positions(before, f'0,{b_len}', cache_key=key) == [[0, 7]]
+	key = search._offset_table_key(1, 1, 100, after)
+	b_start = len(f'{word} and more, '.encode('utf-8'))
+	assert search._parse_positions(after, f'0,{b_len};{b_start},{b_start+b_len}', cache_key=key) == [[0, 7], [18, 25]]
+	assert len(search._offset_tables) == 2
+
+
+def test_snippet():
+	text = 'a' * 50 + 'match' + 'b' * 50
+	assert search.snippet(text, [[50, 55]], [], window=5) == ['aaaaa<b>match</b>bbbbb']
+	assert search.snippet(text, [[50, 55]], [[48, 60]], window=2) == ['aa<h>aa<b>match</b>bbb</h>']  # capped at window * 6
+	assert search.snippet(text, [], []) is None
+	spans = [[i, i+1] for i in range(0, 100, 30)]
+	assert len(search.snippet(text, spans, [], window=2, max_snippets=2)) == 2
+
+
+@pytest.fixture
+async def fts_request(db_conn, monkeypatch):
+	"""
+	Request on notebook#1 without a vector index, highlight positions stubbed
+	for the default tokenizer
+	"""
+	async def getVectorStore(notebookid, db_conn):
+		return types.SimpleNamespace(index=None)
+
+	monkeypatch.setattr(model.NotebookVectorStore, 'getVectorStore', getVectorStore)
+	await db_conn.create_function('simple_highlight_pos', 2, lambda fts, col: '')
+	state = types.SimpleNamespace(db_conn=db_conn, db_pool=model.DBPool(db_conn, [db_conn]))
+	return types.SimpleNamespace(app=types.SimpleNamespace(state=state))
+
+
+@pytest.mark.parametrize('search_title', [True, False])
+async def test_vsearch_fts_keyword_is_bound(fts_request, search_title):
+	result = await search.vsearch(fts_request, 1, 'first note', search_title=search_title)
+	assert [r['noteid'] for r in result['ranking']] == [1]
+	result = await search.vsearch(fts_request, 1, 'hello', search_title=search_title)
+	assert [r['noteid'] for r in result['ranking']] == ([1] if search_title else [])
+	for keyword in ("it's", 'say "hi', "'); DROP TABLE notebook_1; --"):
+		result = await search.vsearch(fts_request, 1, keyword, search_title=search_title)
+		assert result['degraded'] == []
+		assert result['ranking'] == []
+
+
+async def test_vsearch_fts_error_degrades(fts_request, db_conn):
+	await db_conn.execute("DROP TABLE notebook_1_fts;")
+	result = await search.vsearch(fts_request, 1, 'hello')
+	assert result['degraded'] == ['fts']
+	assert result['ranking'] == []
@@ -0,0 +1,8 @@
+import json
+
+import utils
+
+
+def test_json_resp_non_str_keys():
+	resp = utils._json_resp(200, "okay", content={1: {'a': 1}})
+	assert json.loads(resp.body) == {'code': 200, 'status': 'okay', 'content': {'1': {'a': 1}}}
@@ -0,0 +1,145 @@
+import asyncio
+import collections
+import types
+
+import numpy as np
+import pytest
+
+import config
+from model.vectorstore import NotebookVectorStore, SearchTuner
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def vs_db(db_conn, monkeypatch):
+	"""
+	Notebooks #1-#3 with a saved vectorstore each, an empty cache of 2 instances
+	and a loadDB that counts its calls
+	"""
+	for name, value in (('cached_vs', collections.OrderedDict()), ('loading', {}), ('locks', {}), ('last_used', {}), ('hydrate_plan', set())):
+		monkeypatch.setattr(NotebookVectorStore, name, value)
+	monkeypatch.setattr(config, 'VECTORSTORE_CACHE_SIZE', 2)
+	await db_conn.executemany("INSERT INTO Notebooks (nbid, owner, meta) VALUES (?, 1, '{}');", [(2,), (3,)])
+	embs = np.random.default_rng(0).standard_normal((4, config.LLM_EMBED_D)).astype(np.float32)
+	for nbid in (1, 2, 3):
+		vs = NotebookVectorStore(notebookid=nbid, nlist=0)
+		vs.add(1, embs, [[0, 1]] * len(embs), embs[0])
+		await NotebookVectorStore.saveDB(db_conn, vs)
+
+	calls = []
+	load = NotebookVectorStore.loadDB
+
+	async def loadDB(db_conn, notebookid):
+		calls.append(notebookid)
+		await asyncio.sleep(0.01)
+		return await load(db_conn, notebookid=notebookid)
+	monkeypatch.setattr(NotebookVectorStore, 'loadDB', loadDB)
+	db_conn.load_calls = calls
+	return db_conn
+
+
+async def _saved(db_conn, nbid):
+	cursor = await db_conn.execute("SELECT vectorstore FROM Notebooks WHERE nbid = ?;", (nbid,))
+	b_obj, = await cursor.fetchone()
+	await cursor.close()
+	return NotebookVectorStore._deserialize(b_obj)
+
+
+async def test_concurrent_gets_share_one_load(vs_db):
+	instances = await asyncio.gather(*[NotebookVectorStore.getVectorStore(1, vs_db) for _ in range(8)])
+	assert vs_db.load_calls == [1]
+	assert len({id(vs) for vs in instances}) == 1
+	assert NotebookVectorStore.loading == {}
+
+
+async def test_cancelled_get_keeps_load_for_others(vs_db):
+	first = asyncio.create_task(NotebookVectorStore.getVectorStore(1, vs_db))
+	second = asyncio.create_task(NotebookVectorStore.getVectorStore(1, vs_db))
+	await asyncio.sleep(0)
+	first.cancel()
+	assert (await second).notebookid == 1
+	assert vs_db.load_calls == [1]
+
+
+async def test_eviction_skips_held_notebooks(vs_db):
+	async with NotebookVectorStore.hold(1, vs_db) as vs1:
+		await NotebookVectorStore.getVectorStore(2, vs_db)
+		await NotebookVectorStore.getVectorStore(3, vs_db)
+		# #1 is the least recently used, but held
+		assert list(NotebookVectorStore.cached_vs) == [1, 3]
+		vs1.remove(1)
+	# the next load evicts #1 and saves the change made while it was held
+	await NotebookVectorStore.getVectorStore(2, vs_db)
+	assert 1 not in NotebookVectorStore.cached_vs
+	assert (await _saved(vs_db, 1)).emb_id_map == {}
+
+
+async def test_hold_reloads_instance_evicted_while_waiting(vs_db):
+	vs1 = await NotebookVectorStore.getVectorStore(1, vs_db)
+	held = []
+
+	async def _hold():
+		async with NotebookVectorStore.hold(1, vs_db) as vs:
+			held.append(vs)
+
+	async with NotebookVectorStore.lock(1):
+		task = asyncio.create_task(_hold())
+		await asyncio.sleep(0.05)
+		# evicted while the holder waits for the lock
+		await NotebookVectorStore.saveDB(vs_db, NotebookVectorStore.cached_vs.pop(1))
+	await task
+	assert held[0] is not vs1
+	assert NotebookVectorStore.cached_vs[1] is held[0]
+
+
+@pytest.fixture
+def tuner(monkeypatch):
+	monkeypatch.setattr(config, 'FAISS_NPROBE_MIN', 1)
+	monkeypatch.setattr(config, 'FAISS_CANDIDATES', 2)
+	monkeypatch.setattr(config, 'FAISS_CANDIDATES_HR', 4)
+	return SearchTuner(target=0.02)
+
+
+def _observe(tuner, vs, seconds, n=SearchTuner.SAMPLES):
+	for _ in range(n):
+		tuner.observe(vs, seconds)
+
+
+def test_search_tuner_degrades_and_recovers(tuner):
+	vs = types.SimpleNamespace(notebookid=1, nprobe=8, nlist=16)
+	assert tuner.plan(vs, 10) == (8, 20)
+	_observe(tuner, vs, 0.05, SearchTuner.SAMPLES - 1)
+	assert tuner.level == 0
+	_observe(tuner, vs, 0.05, 1)
+	assert tuner.level == 1
+	assert tuner.plan(vs, 10) == (4, 10)
+
+	# capped once nprobe is down to FAISS_NPROBE_MIN
+	_observe(tuner, vs, 0.05, SearchTuner.SAMPLES * 5)
+	assert tuner.level == 3
+	assert tuner.plan(vs, 10) == (1, 10)
+
+	# between half the target and the target the level holds
+	_observe(tuner, vs, 0.015)
+	assert tuner.level == 3
+	_observe(tuner, vs, 0.005)
+	assert tuner.level == 2
+	assert tuner.plan(vs, 10) == (2, 10)
+	_observe(tuner, vs, 0.005, SearchTuner.SAMPLES * 5)
+	assert tuner.level == 0
+
+
+def test_search_tuner_batches(tuner):
+	vs = types.SimpleNamespace(notebookid=1, nprobe=8, nlist=16)
+	tuner.observe(vs, 0.05 * SearchTuner.SAMPLES, n=SearchTuner.SAMPLES)
+	assert tuner.level == 1
+	assert tuner.n == 0
+
+
+def test_search_tuner_high_recall(tuner):
+	vs = types.SimpleNamespace(notebookid=1, nprobe=8, nlist=16)
+	_observe(tuner, vs, 0.05)
+	assert tuner.plan(vs, 10, high_recall=True) == (16, 40)
+	vs.nlist = 0
+	assert tuner.plan(vs, 10, high_recall=True) == (1, 40)
@@ -0,0 +1,85 @@
+import types
+
+import pytest
+import aiosqlite
+
+import model
+import worker
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def conns(tmp_path):
+	"""
+	A request handler's writer connection and the write-behind queue's own
+	"""
+	conns = []
+	for _ in range(2):
+		conn = await aiosqlite.connect(tmp_path / 'test.db')
+		await conn.execute("PRAGMA journal_mode = WAL;")
+		await conn.execute("PRAGMA busy_timeout = 5000;")
+		conns.append(conn)
+	await conns[0].execute("CREATE TABLE t (k TEXT PRIMARY KEY);")
+	await conns[0].commit()
+	yield conns
+	for conn in conns:
+		await conn.close()
+
+
+async def _count(conn, k):
+	cursor = await conn.execute("SELECT count(*) FROM t WHERE k = ?;", (k,))
+	n, = await cursor.fetchone()
+	await cursor.close()
+	return n
+
+
+async def test_failed_batch_keeps_other_writes(conns):
+	handler_conn, queue_conn = conns
+	queue = model.WriteBehindQueue(queue_conn)
+
+	async def _write(db_conn):
+		await db_conn.execute("INSERT INTO t VALUES ('batch');")
+
+	async def _fail(db_conn):
+		raise RuntimeError("job failed")
+
+	await queue.submit('a', _write)
+	await queue.submit('b', _fail)
+	await queue.flush()
+	assert queue.stats['failed_commits'] == 1
+
+	# a handler's transaction is neither committed nor rolled back by the batch
+	await handler_conn.execute("INSERT INTO t VALUES ('handler');")
+	await handler_conn.commit()
+	assert await _count(handler_conn, 'batch') == 0
+	assert await _count(handler_conn, 'handler') == 1
+
+
+async def test_handler_commit_leaves_batch_alone(conns):
+	handler_conn, queue_conn = conns
+	queue = model.WriteBehindQueue(queue_conn)
+
+	async def _write(db_conn):
+		await db_conn.execute("INSERT INTO t VALUES ('batch');")
+		# a handler commits and rolls back while the batch is half done
+		await handler_conn.rollback()
+		await handler_conn.commit()
+		assert await _count(handler_conn, 'batch') == 0
+
+	await queue.submit('a', _write)
+	await queue.close()
+	assert queue.stats['commits'] == 1
+	assert await _count(handler_conn, 'batch') == 1
+
+
+async def test_group_commits_count_as_fts_activity(conns):
+	handler_conn, queue_conn = conns
+	app = types.SimpleNamespace(state=types.SimpleNamespace(db_conn=handler_conn, write_queue=model.WriteBehindQueue(queue_conn)))
+	changes = worker._db_changes(app)
+
+	async def _write(db_conn):
+		await db_conn.execute("INSERT INTO t VALUES ('batch');")
+	await app.state.write_queue.submit(job=_write)
+	await app.state.write_queue.flush()
+	assert worker._db_changes(app) > changes
@@ -0,0 +1,510 @@
+"""
+End-to-end load test of the backend.
+
+Boots backend/main.py:app in a subprocess against a temporary database and a
+deterministic stub of the llm server's /embedding endpoint, drives a weighted
+mix of note writes, searches and page reads at a fixed concurrency, and reports
+latency percentiles, requests/sec and how fast the chunk backlog drains.
+Results are saved as JSON and can be compared against an earlier run.
+
+	python tools/loadtest.py --concurrency 16 --duration 30
+	python tools/loadtest.py --mix create=1,vsearch=4 --compare tools/results/baseline.json
+"""
+import os
+import sys
+import ast
+import json
+import math
+import time
+import socket
+import random
+import asyncio
+import hashlib
+import argparse
+import datetime
+import tempfile
+import subprocess
+import collections
+
+import httpx
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "tools", "results")
+DEFAULT_MIX = "create=1,update=2,vsearch=3,quicksearch=3,get=1"
+# config overrides of the backend under test, before those given with --set
+DEFAULT_OVERRIDES = {
+	"NOTE_SCAN_INTERVAL": 2,  # pick up written notes within the run
+}
+
+
+# ---------------------------------------------------------------------------
+# processes under test
+
+def embed_text(text, dim):
+	"""
+	Deterministic unit vector of @text, same text gives the same embedding
+	"""
+	seed = int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+	vec = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+	return vec / np.linalg.norm(vec)
+
+
+def serve_stub_llm(port, dim, latency_ms, per_text_ms):
+	"""
+	Stand-in for llm_server with the same /embedding contract,
+	answering after a fixed delay plus a delay per text
+	"""
+	import uvicorn
+	import starlette.routing
+	import starlette.responses
+	import starlette.applications
+
+	async def embedding(request):
+		payload = await request.json()
+		texts = payload['contents']
+		await asyncio.sleep((latency_ms + per_text_ms * len(texts)) / 1000)
+		return starlette.responses.JSONResponse({
+			'status': 200,
+			'message': "okay",
+			'contents': [embed_text(t, dim).tolist() for t in texts],
+		})
+
+	app = starlette.applications.Starlette(routes=[
+		starlette.routing.Route('/embedding', embedding, methods=["POST"]),
+	])
+	uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def serve_backend(port, db_path, llm_url, overrides):
+	"""
+	Run main:app with config patched to use the temporary database and the stub llm
+	"""
+	sys.path.insert(0, BACKEND_DIR)
+	import config
+	config.DB_PATH = db_path
+	config.LLM_API_URL = llm_url
+	config.SQLITE_TOKENIZER = os.path.join(BACKEND_DIR, config.SQLITE_TOKENIZER)
+	for key, value in overrides.items():
+		assert hasattr(config, key), f"unknown config {key}"
+		setattr(config, key, value)
+
+	# static files are mounted relative to the working directory
+	workdir = os.path.dirname(db_path)
+	os.makedirs(os.path.join(workdir, "static"), exist_ok=True)
+	os.chdir(workdir)
+
+	import uvicorn
+	import main
+	uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def _free_port():
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+
+def _spawn(args, log_path):
+	log = open(log_path, 'w')
+	env = {**os.environ, "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING")}
+	return subprocess.Popen([sys.executable, os.path.realpath(__file__), *args], stdout=log, stderr=subprocess.STDOUT, env=env)
+
+
+async def wait_ready(client, url, proc, timeout=60):
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		if proc.poll() is not None:
+			raise RuntimeError(f"{url} exited with code {proc.returncode}")
+		try:
+			await client.get(url)
+			return
+		except httpx.TransportError:
+			await asyncio.sleep(0.2)
+	raise RuntimeError(f"{url} not ready after {timeout}s")
+
+
+# ---------------------------------------------------------------------------
+# metrics scraping
+
+def parse_metrics(text):
+	"""
+	{(name, ((label, value), ...)): value} of a Prometheus text exposition
+	"""
+	samples = {}
+	for line in text.splitlines():
+		if not line or line.startswith('#'):
+			continue
+		head, _, value = line.rpartition(' ')
+		name, _, labels = head.partition('{')
+		pairs = []
+		for pair in labels.rstrip('}').split(',') if labels else ():
+			k, _, v = pair.partition('=')
+			pairs.append((k, v.strip('"')))
+		samples[(name, tuple(pairs))] = float(value)
+	return samples
+
+
+def metric_sum(samples, name, **labels):
+	"""
+	Sum of every sample of @name matching @labels
+	"""
+	return sum(v for (n, pairs), v in samples.items()
+		if n == name and all(dict(pairs).get(k) == str(lv) for k, lv in labels.items()))
+
+
+async def chunk_state(client):
+	samples = parse_metrics((await client.get('/metrics')).text)
+	return metric_sum(samples, 'queue_depth', queue='chunk'), metric_sum(samples, 'chunked_notes_total')
+
+
+async def drain(client, scan_interval, timeout):
+	"""
+	Wait until the chunker has nothing left to do: the chunk queue is empty and
+	nothing was chunked for a whole scan interval. Return the drain rate.
+	"""
+	t0 = last_change = time.monotonic()
+	depth, chunked0 = await chunk_state(client)
+	chunked = chunked0
+	max_depth = depth
+	while time.monotonic() - t0 < timeout:
+		await asyncio.sleep(0.5)
+		depth, n = await chunk_state(client)
+		max_depth = max(max_depth, depth)
+		if n != chunked:
+			chunked, last_change = n, time.monotonic()
+		elif depth == 0 and time.monotonic() - last_change > scan_interval + 1:
+			break
+	seconds = last_change - t0
+	n_chunked = int(chunked - chunked0)
+	return {
+		'notes': n_chunked,
+		'seconds': round(seconds, 3),
+		'notes_per_sec': round(n_chunked / seconds, 3) if seconds > 0 else None,
+		'max_backlog': int(max_depth),
+		'timed_out': time.monotonic() - t0 >= timeout,
+	}
+
+
+# ---------------------------------------------------------------------------
+# traffic
+
+def make_words(rng, n=600):
+	syllables = ['ka', 'lo', 'mi', 'ra', 'te', 'su', 'no', 've', 'shi', 'dan', 'por', 'qui', 'el', 'zu', 'bex', 'tor']
+	words = set()
+	while len(words) < n:
+		words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+	return sorted(words)
+
+
+class Context():
+	def __init__(self, client, notebookid, seed):
+		self.client = client
+		self.notebookid = notebookid
+		self.rng = random.Random(seed)
+		self.words = make_words(self.rng)
+		self.noteids = []
+
+	def text(self, n_sentences):
+		# skewed word choice, so searches hit common and rare terms alike
+		sentences = []
+		for _ in range(n_sentences):
+			n = self.rng.randint(6, 18)
+			sentences.append(' '.join(self.words[int(len(self.words) * self.rng.random()**3)] for _ in range(n)).capitalize() + '.')
+		return ' '.join(sentences)
+
+	def keyword(self, n_words):
+		return ' '.join(self.rng.choice(self.words[:100]) for _ in range(n_words))
+
+
+async def op_create(ctx):
+	r = await ctx.client.post(f'/api/note/{ctx.notebookid}/new', json={
+		'title': ctx.text(1)[:60],
+		'textcontent': ctx.text(ctx.rng.randint(3, 30)),
+	})
+	if r.status_code == 200:
+		ctx.noteids.append(int(r.json()['content']['noteid']))
+	return r
+
+
+async def op_update(ctx):
+	if not ctx.noteids:
+		return await op_create(ctx)
+	noteid = ctx.rng.choice(ctx.noteids)
+	return await ctx.client.post(f'/api/note/{ctx.notebookid}/{noteid}/update', json={
+		'title': ctx.text(1)[:60],
+		'textcontent': ctx.text(ctx.rng.randint(3, 30)),
+		'noteid': noteid,
+		'notebookid': ctx.notebookid,
+	})
+
+
+async def op_vsearch(ctx):
+	return await ctx.client.get(f'/api/note/{ctx.notebookid}/vsearch', params={'kw': ctx.keyword(2), 'k': 10, 'ss': 48})
+
+
+async def op_quicksearch(ctx):
+	return await ctx.client.get(f'/api/note/{ctx.notebookid}/search', params={'kw': ctx.keyword(1), 'k': 10})
+
+
+async def op_get(ctx):
+	return await ctx.client.get(f'/api/note/{ctx.notebookid}/get', params={'pagesize': 50, 'excerpt': 200})
+
+
+OPS = {
+	'create': op_create,
+	'update': op_update,
+	'vsearch': op_vsearch,
+	'quicksearch': op_quicksearch,
+	'get': op_get,
+}
+
+
+def parse_mix(s):
+	mix = {}
+	for part in s.split(','):
+		op, _, weight = part.partition('=')
+		assert op in OPS, f"unknown op {op}, choose from {', '.join(OPS)}"
+		mix[op] = float(weight or 1)
+	return mix
+
+
+async def run_load(ctx, mix, concurrency, duration):
+	"""
+	@concurrency clients each sending one request after another for @duration seconds,
+	return [(op, ok, seconds), ...]
+	"""
+	records = []
+	ops, weights = list(mix), list(mix.values())
+	deadline = time.monotonic() + duration
+
+	async def _client():
+		while time.monotonic() < deadline:
+			op = ctx.rng.choices(ops, weights)[0]
+			t0 = time.perf_counter()
+			try:
+				r = await OPS[op](ctx)
+				ok = r.status_code == 200 and r.json().get('code', 200) == 200
+			except (httpx.HTTPError, ValueError):
+				ok = False
+			records.append((op, ok, time.perf_counter() - t0))
+
+	await asyncio.gather(*[_client() for _ in range(concurrency)])
+	return records
+
+
+def percentile(sorted_values, p):
+	if not sorted_values:
+		return None
+	# nearest rank
+	return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def summarize(records, elapsed):
+	by_op = collections.defaultdict(list)
+	for op, ok, seconds in records:
+		by_op[op].append((ok, seconds))
+	by_op['all'] = [(ok, seconds) for _, ok, seconds in records]
+
+	summary = {}
+	for op, rows in by_op.items():
+		ms = sorted(seconds * 1000 for ok, seconds in rows if ok)
+		summary[op] = {
+			'requests': len(rows),
+			'errors': sum(1 for ok, _ in rows if not ok),
+			'rps': round(len(rows) / elapsed, 3),
+			'mean_ms': round(sum(ms) / len(ms), 3) if ms else None,
+			'p50_ms': percentile(ms, 50),
+			'p95_ms': percentile(ms, 95),
+			'p99_ms': percentile(ms, 99),
+			'max_ms': ms[-1] if ms else None,
+		}
+	return summary
+
+
+def compare(result, baseline, tolerance):
+	"""
+	Lines comparing @result to @baseline, and whether anything regressed beyond @tolerance
+	"""
+	lines = []
+	regressed = False
+	for op, cur in result['ops'].items():
+		base = baseline.get('ops', {}).get(op)
+		if not base:
+			continue
+		for key in ('p50_ms', 'p95_ms', 'p99_ms', 'rps'):
+			if not cur.get(key) or not base.get(key):
+				continue
+			change = cur[key] / base[key] - 1
+			worse = change > tolerance if key != 'rps' else change < -tolerance
+			regressed |= worse
+			lines.append(f"{op:12} {key:7} {base[key]:10.2f} -> {cur[key]:10.2f}  {change:+7.1%}{'  REGRESSED' if worse else ''}")
+	for phase in ('seed', 'load'):
+		cur = result['drain'].get(phase, {}).get('notes_per_sec')
+		base = baseline.get('drain', {}).get(phase, {}).get('notes_per_sec')
+		if cur and base:
+			change = cur / base - 1
+			worse = change < -tolerance
+			regressed |= worse
+			lines.append(f"{'drain/'+phase:12} {'notes/s':7} {base:10.2f} -> {cur:10.2f}  {change:+7.1%}{'  REGRESSED' if worse else ''}")
+	return lines, regressed
+
+
+def _git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True).stdout.strip() or None
+	except OSError:
+		return None
+
+
+# ---------------------------------------------------------------------------
+
+async def run(args, overrides):
+	with tempfile.TemporaryDirectory(prefix="loadtest-") as workdir:
+		log_dir = args.log_dir or workdir
+		os.makedirs(log_dir, exist_ok=True)
+		llm_port, backend_port = _free_port(), _free_port()
+		llm_url = f"http://127.0.0.1:{llm_port}/embedding"
+		llm_proc = _spawn(['_stub-llm', '--port', str(llm_port), '--dim', str(args.dim),
+			'--latency-ms', str(args.llm_latency_ms), '--per-text-ms', str(args.llm_per_text_ms)],
+			os.path.join(log_dir, "llm.log"))
+		backend_proc = _spawn(['_backend', '--port', str(backend_port), '--db', os.path.join(workdir, "database.db"),
+			'--llm-url', llm_url, '--overrides', json.dumps(overrides)],
+			os.path.join(log_dir, "backend.log"))
+		try:
+			limits = httpx.Limits(max_connections=args.concurrency + 4)
+			async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{backend_port}", timeout=args.timeout, limits=limits) as client:
+				await wait_ready(client, llm_url.replace('/embedding', '/'), llm_proc)
+				await wait_ready(client, '/', backend_proc)
+
+				# a fresh user with its notebook
+				form = {'username': 'loadtest', 'password': 'loadtest'}
+				r = await client.post('/api/register', data=form)
+				assert r.status_code == 200, r.text
+				r = await client.post('/api/login', data=form)
+				assert r.status_code == 200, r.text
+				r = await client.get('/api/loadtest/get')
+				notebookid = r.json()['content']['notebooks'][0]['notebookid']
+				ctx = Context(client, notebookid, args.seed)
+
+				print(f"seeding {args.seed_notes} notes ...")
+				sem = asyncio.Semaphore(args.concurrency)
+
+				async def _seed():
+					async with sem:
+						await op_create(ctx)
+				await asyncio.gather(*[_seed() for _ in range(args.seed_notes)])
+				seed_drain = await drain(client, overrides['NOTE_SCAN_INTERVAL'], args.drain_timeout)
+				print(f"seed backlog drained: {seed_drain}")
+
+				print(f"running {args.duration}s at concurrency {args.concurrency}, mix {args.mix} ...")
+				t0 = time.monotonic()
+				records = await run_load(ctx, parse_mix(args.mix), args.concurrency, args.duration)
+				elapsed = time.monotonic() - t0
+				load_drain = await drain(client, overrides['NOTE_SCAN_INTERVAL'], args.drain_timeout)
+				print(f"load backlog drained: {load_drain}")
+		except Exception:
+			for name in ("backend.log", "llm.log"):
+				with open(os.path.join(log_dir, name)) as f:
+					print(f"--- {name} ---\n{f.read()[-4000:]}", file=sys.stderr)
+			raise
+		finally:
+			for proc in (backend_proc, llm_proc):
+				proc.terminate()
+				try:
+					proc.wait(10)
+				except subprocess.TimeoutExpired:
+					proc.kill()
+
+	return {
+		'started': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+		'commit': _git_commit(),
+		'params': {k: v for k, v in vars(args).items() if k not in ('out', 'compare', 'log_dir', 'cmd')},
+		'overrides': overrides,
+		'elapsed': round(elapsed, 3),
+		'ops': summarize(records, elapsed),
+		'drain': {'seed': seed_drain, 'load': load_drain},
+	}
+
+
+def print_summary(result):
+	print(f"{'op':12} {'reqs':>7} {'errs':>5} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9}")
+	for op, s in result['ops'].items():
+		fmt = lambda v: f"{v:9.2f}" if v is not None else f"{'-':>9}"
+		print(f"{op:12} {s['requests']:7} {s['errors']:5} {s['rps']:8.1f} {fmt(s['p50_ms'])} {fmt(s['p95_ms'])} {fmt(s['p99_ms'])}")
+
+
+def _parse_override(s):
+	key, _, value = s.partition('=')
+	try:
+		value = ast.literal_eval(value)
+	except (ValueError, SyntaxError):
+		pass
+	return key, value
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	sub = parser.add_subparsers(dest='cmd')
+
+	p = sub.add_parser('_stub-llm')
+	p.add_argument('--port', type=int, required=True)
+	p.add_argument('--dim', type=int, required=True)
+	p.add_argument('--latency-ms', type=float, default=0)
+	p.add_argument('--per-text-ms', type=float, default=0)
+
+	p = sub.add_parser('_backend')
+	p.add_argument('--port', type=int, required=True)
+	p.add_argument('--db', required=True)
+	p.add_argument('--llm-url', required=True)
+	p.add_argument('--overrides', default='{}')
+
+	parser.add_argument('--concurrency', type=int, default=8, help="concurrent clients")
+	parser.add_argument('--duration', type=float, default=30, help="seconds of traffic")
+	parser.add_argument('--mix', default=DEFAULT_MIX, help="op=weight,... of " + ', '.join(OPS))
+	parser.add_argument('--seed-notes', type=int, default=200, help="notes created before the run")
+	parser.add_argument('--seed', type=int, default=0, help="random seed of the generated traffic")
+	parser.add_argument('--dim', type=int, default=None, help="embedding size, defaults to config.LLM_EMBED_D")
+	parser.add_argument('--llm-latency-ms', type=float, default=20, help="stub llm delay per request")
+	parser.add_argument('--llm-per-text-ms', type=float, default=1, help="stub llm delay per text")
+	parser.add_argument('--timeout', type=float, default=60, help="per request timeout in seconds")
+	parser.add_argument('--drain-timeout', type=float, default=300, help="max seconds to wait for the chunk backlog")
+	parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help="override a backend config value")
+	parser.add_argument('--log-dir', default=None, help="keep logs of the backend and stub llm here")
+	parser.add_argument('--out', default=None, help="result file, defaults to tools/results/loadtest-<time>.json")
+	parser.add_argument('--compare', default=None, help="earlier result file to compare with")
+	parser.add_argument('--tolerance', type=float, default=0.10, help="relative change counted as a regression")
+	args = parser.parse_args()
+
+	if args.cmd == '_stub-llm':
+		return serve_stub_llm(args.port, args.dim, args.latency_ms, args.per_text_ms)
+	if args.cmd == '_backend':
+		return serve_backend(args.port, args.db, args.llm_url, json.loads(args.overrides))
+
+	if args.dim is None:
+		sys.path.insert(0, BACKEND_DIR)
+		import config
+		args.dim = config.LLM_EMBED_D
+	overrides = {**DEFAULT_OVERRIDES, **dict(_parse_override(s) for s in args.set)}
+
+	result = asyncio.run(run(args, overrides))
+	print_summary(result)
+
+	out = args.out or os.path.join(RESULTS_DIR, f"loadtest-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+	os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+	with open(out, 'w') as f:
+		json.dump(result, f, indent=4)
+	print(f"results saved to {out}")
+
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		lines, regressed = compare(result, baseline, args.tolerance)
+		print(f"compared with {args.compare} ({baseline.get('commit')}):")
+		print('\n'.join(lines))
+		if regressed:
+			sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,303 @@
+"""
+Quality vs speed benchmark of NotebookVectorStore faiss configurations.
+
+Loads the chunk embeddings of a notebook from the database, or generates a
+clustered synthetic corpus, holds out a sample of them as queries and computes
+their exact top-k neighbours. Then builds the notebook's index for every
+combination of nlist, nprobe and vector encoding, reporting recall@k, query
+latency, build time and serialized size of each.
+The fastest configuration reaching --min-recall wins and can be written to the
+notebook's settings (Notebooks.meta $.faiss); the index rebuilder retrains the
+notebook's index with it on its next pass.
+
+	python tools/vsbench.py --notebook 1
+	python tools/vsbench.py --notebook 1 --min-recall 0.98 --write
+	python tools/vsbench.py --synthetic 20000 --encodings Flat,SQ8,PQ96
+"""
+import os
+import sys
+import json
+import math
+import time
+import sqlite3
+import argparse
+import datetime
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import faiss
+
+import config
+from model.vectorstore import NotebookVectorStore, check_settings
+from model.chunk import TITLE_CHUNK_IDX, unpack_vector
+
+RESULTS_DIR = os.path.join(BACKEND_DIR, "tools", "results")
+DEFAULT_ENCODINGS = "Flat,SQ8,SQfp16"
+
+
+# ---------------------------------------------------------------------------
+# corpus
+
+def load_corpus(db_path, notebookid, dim):
+	"""
+	Chunk embeddings of a notebook, titles excluded
+	"""
+	conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+	try:
+		rows = conn.execute('''
+			SELECT vector FROM chunks
+			WHERE notebookid = ? AND chunk_idx != ?;
+		''', (notebookid, TITLE_CHUNK_IDX)).fetchall()
+	finally:
+		conn.close()
+	embs = [unpack_vector(b_vec) for b_vec, in rows]
+	embs = [emb for emb in embs if len(emb) == dim]  # skip leftovers of another embedding model
+	return np.array(embs, dtype=np.float32).reshape(-1, dim)
+
+
+def synthetic_corpus(n, dim, clusters, rng):
+	"""
+	@n points scattered around @clusters random topics, like chunks of notes on a few subjects
+	"""
+	centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+	labels = rng.integers(0, clusters, size=n)
+	return centers[labels] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+
+
+def split_queries(embs, n_queries, rng):
+	"""
+	Hold out @n_queries embeddings as queries, the rest is indexed
+	"""
+	order = rng.permutation(len(embs))
+	return embs[order[n_queries:]], embs[order[:n_queries]]
+
+
+def ground_truth(corpus, queries, k, normalize):
+	"""
+	Exact top @k corpus positions of each query
+	"""
+	corpus, queries = corpus.copy(), queries.copy()
+	if normalize:
+		faiss.normalize_L2(corpus)
+		faiss.normalize_L2(queries)
+	index = faiss.IndexFlatIP(corpus.shape[1])
+	index.add(corpus)
+	_, I = index.search(queries, k)
+	return I
+
+
+# ---------------------------------------------------------------------------
+# sweep
+
+def default_nlists(n):
+	"""
+	Powers of two around sqrt(@n), keeping enough training points per list, plus the config default
+	"""
+	nlists = {2**i for i in range(2, 20) if 2**i <= max(4, n // 39) and 2**i <= 4 * math.sqrt(n)}
+	nlists.add(config.FAISS_NLIST)
+	return sorted(x for x in nlists if x <= n)
+
+
+def default_nprobes(nlist):
+	return sorted({2**i for i in range(0, 20) if 2**i < nlist} | {nlist})
+
+
+def build(corpus, dim, nlist, encoding):
+	"""
+	Train and fill a vectorstore the way the index rebuilder does.
+	Return it and its build time in seconds.
+	"""
+	vs = NotebookVectorStore(notebookid=0, emb_d=dim, nlist=nlist, nprobe=1, encoding=encoding)
+	t0 = time.perf_counter()
+	vs.train(corpus)
+	# one note holding every chunk, emb ids follow corpus positions
+	vs.add(0, corpus, [[0, 0]] * len(corpus), corpus[0])
+	return vs, time.perf_counter() - t0
+
+
+def measure(vs, queries, truth, k):
+	"""
+	Recall@k against @truth and per query latency, queries sent one at a time like vsearch does
+	"""
+	latencies = []
+	hits = 0
+	for i in range(len(queries)):
+		t0 = time.perf_counter()
+		_, I = vs.search(queries[i:i+1], k=k)
+		latencies.append(time.perf_counter() - t0)
+		found = {int(eid) - 1 for eid in I[0] if eid >= 0}  # emb ids start at 1
+		hits += len(found.intersection(truth[i].tolist()))
+	latencies = np.array(latencies) * 1000
+	return {
+		'recall': round(hits / (len(queries) * k), 4),
+		'latency_ms_p50': round(float(np.percentile(latencies, 50)), 4),
+		'latency_ms_p95': round(float(np.percentile(latencies, 95)), 4),
+		'latency_ms_mean': round(float(latencies.mean()), 4),
+	}
+
+
+def sweep(corpus, queries, truth, k, nlists, encodings, nprobes=None, log=print):
+	"""
+	Measure every (encoding, nlist, nprobe) combination, nlist 0 being exact search
+	"""
+	dim = corpus.shape[1]
+	results = []
+	for encoding in encodings:
+		for nlist in nlists:
+			vs = NotebookVectorStore(notebookid=0, emb_d=dim, nlist=nlist, encoding=encoding)
+			if len(corpus) < vs.min_train_size():
+				log(f"skip {encoding} nlist={nlist}: needs {vs.min_train_size()} embeddings to train")
+				continue
+			vs, build_s = build(corpus, dim, nlist, encoding)
+			size = len(faiss.serialize_index(vs.index))
+			for nprobe in (nprobes or default_nprobes(nlist)) if nlist else [1]:
+				if nprobe > max(nlist, 1):
+					continue
+				vs.configure(nprobe=nprobe)
+				row = {
+					'encoding': encoding,
+					'nlist': nlist,
+					'nprobe': nprobe,
+					'build_s': round(build_s, 4),
+					'bytes': size,
+					**measure(vs, queries, truth, k),
+				}
+				results.append(row)
+				log(format_row(row))
+	return results
+
+
+def pick(results, min_recall):
+	"""
+	Fastest configuration reaching @min_recall, the most accurate one if none does
+	"""
+	good = [r for r in results if r['recall'] >= min_recall]
+	if good:
+		return min(good, key=lambda r: (r['latency_ms_mean'], r['bytes'])), True
+	return max(results, key=lambda r: (r['recall'], -r['latency_ms_mean'])), False
+
+
+def format_row(row):
+	return (
+		f"{row['encoding']:<8} {row['nlist']:>6} {row['nprobe']:>6} {row['recall']:>8.4f} "
+		f"{row['latency_ms_p50']:>9.3f} {row['latency_ms_p95']:>9.3f} {row['build_s']:>9.3f} {row['bytes']/1e6:>9.2f}"
+	)
+
+
+HEADER = f"{'encoding':<8} {'nlist':>6} {'nprobe':>6} {'recall':>8} {'p50_ms':>9} {'p95_ms':>9} {'build_s':>9} {'MB':>9}"
+
+
+# ---------------------------------------------------------------------------
+# settings
+
+def write_settings(db_path, notebookid, winner, k, n):
+	"""
+	Store the winning configuration as the notebook's faiss settings
+	"""
+	settings = {
+		'nlist': winner['nlist'],
+		'nprobe': winner['nprobe'],
+		'encoding': winner['encoding'],
+		# provenance, not read by the backend
+		'recall': winner['recall'],
+		'k': k,
+		'n': n,
+		'latency_ms': winner['latency_ms_mean'],
+		'benchmarked_at': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+	}
+	assert check_settings(settings) is not None
+	conn = sqlite3.connect(db_path, timeout=30)
+	try:
+		cursor = conn.execute('''
+			UPDATE Notebooks
+			SET meta = json_set(CASE WHEN json_valid(meta) THEN meta ELSE '{}' END, '$.faiss', json(?))
+			WHERE nbid = ?;
+		''', (json.dumps(settings), notebookid))
+		conn.commit()
+		return cursor.rowcount > 0
+	finally:
+		conn.close()
+
+
+def _int_list(value):
+	return [int(x) for x in value.split(',') if x.strip()]
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark faiss configurations of a notebook's vectorstore")
+	source = parser.add_mutually_exclusive_group(required=True)
+	source.add_argument('--notebook', type=int, help="benchmark the chunk embeddings of this notebook")
+	source.add_argument('--synthetic', type=int, metavar='N', help="benchmark N synthetic embeddings")
+	parser.add_argument('--db', default=config.DB_PATH)
+	parser.add_argument('--dim', type=int, default=config.LLM_EMBED_D)
+	parser.add_argument('--clusters', type=int, default=50, help="topics of the synthetic corpus")
+	parser.add_argument('--queries', type=int, default=200, help="embeddings held out as queries")
+	parser.add_argument('-k', type=int, default=10, help="recall@k")
+	parser.add_argument('--nlists', type=_int_list, default=None, help="comma separated, 0 for exact search, defaults to powers of two around sqrt(N)")
+	parser.add_argument('--nprobes', type=_int_list, default=None, help="comma separated, defaults to powers of two up to nlist")
+	parser.add_argument('--encodings', default=DEFAULT_ENCODINGS, help="comma separated Flat | SQ8 | SQfp16 | PQ<m>")
+	parser.add_argument('--min-recall', type=float, default=0.95)
+	parser.add_argument('--threads', type=int, default=None, help="faiss OpenMP threads")
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--write', action='store_true', help="save the winner to the notebook's faiss settings")
+	parser.add_argument('--out', default=None, help="result file, defaults to tools/results/vsbench-<time>.json")
+	args = parser.parse_args()
+
+	if args.write and args.notebook is None:
+		parser.error("--write needs --notebook")
+	encodings = [e.strip() for e in args.encodings.split(',') if e.strip()]
+	for encoding in encodings:
+		if check_settings({'encoding': encoding}, emb_d=args.dim) is None:
+			parser.error(f"unsupported encoding {encoding!r} for {args.dim} dimensions")
+	if args.threads:
+		faiss.omp_set_num_threads(args.threads)
+
+	rng = np.random.default_rng(args.seed)
+	if args.notebook is not None:
+		embs = load_corpus(args.db, args.notebook, args.dim)
+	else:
+		embs = synthetic_corpus(args.synthetic, args.dim, args.clusters, rng)
+	n_queries = min(args.queries, len(embs) // 5)
+	if n_queries < 1 or len(embs) - n_queries < args.k:
+		sys.exit(f"too few embeddings to benchmark: {len(embs)}")
+	corpus, queries = split_queries(embs, n_queries, rng)
+	truth = ground_truth(corpus, queries, args.k, config.FAISS_NORMALIZE)
+	nlists = args.nlists if args.nlists is not None else [0, *default_nlists(len(corpus))]
+	print(f"{len(corpus)} embeddings, {n_queries} queries, {args.dim} dimensions, recall@{args.k}")
+
+	print(HEADER)
+	results = sweep(corpus, queries, truth, args.k, nlists, encodings, args.nprobes)
+	if not results:
+		sys.exit("no configuration could be built")
+	winner, reached = pick(results, args.min_recall)
+	print(f"{'winner' if reached else f'no configuration reaches recall {args.min_recall}, most accurate'}:")
+	print(format_row(winner))
+
+	out = args.out or os.path.join(RESULTS_DIR, f"vsbench-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+	os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+	with open(out, 'w') as f:
+		json.dump({
+			'source': {'notebook': args.notebook} if args.notebook is not None else {'synthetic': args.synthetic, 'clusters': args.clusters},
+			'n': len(corpus),
+			'queries': n_queries,
+			'dim': args.dim,
+			'k': args.k,
+			'min_recall': args.min_recall,
+			'results': results,
+			'winner': winner,
+		}, f, indent=4)
+	print(f"results saved to {out}")
+
+	if args.write:
+		if not reached:
+			sys.exit("not writing settings that miss --min-recall")
+		if not write_settings(args.db, args.notebook, winner, args.k, len(corpus)):
+			sys.exit(f"notebook#{args.notebook} not found")
+		print(f"saved as faiss settings of notebook#{args.notebook}, applied on its next index rebuild")
+
+
+if __name__ == "__main__":
+	main()
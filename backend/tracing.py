@@ -0,0 +1,13 @@
+import os
+import sys
+
+# the telemetry package at the repository root is shared with the llm server
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if ROOT_DIR not in sys.path:
+	sys.path.append(ROOT_DIR)
+
+import config
+from telemetry import tracing as _tracing
+from telemetry.tracing import start_trace, span, timings, TracingMiddleware
+
+_tracing.configure(config.TRACE_SERVICE_NAME, config.TRACE_EXPORT)
@@ -1,29 +1,136 @@
 import json
+import time
 import asyncio
+import logging
 import functools
+import contextlib
+import hashlib
+import contextvars
 import typing
 
 import starlette.responses
 import starlette.requests
 import starlette_login.decorator
 
+import config
 
-class PrettyJSONResponse(starlette.responses.Response):
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+
+# set per request by middleware.PrettyJSONMiddleware when ?pretty=1
+pretty_json = contextvars.ContextVar('pretty_json', default=False)
+
+
+class JSONResponse(starlette.responses.Response):
+	"""
+	Compact JSON, encoded with orjson when available.
+	Pretty printed only when the request asks for it.
+	"""
 	media_type = "application/json"
 
 	def render(self, content) -> bytes:
+		if pretty_json.get():
+			return json.dumps(
+				content,
+				ensure_ascii=False,
+				allow_nan=False,
+				indent=4,
+				separators=(", ", ": "),
+			).encode("utf-8")
+		if orjson:
+			return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
 		return json.dumps(
 			content,
 			ensure_ascii=False,
 			allow_nan=False,
-			indent=4,
-			separators=(", ", ": "),
+			separators=(",", ":"),
 		).encode("utf-8")
 
 
+class JSONLogFormatter(logging.Formatter):
+	"""
+	One JSON object per log record, for log shippers
+	"""
+
+	def format(self, record):
+		entry = {
+			'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + '.%03dZ' % record.msecs,
+			'level': record.levelname.lower(),
+			'logger': record.name,
+			'msg': record.getMessage(),
+		}
+		if record.exc_info:
+			entry['exc'] = self.formatException(record.exc_info)
+		return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(level=config.LOG_LEVEL, fmt=config.LOG_FORMAT):
+	"""
+	Configure the root logger once, before the app starts
+	"""
+	handler = logging.StreamHandler()
+	if fmt == 'json':
+		handler.setFormatter(JSONLogFormatter())
+	else:
+		handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+	root = logging.getLogger()
+	root.handlers[:] = [handler]
+	root.setLevel(level.upper())
+
+
+class StartupTimer():
+	"""
+	Durations of named startup phases, each measured from the end of the previous one
+	"""
+
+	def __init__(self, t0=None):
+		self.t0 = time.perf_counter() if t0 is None else t0
+		self.last = self.t0
+		self.phases = {}  # phase --> seconds
+
+	def lap(self, phase):
+		now = time.perf_counter()
+		self.phases[phase] = now - self.last
+		self.last = now
+
+	@contextlib.contextmanager
+	def timed(self, phase):
+		"""
+		Time a phase on its own, for phases running concurrently
+		"""
+		t0 = time.perf_counter()
+		try:
+			yield
+		finally:
+			now = time.perf_counter()
+			self.phases[phase] = now - t0
+			self.last = max(self.last, now)
+
+	def report(self, phases=None):
+		phases = self.phases if phases is None else {p: self.phases[p] for p in phases}
+		steps = ', '.join(f"{p} {s:.3f}s" for p, s in phases.items())
+		return f"{steps} ({self.last - self.t0:.3f}s since start)"
+
+
 def _json_resp(code, desc, content={}):
-	return PrettyJSONResponse({"code": code, "status": desc, "content": content}, status_code=code)
-	return starlette.responses.JSONResponse({"code": code, "status": desc, "content": content}, status_code=code)
+	return JSONResponse({"code": code, "status": desc, "content": content}, status_code=code)
+
+
+def _etag_json_resp(request, code, desc, content={}):
+	"""
+	JSON response with an ETag of its body,
+	answer 304 if the client already holds the same body
+	"""
+	resp = _json_resp(code, desc, content)
+	etag = 'W/"%s"' % hashlib.blake2b(resp.body, digest_size=16).hexdigest()
+	if_none_match = request.headers.get("if-none-match", "")
+	if etag in [tag.strip() for tag in if_none_match.split(",")]:
+		return starlette.responses.Response(status_code=304, headers={"ETag": etag})
+	resp.headers["ETag"] = etag
+	return resp
 
 
 def _error_json_resp(code, desc, content={}):
@@ -50,7 +157,7 @@ def login_required(func: typing.Callable) -> typing.Callable:
 
 			user = request.scope.get("user")
 			if not user or getattr(user, "is_authenticated", False) is False:
-				return PrettyJSONResponse({"code": 400, "status": "login required"}, status_code=400)
+				return JSONResponse({"code": 400, "status": "login required"}, status_code=400)
 			else:
 				return await func(*args, **kwargs)
 
@@ -70,8 +177,22 @@ def login_required(func: typing.Callable) -> typing.Callable:
 
 			user = request.scope.get("user")
 			if not user or getattr(user, "is_authenticated", False) is False:
-				return PrettyJSONResponse({"code": 400, "status": "login required"}, status_code=400)
+				return JSONResponse({"code": 400, "status": "login required"}, status_code=400)
 			else:
 				return func(*args, **kwargs)
 
 		return sync_wrapper
+
+
+def admin_required(func: typing.Callable) -> typing.Callable:
+	"""
+	Like login_required, for async handlers only open to admin users
+	"""
+	@login_required
+	@functools.wraps(func)
+	async def async_wrapper(request: starlette.requests.Request) -> starlette.responses.Response:
+		if not getattr(request.user, "isadmin", False):
+			return JSONResponse({"code": 403, "status": "admin required"}, status_code=403)
+		return await func(request)
+
+	return async_wrapper
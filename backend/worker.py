@@ -1,15 +1,18 @@
+import logging
 import asyncio
-import json
-import pickle
 import datetime
 import time
 
 import aiosqlite
 import anyio
 
+import cache
 import model
+import metrics
 import config
 
+logger = logging.getLogger(__name__)
+
 
 
 async def note_scanner(app):
@@ -17,7 +20,7 @@ async def note_scanner(app):
 	Scan for notes that needs to be processed
 	"""
 	await anyio.sleep(1)
-	print("note scanner: start")
+	logger.info("note scanner: start")
 	db_conn = app.state.db_conn
 	while True:
 		if app.state.should_exit is True:
@@ -35,11 +38,13 @@ async def note_scanner(app):
 			rows = await cursor.fetchall()
 			for nbid, vs_not_found in rows:
 				if bool(vs_not_found):
-					vs = await model.NotebookVectorStore.getVectorStore(nbid, db_conn)
+					vs = await model.NotebookVectorStore.getVectorStore(nbid, db_conn, track_use=False)
 					await model.NotebookVectorStore.saveDB(db_conn, vs, notebookid=nbid)
 
-			# scan for unchunk notes
-			for nbid, _ in rows:
+			# scan for unchunk notes, unless the chunker has not caught up with the last scan yet
+			for nbid, _ in rows if app.state.chunk_queue.empty() else ():
+				if nbid in app.state.importing:
+					continue  # the import pipeline chunks these notes itself
 				try:
 					tablename = f'notebook_{nbid}'
 					await cursor.execute(f'''
@@ -54,9 +59,7 @@ async def note_scanner(app):
 							SELECT docid
 							FROM {tablename}
 							WHERE dirty = 1
-								OR title_emb IS NULL OR title_emb = ''
-								OR chunk_spans IS NULL OR chunk_spans = ''
-								OR chunk_embs IS NULL OR chunk_embs = ''
+								OR NOT EXISTS (SELECT 1 FROM chunks WHERE notebookid = {nbid} AND noteid = docid AND chunk_idx = {model.chunk.TITLE_CHUNK_IDX})
 								OR meta IS NULL OR meta = ''
 								OR json_extract(meta, '$.embed_d') != {config.LLM_EMBED_D}
 								OR json_extract(meta, '$.n_chunk') == NULL;
@@ -71,18 +74,47 @@ async def note_scanner(app):
 							await app.state.rebuild_queue.put(nbid)
 
 				except:
-					print("note scanner: error during notebook scan")
+					logger.exception("note scanner: error during notebook scan")
 					pass
 
 			await cursor.close()
-			print('note scanner: sleep')
-			await anyio.sleep(600)  # run every 10 mins
+			logger.debug('note scanner: sleep')
+			await anyio.sleep(config.NOTE_SCAN_INTERVAL)
 
 		except anyio.get_cancelled_exc_class():
-			print("note scanner: cancelled")
+			logger.info("note scanner: cancelled")
 			break
 
-	print("note scanner: exit")
+	logger.info("note scanner: exit")
+
+
+async def store_chunks(app, note, chunks, chunk_spans, chunk_embs, title_emb):
+	"""
+	Add a chunked note to its notebook's vectorstore
+	and queue its chunks to be written with the next group commit.
+	Runs inside main thread context.
+	"""
+	notebookid, noteid = int(note.notebookid), int(note.noteid)
+
+	async def _write_chunks(db_conn):
+		# runs at the next group commit, the note may be gone or edited by then
+		if not await note.db_mark_chunked(db_conn, len(chunks), len(title_emb)):
+			logger.debug(f"note#{notebookid}/{noteid}: chunk - note changed, dropped")
+			return
+		await note.db_store_chunks(db_conn, title_emb, chunk_embs, chunk_spans)
+
+	vs_changed = False
+	async with model.NotebookVectorStore.hold(notebookid, app.state.db_conn, track_use=False) as vs:
+		if vs.index.is_trained:
+			vs.add(noteid, chunk_embs, chunk_spans, title_emb)
+			vs_changed = True
+	if vs_changed:
+		cache.results.bump(notebookid)
+
+	# note stays dirty until the group commit lands, so a crash before it only means a re-chunk
+	await app.state.write_queue.submit(('chunks', notebookid, noteid), _write_chunks,
+		notebookid=notebookid if vs_changed else None)
+	logger.debug(f"note#{notebookid}/{noteid}: chunk - queued")
 
 
 def note_chunker(app):
@@ -100,35 +132,22 @@ def note_chunker(app):
 
 	async def _chunk(app, db_conn2, notebookid, noteid, task_status=None):
 		# this function runs in worker thread context
-		print(f"note#{notebookid}/{noteid}: chunk - start")
+		logger.debug(f"note#{notebookid}/{noteid}: chunk - start")
 
 		note = await model.Note.db_load(db_conn2, notebookid, noteid)
 		rets = await note.make_chunks()
 		if not rets:
-			print(f"note#{notebookid}/{noteid}: chunk - failed")
+			logger.warning(f"note#{notebookid}/{noteid}: chunk - failed")
+			metrics.chunked_notes.inc(outcome='failed')
 			return
 		chunks, chunk_spans, chunk_embs, title_emb = rets
-
-		async def _store_chunks(app):
-			# this function runs inside main thread context
-			await note.db_store_chunks(app.state.db_conn, title_emb, chunk_embs, chunk_spans)
-			await note.db_store_cols(app.state.db_conn,
-				['dirty', 'meta'],
-				[False, f"json_set(CASE WHEN meta IS NULL THEN '{{}}' ELSE meta END, '$.n_chunk', {len(chunks)}, '$.embed_d', {len(title_emb)})"],
-				directly=True)
-			vs = await model.NotebookVectorStore.getVectorStore(notebookid, app.state.db_conn)
-			if vs.index.is_trained:
-				vs.add(noteid, chunk_embs, chunk_spans, title_emb)
-				await model.NotebookVectorStore.saveDB(app.state.db_conn, vs, notebookid=notebookid)
-			await app.state.db_conn.commit()
-			print(f"note#{notebookid}/{noteid}: chunk - complete")
-
-		anyio.from_thread.run(_store_chunks, app)
+		anyio.from_thread.run(store_chunks, app, note, chunks, chunk_spans, chunk_embs, title_emb)
+		metrics.chunked_notes.inc(outcome='ok')
 
 	# --------------------------------------
 	time.sleep(1)
-	print("note chunker: start")
-	db_conn2 = asyncio.run(model.db_init(config.DB_PATH))
+	logger.info("note chunker: start")
+	db_conn2 = asyncio.run(model.db_connect(config.DB_PATH, readonly=True))
 
 	while True:
 		notebookid, noteid = anyio.from_thread.run(_get_next_note, app)
@@ -139,10 +158,9 @@ def note_chunker(app):
 		# anyio.run(_chunk, app, db_conn2, notebookid, noteid)
 		# anyio.run(app.state.tg.start, _chunk, app, db_conn2, notebookid, noteid)
 
-	asyncio.run(db_conn2.commit())
 	asyncio.run(db_conn2.close())
 
-	print("note chunker: exit")
+	logger.info("note chunker: exit")
 
 
 
@@ -154,9 +172,9 @@ async def _chunk_all(app, notebookid):
 	"""
 	Continuously chunking all notes under notebook
 	"""
-	vs = await model.NotebookVectorStore.getVectorStore(notebookid, app.state.db_conn)
-	print(vs.emb_id_map)
-	print(vs.noteid_map)
+	vs = await model.NotebookVectorStore.getVectorStore(notebookid, app.state.db_conn, track_use=False)
+	logger.debug("emb_id_map: %s", vs.emb_id_map)
+	logger.debug("noteid_map: %s", vs.noteid_map)
 
 	db_conn = model.db_init(config.DB_PATH)
 
@@ -165,12 +183,12 @@ async def _chunk_all(app, notebookid):
 	await cursor.execute(f'''
 		SELECT docid
 		FROM {tablename}
-		WHERE title_emb IS NULL OR dirty = 1;
+		WHERE dirty = 1 OR json_extract(meta, '$.n_chunk') IS NULL;
 	''')
 	rows = await cursor.fetchall()
 	await cursor.close()
 	docids = [r[0] for r in rows]
-	print(f"there are {len(docids)} notes to chunk")
+	logger.info(f"there are {len(docids)} notes to chunk")
 
 
 	for noteid in docids:
@@ -178,10 +196,9 @@ async def _chunk_all(app, notebookid):
 		if threading.main_thread().is_alive() is False or app.state.should_exit is True:
 			break
 
-		print()
 		noteid = int(noteid)
 		note = await model.Note.db_load(db_conn, notebookid, noteid)
-		print(note)
+		logger.debug("%s", note)
 		chunks, chunk_spans, chunk_embs, title_emb = await note.make_chunks()
 		await note.db_store_chunks(db_conn, title_emb, chunk_embs, chunk_spans)
 		await note.db_store_cols(db_conn,
@@ -196,7 +213,7 @@ async def _chunk_all(app, notebookid):
 
 		await anyio.sleep(1)
 
-	print("done!")
+	logger.info("done!")
 
 
 
@@ -210,19 +227,27 @@ async def index_rebuilder(app):
 	Proceed to rebuild faiss index.
 	"""
 	await anyio.sleep(3)
-	print("index rebuilder: start")
+	logger.info("index rebuilder: start")
 	while True:
 		notebookid = await app.state.rebuild_queue.get()
-		print(f"vectorstore#{notebookid}: rebuild check")
+		logger.debug(f"vectorstore#{notebookid}: rebuild check")
 		if notebookid is None or app.state.should_exit is True:
 			break
 
-		vs = await model.NotebookVectorStore.getVectorStore(notebookid, app.state.db_conn)
 		tablename = f'notebook_{notebookid}'
 		cursor = None
 
 		# Check if notebook's faiss index needs rebuilding
 		rebuild = False
+		settings = await model.NotebookVectorStore.loadSettings(app.state.db_conn, notebookid)
+		async with model.NotebookVectorStore.hold(notebookid, app.state.db_conn, track_use=False) as vs:
+			reconfigured = vs.configure(**settings)
+			if reconfigured:
+				# faiss settings of the notebook changed, start over with an empty index of the new kind
+				vs.clear()
+		if reconfigured:
+			logger.info(f"vectorstore#{notebookid}: new faiss settings {settings}")
+			cache.results.bump(notebookid)
 		if vs.emb_count==0 or not vs.index.is_trained:
 			# empty faiss index
 			cursor = await app.state.db_conn.cursor() if not cursor else cursor
@@ -232,7 +257,7 @@ async def index_rebuilder(app):
 				FROM {tablename}
 				WHERE dirty = 0
 					AND meta IS NOT NULL AND meta != '{{}}'
-					AND chunk_embs IS NOT NULL
+					AND json_extract(meta, '$.n_chunk') IS NOT NULL
 					AND json_extract(meta, '$.embed_d') == {config.LLM_EMBED_D};
 			''')
 			rows = await cursor.fetchall()
@@ -240,7 +265,7 @@ async def index_rebuilder(app):
 			for docid, n_chunk in rows:
 				n_total += n_chunk
 
-			if n_total > vs.nlist:
+			if n_total > vs.min_train_size():
 				rebuild = True
 		else:
 			# non-empty faiss index
@@ -254,43 +279,30 @@ async def index_rebuilder(app):
 
 		# Rebuilding
 		if rebuild:
-			print(f"vectorstore#{notebookid}: rebuilding ...")
-
-			cursor = await app.state.db_conn.cursor() if not cursor else cursor
-			await cursor.execute(f'''
-				SELECT
-					docid, chunk_embs, chunk_spans, title_emb
-				FROM {tablename}
-				WHERE dirty = 0
-					AND meta IS NOT NULL AND meta != '{{}}'
-					AND chunk_embs IS NOT NULL
-					AND json_extract(meta, '$.embed_d') == {config.LLM_EMBED_D};
-			''')
-			rows = await cursor.fetchall()
+			logger.info(f"vectorstore#{notebookid}: rebuilding ...")
+			t0 = time.perf_counter()
 
+			rows = []
 			all_embs = []
-			rows_uncompressed = []
-			for docid, chunk_embs, chunk_spans, title_emb in rows:
-				noteid = int(docid)
-				chunk_embs = pickle.loads(chunk_embs)
-				chunk_spans = json.loads(chunk_spans)
-				title_emb = pickle.loads(title_emb)
-				rows_uncompressed.append((noteid, chunk_embs, chunk_spans, title_emb))
+			async for noteid, chunk_embs, chunk_spans, title_emb in model.Chunks.iter_notes(app.state.db_conn, notebookid):
+				rows.append((noteid, chunk_embs, chunk_spans, title_emb))
 				all_embs.extend(chunk_embs)
 
-			# rebuild
-			vs.clear()
-			vs.train(all_embs)
-			for noteid, chunk_embs, chunk_spans, title_emb in rows_uncompressed:
-				vs.add(noteid, chunk_embs, chunk_spans, title_emb)
-			vs.modifies = 0
-			vs.last_rebuild = datetime.datetime.utcnow()
-			print(f"vectorstore#{notebookid}: rebuilding successful")
-
-			await model.NotebookVectorStore.saveDB(app.state.db_conn, vs, notebookid=notebookid)
+			# rebuild and save under the lock, so the instance saved is still the cached one
+			async with model.NotebookVectorStore.hold(notebookid, app.state.db_conn, track_use=False) as vs:
+				vs.clear()
+				vs.train(all_embs)
+				for noteid, chunk_embs, chunk_spans, title_emb in rows:
+					vs.add(noteid, chunk_embs, chunk_spans, title_emb)
+				vs.modifies = 0
+				vs.last_rebuild = datetime.datetime.utcnow()
+				await model.NotebookVectorStore.saveDB(app.state.db_conn, vs, notebookid=notebookid)
+			cache.results.bump(notebookid)
+			metrics.rebuild_seconds.observe(time.perf_counter() - t0)
+			logger.info(f"vectorstore#{notebookid}: rebuilding successful")
 
 		else:
-			print(f"vectorstore#{notebookid}: no need to rebuild")
+			logger.debug(f"vectorstore#{notebookid}: no need to rebuild")
 
 		# print(vs.emb_count)
 		# print(vs.modifies)
@@ -300,4 +312,73 @@ async def index_rebuilder(app):
 		if cursor:
 			await cursor.close()
 
-	print("index rebuilder: exit")
+	logger.info("index rebuilder: exit")
+
+
+
+# notebookid --> FTS index maintenance counters, kept by fts_maintainer
+fts_stats = {}
+
+
+def _db_changes(app):
+	"""
+	Rows changed so far on the request writer and the group commit writer
+	"""
+	return app.state.db_conn.total_changes + app.state.write_queue.db_conn.total_changes
+
+
+async def fts_maintainer(app):
+	"""
+	Keep FTS indexes from fragmenting under heavy edits.
+	When the database saw no writes since the previous round, run a few
+	incremental merge steps on every index that has mergeable levels,
+	and fully optimize indexes still fragmented after a long idle stretch.
+	"""
+	await anyio.sleep(5)
+	logger.info("fts maintainer: start")
+	db_conn = app.state.db_conn
+	last_changes = _db_changes(app)
+	idle_rounds = 0
+	while True:
+		try:
+			await anyio.sleep(config.FTS_MAINTENANCE_INTERVAL)
+			if app.state.should_exit is True:
+				break
+			# imports write on connections of their own, their notebooks count as busy
+			idle = _db_changes(app) == last_changes and not app.state.importing
+			idle_rounds = idle_rounds + 1 if idle else 0
+
+			cursor = await db_conn.execute("SELECT nbid FROM Notebooks;")
+			nbids = [nbid for nbid, in await cursor.fetchall()]
+			await cursor.close()
+			for nbid in nbids:
+				tablename = f'notebook_{nbid}'
+				if not idle or not await model.db_table_exists(db_conn, tablename + '_fts'):
+					continue
+				stats = fts_stats.setdefault(nbid, {'merge_steps': 0, 'optimizes': 0, 'last_maintenance': None})
+
+				steps = 0
+				while steps < config.FTS_MERGE_STEPS and await model.db_merge_table_fts(db_conn, tablename, config.FTS_MERGE_PAGES):
+					steps += 1
+					await db_conn.commit()
+					await anyio.sleep(0)  # let requests in between steps
+				optimized = False
+				if idle_rounds >= config.FTS_OPTIMIZE_IDLE_ROUNDS and (await model.db_fts_stats(db_conn, tablename))['segments'] > 1:
+					await model.db_optimize_table_fts(db_conn, tablename)
+					await db_conn.commit()
+					optimized = True
+
+				if steps or optimized:
+					stats['merge_steps'] += steps
+					stats['optimizes'] += int(optimized)
+					stats['last_maintenance'] = int(time.time())
+					logger.info(f"fts maintainer: table#{nbid} {steps} merge steps{', optimized' if optimized else ''}")
+
+		except anyio.get_cancelled_exc_class():
+			logger.info("fts maintainer: cancelled")
+			break
+		except Exception as err:
+			logger.exception(f"fts maintainer: error during maintenance: {err!r}")
+		last_changes = _db_changes(app)
+
+	logger.info("fts maintainer: exit")
@@ -0,0 +1,139 @@
+import collections
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+CACHE_MEM_ENTRIES = 50000  # max number of vectors kept in memory
+CACHE_DISK_PATH = os.environ.get("EMBED_CACHE_DISK") or None  # sqlite file of the disk tier, e.g. cache/embeddings.db, unset to keep it off
+
+
+class EmbeddingCache():
+	"""
+	Two-tier cache of (profile, text hash) --> embedding vector.
+	Memory tier is a bounded LRU, disk tier is an optional sqlite file.
+	With the disk tier on, lookups and stores block on sqlite, call them off the event loop.
+	"""
+
+	def __init__(self, mem_entries=CACHE_MEM_ENTRIES, disk_path=CACHE_DISK_PATH):
+		self.mem_entries = mem_entries
+		self.mem = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.stats = {
+			'mem_hits': 0,
+			'disk_hits': 0,
+			'misses': 0,
+			'evictions': 0,
+		}
+
+		self.disk = None
+		if disk_path:
+			disk_path = os.path.join(SCRIPT_DIR, disk_path)
+			os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+			self.disk = sqlite3.connect(disk_path, check_same_thread=False)
+			self.disk.executescript('''
+				PRAGMA journal_mode = WAL;
+				PRAGMA synchronous = NORMAL;
+				CREATE TABLE IF NOT EXISTS embeddings (
+					profile TEXT,
+					hash BLOB,
+					vector BLOB,
+					PRIMARY KEY (profile, hash)
+				) WITHOUT ROWID;
+			''')
+
+	@staticmethod
+	def _hash(text):
+		return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+	def _mem_put(self, key, vec):
+		self.mem[key] = vec
+		self.mem.move_to_end(key)
+		while len(self.mem) > self.mem_entries:
+			self.mem.popitem(last=False)
+			self.stats['evictions'] += 1
+
+	def get_many(self, profile, sentences):
+		"""
+		Look up embeddings for @sentences.
+		Return a list with a vector or None (cache miss) for each sentence.
+		"""
+		keys = [(profile, self._hash(s)) for s in sentences]
+		found = [None] * len(keys)
+		disk_lookups = []
+		with self.lock:
+			for i, key in enumerate(keys):
+				vec = self.mem.get(key)
+				if vec is not None:
+					self.mem.move_to_end(key)
+					found[i] = vec
+					self.stats['mem_hits'] += 1
+				else:
+					disk_lookups.append(i)
+
+			if self.disk and disk_lookups:
+				still_missing = []
+				for i in disk_lookups:
+					row = self.disk.execute(
+						"SELECT vector FROM embeddings WHERE profile = ? AND hash = ?;",
+						keys[i]).fetchone()
+					if row:
+						vec = np.frombuffer(row[0], dtype=np.float32)
+						self._mem_put(keys[i], vec)
+						found[i] = vec
+						self.stats['disk_hits'] += 1
+					else:
+						still_missing.append(i)
+				disk_lookups = still_missing
+
+			self.stats['misses'] += len(disk_lookups)
+		return found
+
+	def put_many(self, profile, sentences, vectors):
+		"""
+		Store newly encoded @vectors for @sentences
+		"""
+		vectors = np.asarray(vectors, dtype=np.float32)
+		rows = []
+		with self.lock:
+			for s, vec in zip(sentences, vectors):
+				key = (profile, self._hash(s))
+				# a copy, a row view would keep the whole batch alive
+				self._mem_put(key, vec.copy())
+				rows.append((key[0], key[1], vec.tobytes()))
+			if self.disk and rows:
+				self.disk.executemany(
+					"INSERT OR REPLACE INTO embeddings (profile, hash, vector) VALUES (?, ?, ?);",
+					rows)
+				self.disk.commit()
+
+	def info(self, count_disk=True):
+		"""
+		Hit rates and sizes, @count_disk: count the disk tier's entries, a full table scan
+		"""
+		with self.lock:
+			lookups = self.stats['mem_hits'] + self.stats['disk_hits'] + self.stats['misses']
+			hits = self.stats['mem_hits'] + self.stats['disk_hits']
+			disk_entries = None
+			if self.disk and count_disk:
+				disk_entries = self.disk.execute("SELECT COUNT(*) FROM embeddings;").fetchone()[0]
+			return {
+				**self.stats,
+				'lookups': lookups,
+				'hit_rate': hits / lookups if lookups else 0.0,
+				'mem_entries': len(self.mem),
+				'mem_capacity': self.mem_entries,
+				'disk_entries': disk_entries,
+			}
+
+	def close(self):
+		if self.disk:
+			self.disk.close()
+			self.disk = None
+
+
+embedding_cache = EmbeddingCache()
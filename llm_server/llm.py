@@ -1,8 +1,12 @@
+import logging
 import asyncio
 import gc
 import contextlib
 import psutil
-import sentence_transformers
+
+import metrics
+
+logger = logging.getLogger(__name__)
 
 llm_profile = None  # singleton llm profile # TODO: use a semaphore to allow multiple concurrent LLMs
 llm_lock = asyncio.Lock()
@@ -35,27 +39,41 @@ llm_profiles = {
 }
 
 
+def resolve_llm_name(name):
+	"""
+	Map "default" to the actual profile name
+	"""
+	return llm_profiles[name] if name == "default" else name
+
+
 def select_llm_profile(name):
 	"""
 	Return a LLM profile from given @name,
 	but check whether the machine has enough ram to run the LLM first
 	"""
-	name = llm_profiles[name] if name == "default" else name
+	name = resolve_llm_name(name)
 	profile = llm_profiles.get(name)
 	if not profile:
-		print("error: llm profile not found")
+		logger.error("llm profile not found")
 		return None
 
 	profile['instance'] = None if 'instance' not in profile else profile['instance']
 	if not profile['instance']:
 		avail_memory = psutil.virtual_memory().available
 		if avail_memory < profile['ram']:
-			print("error: not enough memory to launch a new llm")
+			logger.error("not enough memory to launch a new llm")
 			return None
 
 	return profile
 
 
+def _load_model(profile):
+	# sentence_transformers pulls in torch, import it only once a model is needed
+	import sentence_transformers
+	model_kwargs = profile['model_kwargs'] if 'model_kwargs' in profile else None
+	return sentence_transformers.SentenceTransformer(profile['repo'], model_kwargs=model_kwargs)
+
+
 async def launch_llm(profile):
 	"""
 	Launch a LLM instance if not launched
@@ -68,21 +86,22 @@ async def launch_llm(profile):
 		if profile == llm_profile:
 			return llm_profile['instance']
 		else:
-			print("info: close llm %s" % llm_profile['repo'])
+			logger.info("close llm %s", llm_profile['repo'])
 			llm_profile['instance'] = None  # close other LLMs first
 			gc.collect()
 
 	# launch llm
 	instance = None if 'instance' not in profile else profile['instance']
 	if not instance:
-		print("info: launch llm %s ..." % profile['repo'])
+		logger.info("launch llm %s ...", profile['repo'])
 		try:
-			model_kwargs = profile['model_kwargs'] if 'model_kwargs' in profile else None
-			instance = sentence_transformers.SentenceTransformer(profile['repo'], model_kwargs=model_kwargs)
+			# loading takes seconds, keep serving cached embeddings meanwhile
+			instance = await asyncio.to_thread(_load_model, profile)
 		except Exception as err:
-			print(err)
-			print("error: launch llm failed")
+			logger.error("launch llm failed: %r", err)
+			metrics.llm_launches.inc(outcome='failed')
 			return None
+		metrics.llm_launches.inc(outcome='ok')
 
 	profile['instance'] = instance
 	profile['idle'] = 0
@@ -105,12 +124,11 @@ async def hold_llm(which_llm):
 			raise
 		yield instance
 	except asyncio.TimeoutError:
-		print("warn: hold_llm() timed out")
+		logger.warning("hold_llm() timed out")
 		yield None
 	except Exception as err:
-		print(err)
+		logger.warning("hold_llm() failed: %r", err)
 		yield None
 	finally:
-		print("finally")
 		if llm_lock.locked():
 			llm_lock.release()
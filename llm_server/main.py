@@ -1,8 +1,14 @@
+import time
+startup_t0 = time.perf_counter()  # startup timings count from before the imports
+import logging
+import os
 import asyncio
+import contextlib
 import starlette
 import starlette.routing
 import starlette.responses
 import starlette.applications
+import starlette.middleware
 import starlette.config
 import starlette.datastructures
 import starlette.staticfiles
@@ -11,15 +17,72 @@ import starlette.staticfiles
 # PASSWORD = config('PASSWORD', cast=starlette.datastructures.Secret, default="")
 
 import llm
+import cache
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+	level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+	format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+)
+WARMUP_LLM = os.environ.get("WARMUP_LLM", "default")  # profile loaded in the background once serving, "" to load on first request
+startup_phases = {}  # phase --> seconds
+
+
+async def warmup(name):
+	"""
+	Load a llm profile and run one encode, so the first request doesn't wait for it
+	"""
+	t0 = time.perf_counter()
+	async with llm.hold_llm(name) as model:
+		if model:
+			await asyncio.to_thread(model.encode, ['warm up'])
+	startup_phases['warmup.llm'] = time.perf_counter() - t0
+	logger.info("warm-up: llm %s %s in %.3fs", name, "loaded" if model else "failed", startup_phases['warmup.llm'])
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+	startup_phases['import'] = time.perf_counter() - startup_t0
+	logger.info("startup: import %.3fs", startup_phases['import'])
+	task = asyncio.create_task(warmup(WARMUP_LLM)) if WARMUP_LLM else None
+	yield
+	if task:
+		task.cancel()
 
 
 async def homepage(request):
 	return starlette.responses.PlainTextResponse("This is a barebone LLM Server")
 
 
+@contextlib.contextmanager
+def _stage(timings, name, **attributes):
+	"""
+	Trace a stage and record its duration for the Server-Timing header
+	"""
+	t0 = time.perf_counter()
+	with tracing.span(name, **attributes):
+		try:
+			yield
+		finally:
+			timings[name] = (time.perf_counter() - t0) * 1000
+
+
+def _server_timing(timings):
+	return {'Server-Timing': ', '.join(f"{name};dur={ms:.3f}" for name, ms in timings.items())}
+
+
+async def _cache_call(fn, *args):
+	# the disk tier's sqlite calls run off the event loop, memory lookups are quick enough to run on it
+	if cache.embedding_cache.disk:
+		return await asyncio.to_thread(fn, *args)
+	return fn(*args)
+
+
 async def get_embeddings(request):
 	user_data = None
-	print(request.headers)
+	timings = {}  # stage --> milliseconds
 	sentences = []
 	which_llm = 'default'
 	result_json = {
@@ -33,41 +96,78 @@ async def get_embeddings(request):
 		user_data = await request.json()
 		which_llm = which_llm if 'llm' not in user_data else user_data['llm']
 		sentences = user_data['contents']
+		assert all(isinstance(s, str) for s in sentences)
 	except:
 		result_json['status'] = 400
 		result_json['message'] = 'invalid json'
 		return starlette.responses.JSONResponse(result_json)
 
+	# serve cached embeddings, only forward misses to the llm
+	profile_name = llm.resolve_llm_name(which_llm)
+	with _stage(timings, 'cache', texts=len(sentences)):
+		embeddings = await _cache_call(cache.embedding_cache.get_many, profile_name, sentences)
+	miss_idx = [i for i, emb in enumerate(embeddings) if emb is None]
+	logger.debug("cache hits %d/%d", len(sentences)-len(miss_idx), len(sentences))
+
 	# invoke llm
-	async with llm.hold_llm(which_llm) as model:
-		print("debug: llm = %r" % model)
-		if not model:
-			result_json['status'] = 400
-			result_json['message'] = 'llm is not available'
-			return starlette.responses.JSONResponse(result_json)
+	if miss_idx:
+		t0 = time.perf_counter()
+		async with llm.hold_llm(which_llm) as model:
+			timings['wait'] = (time.perf_counter() - t0) * 1000
+			logger.debug("llm = %r", model)
+			if not model:
+				result_json['status'] = 400
+				result_json['message'] = 'llm is not available'
+				return starlette.responses.JSONResponse(result_json)
 
-		try:
-			embeddings = model.encode(sentences)
-			print("debug: embeddings shape: %s" % (embeddings.shape,))
-			result_json['contents'] = embeddings.tolist()
-			# similarities = model.similarity(embeddings, embeddings)
-			# print(similarities)
-			# from sklearn.metrics.pairwise import cosine_similarity
-			# print(cosine_similarity([embeddings[0]], embeddings[1:]))
-
-		except Exception as err:
-			print(err)
-			result_json['status'] = 400
-			result_json['message'] = 'unable to encode sentence'
-			return starlette.responses.JSONResponse(result_json)
+			try:
+				miss_sentences = [sentences[i] for i in miss_idx]
+				with metrics.encode_seconds.time(llm=profile_name), _stage(timings, 'encode', texts=len(miss_sentences)):
+					miss_embeddings = model.encode(miss_sentences)
+				metrics.encode_batch_size.observe(len(miss_sentences), llm=profile_name)
+				logger.debug("embeddings shape: %s", miss_embeddings.shape)
+				await _cache_call(cache.embedding_cache.put_many, profile_name, miss_sentences, miss_embeddings)
+				for i, emb in zip(miss_idx, miss_embeddings):
+					embeddings[i] = emb
+				# similarities = model.similarity(embeddings, embeddings)
+				# print(similarities)
+				# from sklearn.metrics.pairwise import cosine_similarity
+				# print(cosine_similarity([embeddings[0]], embeddings[1:]))
+
+			except Exception as err:
+				logger.warning("encode failed: %r", err)
+				result_json['status'] = 400
+				result_json['message'] = 'unable to encode sentence'
+				return starlette.responses.JSONResponse(result_json)
+
+	result_json['contents'] = [emb.tolist() for emb in embeddings]
 
 	# return embeddings
-	return starlette.responses.JSONResponse(result_json)
+	return starlette.responses.JSONResponse(result_json, headers=_server_timing(timings))
 
 
+async def cache_stats(request):
+	return starlette.responses.JSONResponse({
+		'status': 200,
+		'message': "okay",
+		'contents': await asyncio.to_thread(cache.embedding_cache.info),
+	})
+
+
+metrics.startup_seconds.fn = lambda: {(p,): s for p, s in startup_phases.items()}
+metrics.embedding_cache.fn = lambda: {
+	(k,): v for k, v in cache.embedding_cache.info(count_disk=False).items() if isinstance(v, (int, float))
+}
+
 routes = [
 	starlette.routing.Route('/', homepage),
 	starlette.routing.Route('/embedding', get_embeddings, methods=["POST"]),
+	starlette.routing.Route('/cache', cache_stats),
+	starlette.routing.Route('/metrics', metrics.metrics_endpoint),
 	starlette.routing.Mount('/static', starlette.staticfiles.StaticFiles(directory="static")),
 ]
-app = starlette.applications.Starlette(routes=routes)
+middlewares = [
+	starlette.middleware.Middleware(metrics.MetricsMiddleware, histogram=metrics.http_request_seconds),
+	starlette.middleware.Middleware(tracing.TracingMiddleware),
+]
+app = starlette.applications.Starlette(routes=routes, middleware=middlewares, lifespan=lifespan)
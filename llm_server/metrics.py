@@ -0,0 +1,15 @@
+import os
+import sys
+
+# the telemetry package at the repository root is shared with the backend
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if ROOT_DIR not in sys.path:
+	sys.path.append(ROOT_DIR)
+
+from telemetry.metrics import Counter, Gauge, Histogram, MetricsMiddleware, metrics_endpoint, render, http_request_seconds, startup_seconds
+
+
+encode_seconds = Histogram('llm_encode_duration_seconds', "Time spent encoding cache misses", labels=('llm',))
+encode_batch_size = Histogram('llm_encode_batch_size', "Texts encoded per call", labels=('llm',), buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+llm_launches = Counter('llm_launches_total', "LLM loads, by outcome", labels=('outcome',))
+embedding_cache = Gauge('embedding_cache', "Embedding cache counters and size", labels=('stat',))
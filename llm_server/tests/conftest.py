@@ -0,0 +1,5 @@
+import os
+import sys
+
+LLM_SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LLM_SERVER_DIR)
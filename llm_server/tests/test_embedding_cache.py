@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from cache import EmbeddingCache
+
+
+@pytest.fixture
+def embedding_cache():
+	c = EmbeddingCache(mem_entries=2, disk_path=None)
+	yield c
+	c.close()
+
+
+def test_hit_and_miss(embedding_cache):
+	assert embedding_cache.get_many('p', ['a', 'b']) == [None, None]
+	embedding_cache.put_many('p', ['a'], [[1.0, 2.0]])
+	a, b = embedding_cache.get_many('p', ['a', 'b'])
+	assert a.tolist() == [1.0, 2.0] and a.dtype == np.float32
+	assert b is None
+	# profiles don't share entries
+	assert embedding_cache.get_many('q', ['a']) == [None]
+	info = embedding_cache.info()
+	assert (info['mem_hits'], info['misses'], info['lookups']) == (1, 4, 5)
+	assert info['disk_entries'] is None
+
+
+def test_entries_do_not_share_the_batch(embedding_cache):
+	batch = np.ones((2, 1024), dtype=np.float32)
+	embedding_cache.put_many('p', ['a', 'b'], batch)
+	a, b = embedding_cache.get_many('p', ['a', 'b'])
+	assert a.base is None and b.base is None
+	batch[0] = 0
+	assert a.tolist() == [1.0] * 1024
+
+
+def test_lru_eviction(embedding_cache):
+	embedding_cache.put_many('p', ['a', 'b'], [[1.0], [2.0]])
+	embedding_cache.get_many('p', ['a'])  # b is now the least recently used
+	embedding_cache.put_many('p', ['c'], [[3.0]])
+	assert [v is not None for v in embedding_cache.get_many('p', ['a', 'b', 'c'])] == [True, False, True]
+	info = embedding_cache.info()
+	assert info['evictions'] == 1 and info['mem_entries'] == 2
+
+
+def test_disk_tier_fallback(tmp_path):
+	disk_path = str(tmp_path / 'cache' / 'embeddings.db')
+	c = EmbeddingCache(mem_entries=1, disk_path=disk_path)
+	c.put_many('p', ['a', 'b'], [[1.0], [2.0]])  # a is evicted from memory, kept on disk
+	assert [v.tolist() for v in c.get_many('p', ['a', 'b'])] == [[1.0], [2.0]]
+	info = c.info()
+	assert (info['mem_hits'], info['disk_hits'], info['misses']) == (1, 1, 0)
+	assert info['disk_entries'] == 2
+	c.close()
+
+	# a fresh cache on the same file starts with an empty memory tier
+	c = EmbeddingCache(mem_entries=1, disk_path=disk_path)
+	assert c.get_many('p', ['b', 'z'])[0].tolist() == [2.0]
+	assert c.info()['disk_hits'] == 1 and c.info()['misses'] == 1
+	c.close()
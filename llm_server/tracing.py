@@ -0,0 +1,15 @@
+import os
+import sys
+
+# the telemetry package at the repository root is shared with the backend
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if ROOT_DIR not in sys.path:
+	sys.path.append(ROOT_DIR)
+
+from telemetry import tracing as _tracing
+from telemetry.tracing import start_trace, span, timings, TracingMiddleware
+
+TRACE_EXPORT = os.environ.get("TRACE_EXPORT", "")  # "" off | stdout | path of a JSON lines file
+SERVICE_NAME = "llm-server"
+
+_tracing.configure(SERVICE_NAME, TRACE_EXPORT)
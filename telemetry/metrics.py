@@ -0,0 +1,182 @@
+import re
+import time
+import bisect
+import threading
+import contextlib
+
+import starlette.responses
+
+
+# latency buckets in seconds, from a cached lookup up to a slow embedding round trip
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REGISTRY = []
+
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+	pairs = [*zip(names, values), *extra]
+	if not pairs:
+		return ''
+	return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric():
+	kind = ''
+
+	def __init__(self, name, doc, labels=()):
+		assert re.match(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$', name)
+		self.name = name
+		self.doc = doc
+		self.label_names = tuple(labels)
+		self.values = {}  # label values --> value
+		self.lock = threading.Lock()  # observed from worker threads too
+		REGISTRY.append(self)
+
+	def _key(self, labels):
+		assert len(labels) == len(self.label_names), f"{self.name} takes labels {self.label_names}"
+		return tuple(str(labels[name]) for name in self.label_names)
+
+	def samples(self):
+		with self.lock:
+			return [(self.name, key, (), value) for key, value in self.values.items()]
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+		for name, key, extra, value in self.samples():
+			lines.append(f"{name}{_format_labels(self.label_names, key, extra)} {_format_value(value)}")
+		return '\n'.join(lines)
+
+
+class Counter(_Metric):
+	kind = 'counter'
+
+	def inc(self, amount=1, **labels):
+		key = self._key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+	"""
+	A value set directly, or read from @fn at scrape time
+	"""
+	kind = 'gauge'
+
+	def __init__(self, name, doc, labels=(), fn=None):
+		super().__init__(name, doc, labels)
+		self.fn = fn  # () --> {label values tuple: value}, or a number without labels
+
+	def set(self, value, **labels):
+		key = self._key(labels)
+		with self.lock:
+			self.values[key] = value
+
+	def inc(self, amount=1, **labels):
+		key = self._key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+	def samples(self):
+		if self.fn is None:
+			return super().samples()
+		try:
+			values = self.fn()
+		except Exception:
+			return []
+		if not isinstance(values, dict):
+			values = {(): values}
+		return [(self.name, key, (), value) for key, value in values.items()]
+
+
+class Histogram(_Metric):
+	kind = 'histogram'
+
+	def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+		super().__init__(name, doc, labels)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self, value, **labels):
+		key = self._key(labels)
+		with self.lock:
+			counts = self.values.get(key)
+			if counts is None:
+				counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+			counts[0][bisect.bisect_left(self.buckets, value)] += 1
+			counts[1] += value
+
+	@contextlib.contextmanager
+	def time(self, **labels):
+		t0 = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - t0, **labels)
+
+	def samples(self):
+		samples = []
+		with self.lock:
+			for key, (counts, total) in self.values.items():
+				cumulative = 0
+				for bound, n in zip((*self.buckets, float('inf')), counts):
+					cumulative += n
+					samples.append((f"{self.name}_bucket", key, (('le', _format_value(float(bound))),), cumulative))
+				samples.append((f"{self.name}_sum", key, (), total))
+				samples.append((f"{self.name}_count", key, (), cumulative))
+		return samples
+
+
+def render():
+	return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+async def metrics_endpoint(request):
+	"""
+	Prometheus text exposition of all metrics
+	"""
+	return starlette.responses.Response(render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+class MetricsMiddleware():
+	"""
+	Time every HTTP request, labelled by the endpoint that served it
+	"""
+
+	def __init__(self, app, histogram):
+		self.app = app
+		self.histogram = histogram
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] != 'http':
+			return await self.app(scope, receive, send)
+
+		status = 500
+
+		async def _send(message):
+			nonlocal status
+			if message['type'] == 'http.response.start':
+				status = message['status']
+			await send(message)
+
+		t0 = time.perf_counter()
+		try:
+			await self.app(scope, receive, _send)
+		finally:
+			# the router records the matched endpoint in the shared scope
+			endpoint = scope.get('endpoint')
+			handler = getattr(endpoint, '__name__', None) or ('static' if scope.get('root_path', '').endswith('/static') else 'unmatched')
+			self.histogram.observe(time.perf_counter() - t0, handler=handler, method=scope['method'], status=status)
+
+
+# recorded by every service
+http_request_seconds = Histogram('http_request_duration_seconds', "HTTP request latency", labels=('handler', 'method', 'status'))
+startup_seconds = Gauge('startup_phase_duration_seconds', "Duration of startup and warm-up phases", labels=('phase',))
@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import contextlib
+import contextvars
+
+import starlette.datastructures
+
+logger = logging.getLogger(__name__)
+
+
+SERVICE_NAME = ""  # set by configure()
+
+# the innermost open span of the running task, inherited by child tasks and worker threads
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span():
+	"""
+	A timed stage of a trace, with OpenTelemetry ids and field names.
+	Every span of a trace shares the root's list of finished spans.
+	"""
+	__slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'attributes', 'finished')
+
+	def __init__(self, name, trace_id, parent_id=None, finished=None, attributes=None):
+		self.name = name
+		self.trace_id = trace_id
+		self.span_id = os.urandom(8).hex()
+		self.parent_id = parent_id
+		self.start_ns = time.time_ns()
+		self.end_ns = None
+		self.attributes = attributes or {}
+		self.finished = finished if finished is not None else []
+
+	def set_attribute(self, key, value):
+		self.attributes[key] = value
+
+	def end(self):
+		self.end_ns = time.time_ns()
+		self.finished.append(self)
+
+	def traceparent(self):
+		"""
+		W3C trace context header value naming this span as the parent
+		"""
+		return f"00-{self.trace_id}-{self.span_id}-01"
+
+	def to_dict(self):
+		return {
+			'traceId': self.trace_id,
+			'spanId': self.span_id,
+			'parentSpanId': self.parent_id or '',
+			'name': self.name,
+			'startTimeUnixNano': self.start_ns,
+			'endTimeUnixNano': self.end_ns,
+			'attributes': self.attributes,
+			'resource': {'service.name': SERVICE_NAME},
+		}
+
+
+def parse_traceparent(value):
+	"""
+	Return (trace_id, parent span_id) of a W3C traceparent header, or None
+	"""
+	parts = (value or '').strip().split('-')
+	if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+		return None
+	try:
+		int(parts[1], 16), int(parts[2], 16)
+	except ValueError:
+		return None
+	if parts[1] == '0'*32 or parts[2] == '0'*16:
+		return None
+	return parts[1], parts[2]
+
+
+@contextlib.contextmanager
+def start_trace(name, traceparent=None, **attributes):
+	"""
+	Open the root span of this process' part of a trace,
+	continuing the caller's trace if @traceparent is given
+	"""
+	parent = parse_traceparent(traceparent)
+	trace_id, parent_id = parent if parent else (os.urandom(16).hex(), None)
+	root = Span(name, trace_id, parent_id, attributes=attributes)
+	token = current_span.set(root)
+	try:
+		yield root
+	finally:
+		current_span.reset(token)
+		root.end()
+		exporter.export(root.finished)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+	"""
+	Time a stage as a child of the current span,
+	a no-op outside of a trace
+	"""
+	parent = current_span.get()
+	if parent is None:
+		yield None
+		return
+	s = Span(name, parent.trace_id, parent.span_id, parent.finished, attributes)
+	token = current_span.set(s)
+	try:
+		yield s
+	finally:
+		current_span.reset(token)
+		s.end()
+
+
+def timings():
+	"""
+	Stages of the current trace finished so far, in start order,
+	as offsets from the root span in milliseconds
+	"""
+	s = current_span.get()
+	if s is None:
+		return []
+	spans = sorted(s.finished, key=lambda x: x.start_ns)
+	t0 = min([x.start_ns for x in spans] + [s.start_ns])
+	return [{
+		'span': x.name,
+		'start_ms': round((x.start_ns - t0) / 1e6, 3),
+		'ms': round((x.end_ns - x.start_ns) / 1e6, 3),
+		**({'attributes': x.attributes} if x.attributes else {}),
+	} for x in spans]
+
+
+class FileExporter():
+	"""
+	Write finished traces as JSON lines, one span per line,
+	to stdout or a file a local collector tails
+	"""
+
+	def __init__(self, target):
+		self.target = target
+		self.lock = threading.Lock()
+		self.f = None
+		if target == 'stdout':
+			self.f = sys.stdout
+		elif target:
+			os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+			self.f = open(target, 'a', buffering=1)
+
+	@property
+	def enabled(self):
+		return self.f is not None
+
+	def export(self, spans):
+		if self.f is None or not spans:
+			return
+		lines = ''.join(json.dumps(s.to_dict(), default=str) + '\n' for s in spans)
+		try:
+			with self.lock:
+				self.f.write(lines)
+		except OSError as err:
+			logger.warning(f"trace export failed: {err!r}")
+
+
+exporter = FileExporter("")  # set by configure()
+
+
+def configure(service_name, target):
+	"""
+	Name the service exporting spans, and export them to @target:
+	"" off | stdout | path of a JSON lines file
+	"""
+	global SERVICE_NAME, exporter
+	SERVICE_NAME = service_name
+	exporter = FileExporter(target)
+
+
+class TracingMiddleware():
+	"""
+	Trace a HTTP request if traces are exported or the request asks for
+	?debug=timings, continuing the caller's trace from its traceparent header
+	"""
+
+	def __init__(self, app):
+		self.app = app
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] != 'http':
+			return await self.app(scope, receive, send)
+
+		query_params = starlette.datastructures.QueryParams(scope.get('query_string', b''))
+		if not exporter.enabled and query_params.get('debug') != 'timings':
+			return await self.app(scope, receive, send)
+
+		headers = starlette.datastructures.Headers(scope=scope)
+		with start_trace(f"{scope['method']} {scope['path']}", headers.get('traceparent')) as root:
+			status = 500
+
+			async def _send(message):
+				nonlocal status
+				if message['type'] == 'http.response.start':
+					status = message['status']
+				await send(message)
+
+			try:
+				await self.app(scope, receive, _send)
+			finally:
+				root.set_attribute('http.status_code', status)